@@ -57,12 +57,17 @@ class Config(object):
         self.temp_dir = "/tmp"
         self.backdoor = False
         self.file_log_debug = False
+        self.rpc_codecs = ["json"]
 
         # Database.
         self.database = "postgresql+psycopg2://cmsuser@localhost/cms"
         self.database_debug = False
         self.twophase_commit = False
 
+        # EvaluationService.
+        self.queue_snapshot_path = None
+        self.worker_evaluation_service_shards = None
+
         # Worker.
         self.keep_sandbox = True
         self.use_cgroups = True
@@ -80,6 +85,7 @@ class Config(object):
         self.contest_listen_address = [""]
         self.contest_listen_port = [8888]
         self.cookie_duration = 1800
+        self.token_duration = 2592000
         self.submit_local_copy = True
         self.submit_local_copy_path = "%s/submissions/"
         self.tests_local_copy = True
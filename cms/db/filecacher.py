@@ -33,6 +33,7 @@ import hashlib
 import io
 import logging
 import os
+import stat
 import tempfile
 
 import gevent
@@ -121,6 +122,17 @@ class FileCacherBackend(object):
         """
         raise NotImplementedError("Please subclass this class.")
 
+    def filter_existing(self, digests):
+        """Tell which of the given files are available in the storage.
+
+        digests ([unicode]): the digests of the files to look for.
+
+        return (set): the digests, among the given ones, of the files
+            that are available.
+
+        """
+        raise NotImplementedError("Please subclass this class.")
+
 
 class FSBackend(FileCacherBackend):
     """This class implements a backend for FileCacher that keeps all
@@ -212,6 +224,13 @@ class FSBackend(FileCacherBackend):
         """
         return list((x, "") for x in os.listdir(self.path))
 
+    def filter_existing(self, digests):
+        """See FileCacherBackend.filter_existing().
+
+        """
+        return set(digest for digest in digests
+                   if os.path.exists(os.path.join(self.path, digest)))
+
 
 class DBBackend(FileCacherBackend):
     """This class implements an actual backend for FileCacher that
@@ -220,6 +239,9 @@ class DBBackend(FileCacherBackend):
 
     """
 
+    # The maximum number of digests to look for in a single query.
+    FILTER_BATCH_SIZE = 1000
+
     def get_file(self, digest):
         """See FileCacherBackend.get_file().
 
@@ -337,6 +359,21 @@ class DBBackend(FileCacherBackend):
             with SessionGen() as session:
                 return _list(session)
 
+    def filter_existing(self, digests):
+        """See FileCacherBackend.filter_existing().
+
+        """
+        digests = list(digests)
+        existing = set()
+        with SessionGen() as session:
+            # Keep the queries (and their IN clause) reasonably sized.
+            for i in xrange(0, len(digests), self.FILTER_BATCH_SIZE):
+                existing.update(
+                    digest for digest, in session.query(FSObject.digest)
+                    .filter(FSObject.digest.in_(
+                        digests[i:i + self.FILTER_BATCH_SIZE])))
+        return existing
+
 
 class NullBackend(FileCacherBackend):
     """This backend is always empty, it just drops each file that
@@ -364,6 +401,9 @@ class NullBackend(FileCacherBackend):
     def list(self):
         return list()
 
+    def filter_existing(self, digests):
+        return set()
+
 
 class FileCacher(object):
     """This class implement a local cache for files stored as FSObject
@@ -469,6 +509,11 @@ class FileCacher(object):
                 ftmp.close()
                 fobj.close()
 
+            # Cached files are never modified, so they can be made
+            # read-only, and shared by hard links (see get_file_path).
+            os.chmod(temp_file_path,
+                     stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+
             # Then move it to its real location (this operation is atomic
             # by POSIX requirement)
             os.rename(temp_file_path, cache_file_path)
@@ -512,6 +557,25 @@ class FileCacher(object):
         else:
             return self.backend.get_file(digest)
 
+    def get_file_path(self, digest):
+        """Return the path of a file in the local cache.
+
+        The file is loaded into the cache if it is not there yet. The
+        cached copy must not be modified by the caller.
+
+        digest (unicode): the digest of the file to get.
+
+        return (string|None): the path of the cached file, or None if
+            caching is disabled.
+
+        raise (KeyError): if the file cannot be found.
+
+        """
+        if not self.enabled:
+            return None
+        self.load(digest, if_needed=True)
+        return os.path.join(self.file_dir, digest)
+
     def get_file_content(self, digest):
         """Retrieve a file from the storage.
 
@@ -765,6 +829,19 @@ class FileCacher(object):
         """
         return self.backend.list()
 
+    def filter_existing(self, digests):
+        """Tell which of the given files are available in the storage.
+
+        Files that are only in the local cache are not considered.
+
+        digests ([unicode]): the digests of the files to look for.
+
+        return (set): the digests, among the given ones, of the files
+            that are available.
+
+        """
+        return self.backend.filter_existing(digests)
+
     def check_backend_integrity(self, delete=False):
         """Check the integrity of the backend.
 
@@ -353,6 +353,17 @@ class SubmissionResult(Base):
         String,
         nullable=True)
 
+    # The score details in the form shown by the practice frontend
+    # (see cms.grading.render_score_details), JSON encoded, and the
+    # version of the rendering that produced them. They are a cache,
+    # filled by ScoringService, and may be null even when scored.
+    rendered_score_details = Column(
+        String,
+        nullable=True)
+    rendered_score_details_version = Column(
+        Integer,
+        nullable=True)
+
     # Follows the description of the fields automatically added by
     # SQLAlchemy.
     # executables (dict of Executable objects indexed by filename)
@@ -511,6 +522,63 @@ class SubmissionResult(Base):
         self.public_score = None
         self.public_score_details = None
         self.ranking_score_details = None
+        self.rendered_score_details = None
+        self.rendered_score_details_version = None
+
+    @staticmethod
+    def invalidate_in_bulk(session, level, submission_ids, dataset_id=None):
+        """Do what invalidate_compilation or invalidate_evaluation do
+        on many submission results at once, with a few SQL statements
+        and without loading them.
+
+        session (Session): the session to use.
+        level (unicode): "compilation" or "evaluation".
+        submission_ids ([int]): the ids of the submissions whose
+            results are to be invalidated.
+        dataset_id (int|None): the id of the dataset of the results,
+            or None for all datasets.
+
+        return (int): the number of submission results invalidated.
+
+        """
+        # The same values set by the methods above.
+        values = {
+            SubmissionResult.score: None,
+            SubmissionResult.score_details: None,
+            SubmissionResult.public_score: None,
+            SubmissionResult.public_score_details: None,
+            SubmissionResult.ranking_score_details: None,
+            SubmissionResult.rendered_score_details: None,
+            SubmissionResult.rendered_score_details_version: None,
+            SubmissionResult.evaluation_outcome: None,
+            SubmissionResult.evaluation_tries: 0,
+        }
+        related = [Evaluation]
+        if level == "compilation":
+            values.update({
+                SubmissionResult.compilation_outcome: None,
+                SubmissionResult.compilation_text: None,
+                SubmissionResult.compilation_tries: 0,
+                SubmissionResult.compilation_time: None,
+                SubmissionResult.compilation_wall_clock_time: None,
+                SubmissionResult.compilation_memory: None,
+                SubmissionResult.compilation_shard: None,
+                SubmissionResult.compilation_sandbox: None,
+            })
+            related.append(Executable)
+
+        for cls in related:
+            query = session.query(cls)\
+                .filter(cls.submission_id.in_(submission_ids))
+            if dataset_id is not None:
+                query = query.filter(cls.dataset_id == dataset_id)
+            query.delete(synchronize_session=False)
+
+        query = session.query(SubmissionResult)\
+            .filter(SubmissionResult.submission_id.in_(submission_ids))
+        if dataset_id is not None:
+            query = query.filter(SubmissionResult.dataset_id == dataset_id)
+        return query.update(values, synchronize_session=False)
 
     def set_compilation_outcome(self, success):
         """Set the compilation outcome based on the success.
@@ -419,6 +419,14 @@ class Dataset(Base):
         Integer,
         nullable=True)
 
+    # If not null, ES reuses the outcome of an identical evaluation
+    # (same executables, testcase, limits and task type) done at most
+    # this long ago instead of running it again. Only sensible when
+    # the outcome doesn't depend on timing or randomness.
+    evaluation_cache_max_age = Column(
+        Interval,
+        nullable=True)
+
     # Name of the TaskType child class suited for the task.
     task_type = Column(
         String,
@@ -39,6 +39,7 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import hashlib
 import json
 
 from cms.db import File, Manager, Executable, UserTestExecutable, Evaluation
@@ -183,6 +184,25 @@ class CompilationJob(Job):
             })
         return res
 
+    def get_cache_key(self):
+        """Return a key identifying the input of the compilation.
+
+        Compilations with the same key are expected to have the same
+        outcome, so that a stored one can be reused.
+
+        return (str): the hex SHA-1 of the task type, its parameters,
+            the language and the digests of files and managers.
+
+        """
+        data = json.dumps([
+            self.task_type,
+            self.task_type_parameters,
+            self.language,
+            sorted((k, v.digest) for k, v in self.files.iteritems()),
+            sorted((k, v.digest) for k, v in self.managers.iteritems()),
+            ])
+        return hashlib.sha1(data).hexdigest()
+
     @classmethod
     def import_from_dict(cls, data):
         data['files'] = dict(
@@ -297,6 +317,52 @@ class EvaluationJob(Job):
             })
         return res
 
+    def get_cache_key(self):
+        """Return a key identifying the input of the evaluation.
+
+        Evaluations with the same key have the same outcome, provided
+        that the task type is deterministic and that timings aren't
+        near the limits.
+
+        return (str): the hex SHA-1 of the task type, its parameters,
+            the language, the digests of files, managers, executables,
+            input and output, and the limits.
+
+        """
+        data = json.dumps([
+            self.task_type,
+            self.task_type_parameters,
+            self.language,
+            sorted((k, v.digest) for k, v in self.files.iteritems()),
+            sorted((k, v.digest) for k, v in self.managers.iteritems()),
+            sorted((k, v.digest) for k, v in self.executables.iteritems()),
+            self.input,
+            self.output,
+            self.time_limit,
+            self.memory_limit,
+            ])
+        return hashlib.sha1(data).hexdigest()
+
+    def to_evaluation(self, **kwargs):
+        """Return an Evaluation storing the outcome of the job.
+
+        kwargs (dict): other attributes of the evaluation (e.g., its
+            testcase).
+
+        return (Evaluation): the new evaluation.
+
+        """
+        return Evaluation(
+            text=json.dumps(self.text, encoding='utf-8'),
+            outcome=self.outcome,
+            execution_time=self.plus.get('execution_time'),
+            execution_wall_clock_time=self.plus.get(
+                'execution_wall_clock_time'),
+            execution_memory=self.plus.get('execution_memory'),
+            evaluation_shard=self.shard,
+            evaluation_sandbox=":".join(self.sandboxes),
+            **kwargs)
+
     @classmethod
     def import_from_dict(cls, data):
         data['files'] = dict(
@@ -498,15 +564,7 @@ class JobGroup(object):
         for test_name, job in self.jobs.iteritems():
             assert isinstance(job, EvaluationJob)
 
-            sr.evaluations += [Evaluation(
-                text=json.dumps(job.text, encoding='utf-8'),
-                outcome=job.outcome,
-                execution_time=job.plus.get('execution_time'),
-                execution_wall_clock_time=job.plus.get(
-                    'execution_wall_clock_time'),
-                execution_memory=job.plus.get('execution_memory'),
-                evaluation_shard=job.shard,
-                evaluation_sandbox=":".join(job.sandboxes),
+            sr.evaluations += [job.to_evaluation(
                 testcase=sr.dataset.testcases[test_name])]
 
     @staticmethod
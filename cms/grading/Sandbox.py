@@ -29,12 +29,13 @@ import logging
 import os
 import re
 import resource
-import select
+import signal
 import stat
 import tempfile
 from functools import wraps, partial
 
 import gevent
+import gevent.select
 from gevent import subprocess
 #import gevent_subprocess as subprocess
 
@@ -51,6 +52,38 @@ class SandboxInterfaceException(Exception):
     pass
 
 
+# The processes started by the sandboxes and still running, mapped to
+# the signal that stops them cleanly, and whether the current job has
+# been aborted (in which case no new process can be started).
+_running = dict()
+_aborted = False
+
+
+def abort_executions():
+    """Stop all the processes running in the sandboxes and prevent
+    new ones from starting, until allow_executions() is called. Used
+    when the result of the current job is not needed anymore.
+
+    """
+    global _aborted
+    _aborted = True
+    for popen, signum in _running.items():
+        logger.info("Stopping process %d of an aborted job.", popen.pid)
+        try:
+            popen.send_signal(signum)
+        except OSError:
+            # The process had died by itself
+            pass
+
+
+def allow_executions():
+    """Allow processes to be started again after abort_executions().
+
+    """
+    global _aborted
+    _aborted = False
+
+
 def with_log(func):
     """Decorator for presuming that the logs are present.
 
@@ -102,12 +135,16 @@ def wait_without_std(procs):
 
     # Read stdout and stderr to the end without having to block
     # because of insufficient buffering (and without allocating too
-    # much memory). Unix specific.
+    # much memory), yielding to the other greenlets in the meantime.
+    # Unix specific.
     to_consume = get_to_consume()
     while len(to_consume) > 0:
-        to_read = select.select(to_consume, [], [], 1.0)[0]
+        to_read = gevent.select.select(to_consume, [], [], 1.0)[0]
         for file_ in to_read:
-            file_.read(8192)
+            # Read only what is available, as the stream may be kept
+            # open by other processes even after this one has died.
+            if len(os.read(file_.fileno(), 8192)) == 0:
+                file_.close()
         to_consume = get_to_consume()
 
     return [process.wait() for process in procs]
@@ -195,6 +232,9 @@ class SandboxBase(object):
     EXIT_SYSCALL = 'syscall'
     EXIT_NONZERO_RETURN = 'nonzero return'
 
+    # The signal sent to the processes of an aborted job.
+    ABORT_SIGNAL = signal.SIGKILL
+
     def __init__(self, file_cacher):
         """Initialization.
 
@@ -223,6 +263,28 @@ class SandboxBase(object):
             mem_str = "(memory usage unknown)"
         return "[%s - %s]" % (time_str, mem_str)
 
+    def _start_process(self, args, **kwargs):
+        """Start the given command with subprocess.Popen, unless the
+        current job has been aborted, and keep track of it until it
+        terminates.
+
+        args ([string]): executable filename and arguments.
+        kwargs (dict): other arguments for subprocess.Popen.
+
+        return (Popen): popen object.
+
+        raise (SandboxInterfaceException): if the job has been aborted.
+
+        """
+        if _aborted:
+            raise SandboxInterfaceException(
+                "Not executing command of aborted job: %s" %
+                pretty_print_cmdline(args))
+        popen = subprocess.Popen(args, **kwargs)
+        _running[popen] = self.ABORT_SIGNAL
+        popen.rawlink(lambda p: _running.pop(p, None))
+        return popen
+
     def get_root_path(self):
         """Return the toplevel path of the sandbox.
 
@@ -309,6 +371,36 @@ class SandboxBase(object):
         self.file_cacher.get_file_to_fobj(digest, file_)
         file_.close()
 
+    def link_file_from_storage(self, path, digest):
+        """Make a file taken from FS available, read-only, in the
+        sandbox.
+
+        The file is hard-linked from the cache of the file cacher
+        instead of being copied, if the cached copy is already
+        read-only for everybody: the link shares its permissions,
+        which therefore are never changed. If this is not possible
+        (for example because caching is disabled, the cached copy has
+        other permissions or the cache is on another file system) it
+        is written as in create_file_from_storage.
+
+        path (string): relative path of the file inside the sandbox.
+        digest (string): digest of the file in FS.
+
+        """
+        cache_path = self.file_cacher.get_file_path(digest)
+        if cache_path is not None and \
+                stat.S_IMODE(os.stat(cache_path).st_mode) == \
+                stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH:
+            try:
+                os.link(cache_path, self.relative_path(path))
+            except OSError:
+                logger.debug("Cannot link file %s in sandbox, copying it.",
+                             path)
+            else:
+                logger.debug("Linked plain file %s in sandbox.", path)
+                return
+        self.create_file_from_storage(path, digest)
+
     def create_file_from_string(self, path, content, executable=False):
         """Write some data to a file in the sandbox.
 
@@ -592,9 +684,10 @@ class StupidSandbox(SandboxBase):
         with io.open(self.relative_path(self.cmd_file), 'at') as commands:
             commands.write("%s\n" % (pretty_print_cmdline(command)))
         try:
-            p = subprocess.Popen(command,
-                                 stdin=stdin, stdout=stdout, stderr=stderr,
-                                 preexec_fn=preexec_fn, close_fds=close_fds)
+            p = self._start_process(command,
+                                    stdin=stdin, stdout=stdout,
+                                    stderr=stderr, preexec_fn=preexec_fn,
+                                    close_fds=close_fds)
         except OSError:
             logger.critical("Failed to execute program in sandbox "
                             "with command: `%s'.",
@@ -753,6 +846,9 @@ class IsolateSandbox(SandboxBase):
     """
     next_id = 0
 
+    # On SIGTERM isolate kills the sandboxed program and exits.
+    ABORT_SIGNAL = signal.SIGTERM
+
     def __init__(self, file_cacher=None, temp_dir=None):
         """Initialization.
 
@@ -1191,7 +1287,8 @@ class IsolateSandbox(SandboxBase):
                      pretty_print_cmdline(args))
         with io.open(self.relative_path(self.cmd_file), 'at') as commands:
             commands.write("%s\n" % (pretty_print_cmdline(args)))
-        return self.translate_box_exitcode(subprocess.call(args))
+        return self.translate_box_exitcode(
+            self._start_process(args).wait())
 
     def _popen(self, command,
                stdin=None, stdout=None, stderr=None,
@@ -1222,9 +1319,9 @@ class IsolateSandbox(SandboxBase):
             commands.write("%s\n" % (pretty_print_cmdline(args)))
         os.chmod(self.path, prev_permissions)
         try:
-            p = subprocess.Popen(args,
-                                 stdin=stdin, stdout=stdout, stderr=stderr,
-                                 close_fds=close_fds)
+            p = self._start_process(args,
+                                    stdin=stdin, stdout=stdout,
+                                    stderr=stderr, close_fds=close_fds)
         except OSError:
             logger.critical("Failed to execute program in sandbox "
                             "with command: %s", pretty_print_cmdline(args),
@@ -233,24 +233,32 @@ class ScoreTypeGroup(ScoreTypeAlone):
 </div>
 {% end %}"""
 
+    def __init__(self, parameters, public_testcases):
+        """See ScoreType.__init__."""
+        # Compute once the codenames of the testcases of each subtask.
+        # XXX Lexicographical order by codename
+        indices = sorted(public_testcases.keys())
+        self.subtask_indices = list()
+        current = 0
+        for parameter in parameters:
+            next_ = current + parameter[1]
+            self.subtask_indices.append(indices[current:next_])
+            current = next_
+
+        super(ScoreTypeGroup, self).__init__(parameters, public_testcases)
+
     def max_scores(self):
         """See ScoreType.max_score."""
         score = 0.0
         public_score = 0.0
         headers = list()
 
-        # XXX Lexicographical order by codename
-        indices = sorted(self.public_testcases.keys())
-        current = 0
-
         for i, parameter in enumerate(self.parameters):
-            next_ = current + parameter[1]
             score += parameter[0]
             if all(self.public_testcases[idx]
-                   for idx in indices[current:next_]):
+                   for idx in self.subtask_indices[i]):
                 public_score += parameter[0]
             headers += ["Subtask %d (%g)" % (i + 1, parameter[0])]
-            current = next_
 
         return score, public_score, headers
 
@@ -261,32 +269,28 @@ class ScoreTypeGroup(ScoreTypeAlone):
             return 0.0, "[]", 0.0, "[]", \
                 json.dumps(["%lg" % 0.0 for _ in self.parameters])
 
-        # XXX Lexicographical order by codename
-        indices = sorted(self.public_testcases.keys())
         evaluations = dict((ev.codename, ev)
                            for ev in submission_result.evaluations)
         subtasks = []
         public_subtasks = []
         ranking_details = []
-        tc_start = 0
-        tc_end = 0
 
         for st_idx, parameter in enumerate(self.parameters):
-            tc_end = tc_start + parameter[1]
+            st_indices = self.subtask_indices[st_idx]
             st_score = self.reduce([float(evaluations[idx].outcome)
-                                    for idx in indices[tc_start:tc_end]],
+                                    for idx in st_indices],
                                    parameter) * parameter[0]
             st_public = all(self.public_testcases[idx]
-                            for idx in indices[tc_start:tc_end])
+                            for idx in st_indices)
             tc_outcomes = dict((
                 idx,
                 self.get_public_outcome(
                     float(evaluations[idx].outcome), parameter)
-                ) for idx in indices[tc_start:tc_end])
+                ) for idx in st_indices)
 
             testcases = []
             public_testcases = []
-            for idx in indices[tc_start:tc_end]:
+            for idx in st_indices:
                 testcases.append({
                     "idx": idx,
                     "outcome": tc_outcomes[idx],
@@ -314,8 +318,6 @@ class ScoreTypeGroup(ScoreTypeAlone):
 
             ranking_details.append("%g" % round(st_score, 2))
 
-            tc_start = tc_end
-
         score = sum(st["score"] for st in subtasks)
         public_score = sum(st["score"]
                            for st in public_subtasks
@@ -26,20 +26,22 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import hashlib
 import io
 import json
 import logging
 import os
 import six
 
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
 
-from sqlalchemy.orm import joinedload
+from sqlalchemy import case, func, or_
+from sqlalchemy.orm import aliased, joinedload
 
 from cms import config, \
     LANG_C, LANG_CPP, LANG_PASCAL, LANG_PYTHON, LANG_PHP, LANG_JAVA, \
     SCORE_MODE_MAX
-from cms.db import Submission
+from cms.db import Submission, SubmissionResult, Task, Token
 from cms.grading.Sandbox import Sandbox
 
 
@@ -331,6 +333,38 @@ def format_status_text(status, translator=None):
         return translator("N/A")
 
 
+# Version of the output of render_score_details, to be increased
+# whenever it changes, so that the stored renderings become stale.
+SCORE_DETAILS_VERSION = 1
+
+
+def render_score_details(score, score_details):
+    """Put the score details in the form used by the practice frontend.
+
+    That is, a list of subtasks (a single one for score types without
+    subtasks) each with its score, its maximum score and its testcases,
+    whose texts are formatted.
+
+    score (float): the score of the submission result.
+    score_details (unicode): its JSON-encoded score details.
+
+    return (unicode): the JSON-encoded rendered details.
+
+    """
+    details = json.loads(score_details)
+    if len(details) > 0 and "text" in details[0]:
+        details = [{
+            "testcases": details,
+            "score": round(score, 2),
+            "max_score": 100,
+        }]
+    for subtask in details:
+        for testcase in subtask["testcases"]:
+            status = json.loads(testcase["text"])
+            testcase["text"] = status[0] % tuple(status[1:])
+    return json.dumps(details)
+
+
 def compilation_step(sandbox, commands):
     """Execute some compilation commands in the sandbox, setting up the
     sandbox itself with a standard configuration and doing standard
@@ -795,6 +829,110 @@ def white_diff(output, res):
                 return False
 
 
+def white_diff_digest(fobj):
+    """Compute a digest of a file that identifies it up to the
+    differences ignored by white_diff: two files are equal according
+    to white_diff if and only if their white diff digests are equal.
+
+    The digest is the SHA1 of the canonicalized lines, each followed
+    by a newline, without the trailing blank ones. The file is read
+    line by line, so it is never kept in memory as a whole.
+
+    fobj (file): the file, opened in binary mode.
+    return (unicode): the hexadecimal white diff digest.
+
+    """
+    hasher = hashlib.sha1()
+    blank_lines = 0
+    for line in iter(fobj.readline, b''):
+        line = white_diff_canonicalize(line)
+        if line == b'':
+            # Blank lines matter only if followed by non-blank ones.
+            blank_lines += 1
+        else:
+            hasher.update(b'\n' * blank_lines + line + b'\n')
+            blank_lines = 0
+    return hasher.hexdigest().decode('ascii')
+
+
+# Maximum number of white diff digests of files in the storage kept
+# in memory by storage_white_diff_digest.
+WHITE_DIFF_DIGEST_CACHE_SIZE = 10000
+
+# The white diff digests of files in the storage, indexed by their
+# digest, from the least to the most recently used.
+_white_diff_digests = OrderedDict()
+
+
+def storage_white_diff_digest(file_cacher, digest):
+    """Return the white diff digest of a file in the storage.
+
+    The digest is computed streaming the file the first time it is
+    requested, and then remembered, so that reference outputs are read
+    only once even if they are checked against many outputs.
+
+    file_cacher (FileCacher): the file cacher to retrieve the file.
+    digest (unicode): the digest of the file in the storage.
+
+    return (unicode): the white diff digest of the file.
+
+    """
+    try:
+        result = _white_diff_digests.pop(digest)
+    except KeyError:
+        with file_cacher.get_file(digest) as fobj:
+            result = white_diff_digest(fobj)
+        if len(_white_diff_digests) >= WHITE_DIFF_DIGEST_CACHE_SIZE:
+            _white_diff_digests.popitem(last=False)
+    _white_diff_digests[digest] = result
+    return result
+
+
+def white_diff_outcome(equal):
+    """Return the outcome and text of a white diff.
+
+    equal (bool): whether the output and the reference output are
+        equal.
+
+    return ((float, [unicode])): the outcome and a description text.
+
+    """
+    if equal:
+        return 1.0, [EVALUATION_MESSAGES.get("success").message]
+    else:
+        return 0.0, [EVALUATION_MESSAGES.get("wrong").message]
+
+
+def white_diff_storage_step(sandbox, output_filename,
+                            correct_output_digest):
+    """Assess the correctedness of a solution like white_diff_step,
+    taking the reference output directly from the storage.
+
+    The reference output is not copied into the sandbox: the output is
+    hashed with white_diff_digest and compared with the (cached) white
+    diff digest of the reference output.
+
+    sandbox (Sandbox): the sandbox we consider.
+    output_filename (string): the filename of user's output in the
+        sandbox.
+    correct_output_digest (unicode): the digest of the reference
+        output in the storage.
+
+    return ((float, [unicode])): the outcome as above and a
+        description text.
+
+    """
+    if sandbox.file_exists(output_filename):
+        with sandbox.get_file(output_filename) as out_file:
+            output_digest = white_diff_digest(out_file)
+        return white_diff_outcome(
+            output_digest == storage_white_diff_digest(
+                sandbox.file_cacher, correct_output_digest))
+    else:
+        return 0.0, [EVALUATION_MESSAGES.get("nooutput").message,
+                     output_filename]
+
+
 def white_diff_step(sandbox, output_filename,
                     correct_output_filename):
     """Assess the correctedness of a solution by doing a simple white
@@ -815,28 +953,42 @@ def white_diff_step(sandbox, output_filename,
     if sandbox.file_exists(output_filename):
         out_file = sandbox.get_file(output_filename)
         res_file = sandbox.get_file(correct_output_filename)
-        if white_diff(out_file, res_file):
-            outcome = 1.0
-            text = [EVALUATION_MESSAGES.get("success").message]
-        else:
-            outcome = 0.0
-            text = [EVALUATION_MESSAGES.get("wrong").message]
+        outcome, text = white_diff_outcome(white_diff(out_file, res_file))
     else:
         outcome = 0.0
         text = [EVALUATION_MESSAGES.get("nooutput").message, output_filename]
     return outcome, text
 
 
-def compute_changes_for_dataset(old_dataset, new_dataset):
-    """This function will compute the differences expected when changing from
-    one dataset to another.
+# The fields of the submission results compared when changing dataset.
+DATASET_CHANGE_FIELDS = ["score", "public_score", "ranking_score_details"]
+
+
+def _differ(old, new, field):
+    """Return the SQL condition for a field to differ (considering
+    NULLs as ordinary values) between two results.
+
+    """
+    return getattr(old, field).op("IS DISTINCT FROM")(getattr(new, field))
+
+
+def _dataset_changes_query(old_dataset, new_dataset, old, new, *columns):
+    """Return a query on the submissions whose results differ between
+    two datasets.
+
+    The results on the two datasets are outer-joined to the
+    submissions of the task, so that the comparison is done by the
+    database and only the rows that differ are returned.
 
     old_dataset (Dataset): the original dataset, typically the active one.
     new_dataset (Dataset): the dataset to compare against.
+    old (SubmissionResult): an alias for the results on old_dataset.
+    new (SubmissionResult): an alias for the results on new_dataset.
+    columns ([object]): the entities and columns to select.
 
-    returns (list): a list of tuples of SubmissionScoreDelta tuples
-        where they differ. Those entries that do not differ will have
-        None in the pair of respective tuple entries.
+    return (Query): the query.
+
+    raise (ValueError): if the datasets belong to different tasks.
 
     """
     # If we are switching tasks, something has gone seriously wrong.
@@ -845,42 +997,111 @@ def compute_changes_for_dataset(old_dataset, new_dataset):
             "Cannot compare datasets referring to different tasks.")
 
     task = old_dataset.task
+    return task.sa_session.query(*columns)\
+        .select_from(Submission)\
+        .outerjoin(old, (old.submission_id == Submission.id) &
+                   (old.dataset_id == old_dataset.id))\
+        .outerjoin(new, (new.submission_id == Submission.id) &
+                   (new.dataset_id == new_dataset.id))\
+        .filter(Submission.task_id == task.id)\
+        .filter(or_(*(_differ(old, new, field)
+                      for field in DATASET_CHANGE_FIELDS)))
+
+
+def compute_changes_for_dataset(old_dataset, new_dataset,
+                                offset=0, limit=None):
+    """This function will compute the differences expected when changing from
+    one dataset to another.
 
-    def compare(a, b):
-        if a == b:
-            return False, (None, None)
-        else:
-            return True, (a, b)
+    old_dataset (Dataset): the original dataset, typically the active one.
+    new_dataset (Dataset): the dataset to compare against.
+    offset (int): the number of differing submissions to skip.
+    limit (int|None): the maximum number of differing submissions to
+        return, or None to return all of them.
 
-    # Construct query with all relevant fields to avoid roundtrips to the DB.
-    submissions = \
-        task.sa_session.query(Submission)\
-            .filter(Submission.task == task)\
-            .options(joinedload(Submission.user))\
-            .options(joinedload(Submission.token))\
-            .options(joinedload(Submission.results)).all()
+    returns (list): a list of tuples of SubmissionScoreDelta tuples
+        where they differ, sorted by user and submission. Those
+        entries that do not differ will have None in the pair of
+        respective tuple entries.
+
+    """
+    old = aliased(SubmissionResult)
+    new = aliased(SubmissionResult)
+    columns = [Submission]
+    for field in DATASET_CHANGE_FIELDS:
+        columns += [getattr(old, field), getattr(new, field)]
+
+    query = _dataset_changes_query(old_dataset, new_dataset, old, new,
+                                   *columns)\
+        .options(joinedload(Submission.user))\
+        .options(joinedload(Submission.token))\
+        .order_by(Submission.user_id, Submission.id)\
+        .offset(offset)
+    if limit is not None:
+        query = query.limit(limit)
 
     ret = []
-    for s in submissions:
-        old = s.get_result(old_dataset)
-        new = s.get_result(new_dataset)
-
-        diff1, pair1 = compare(
-            old.score if old is not None else None,
-            new.score if new is not None else None)
-        diff2, pair2 = compare(
-            old.public_score if old is not None else None,
-            new.public_score if new is not None else None)
-        diff3, pair3 = compare(
-            old.ranking_score_details if old is not None else None,
-            new.ranking_score_details if new is not None else None)
-
-        if diff1 or diff2 or diff3:
-            ret.append(SubmissionScoreDelta(*(s,) + pair1 + pair2 + pair3))
+    for row in query:
+        pairs = ()
+        for a, b in zip(row[1::2], row[2::2]):
+            pairs += (None, None) if a == b else (a, b)
+        ret.append(SubmissionScoreDelta(row[0], *pairs))
 
     return ret
 
 
+def users_with_changes_for_dataset(old_dataset, new_dataset,
+                                   visible_only=False):
+    """Return the users affected by changing from one dataset to
+    another.
+
+    old_dataset (Dataset): the original dataset, typically the active one.
+    new_dataset (Dataset): the dataset to compare against.
+    visible_only (bool): whether to consider only the changes visible
+        to the users, that is to their public scores or to the score
+        of their tokened submissions.
+
+    return ({int}): the ids of the users.
+
+    """
+    old = aliased(SubmissionResult)
+    new = aliased(SubmissionResult)
+    query = _dataset_changes_query(old_dataset, new_dataset, old, new,
+                                   Submission.user_id)
+    if visible_only:
+        query = query\
+            .outerjoin(Token, Token.submission_id == Submission.id)\
+            .filter(_differ(old, new, "public_score") |
+                    ((Token.id != None) &
+                     _differ(old, new, "score")))  # noqa
+    return set(user_id for user_id, in query.distinct())
+
+
+def count_changes_for_dataset(old_dataset, new_dataset):
+    """Summarize the differences expected when changing from one
+    dataset to another, without loading them.
+
+    old_dataset (Dataset): the original dataset, typically the active one.
+    new_dataset (Dataset): the dataset to compare against.
+
+    return ({unicode: int}): the number of submissions whose results
+        differ ("submissions"), of their users ("users") and of the
+        users with visible changes ("visible_users", see
+        users_with_changes_for_dataset).
+
+    """
+    old = aliased(SubmissionResult)
+    new = aliased(SubmissionResult)
+    submissions, users = _dataset_changes_query(
+        old_dataset, new_dataset, old, new,
+        func.count(Submission.id),
+        func.count(Submission.user_id.distinct())).one()
+    return {"submissions": submissions,
+            "users": users,
+            "visible_users": len(users_with_changes_for_dataset(
+                old_dataset, new_dataset, visible_only=True))}
+
+
 ## Computing global scores (for ranking). ##
 
 def task_score(user, task):
@@ -960,3 +1181,76 @@ def task_score(user, task):
         score = max(last_score, max_tokened_score)
 
     return score, partial
+
+
+def contest_scores(session, contest):
+    """Return the scores of all users on all tasks of a contest.
+
+    This computes the same values as task_score, but for the whole
+    contest at once and using aggregate queries, so that no Submission
+    or SubmissionResult object is ever loaded in memory. Only the
+    (user, task) pairs with at least one submission are returned.
+
+    session (Session): the session to use.
+    contest (Contest): the contest for which to compute the scores.
+
+    return ({(int, int): (float, bool)}): a dictionary mapping the
+        pair (user id, task id) to the score of the user on the task,
+        and True if the score could change because of a submission yet
+        to score.
+
+    """
+    scored = SubmissionResult.filter_scored()
+    tokened = Token.id != None  # noqa
+    scored_score = case([(scored, SubmissionResult.score)])
+
+    def base_query(*columns):
+        # Results are taken from the active dataset only; submissions
+        # without a result there are returned anyway, with NULLs.
+        return session.query(Submission.user_id, Submission.task_id,
+                             *columns)\
+            .join(Task, Submission.task_id == Task.id)\
+            .outerjoin(SubmissionResult,
+                       (SubmissionResult.submission_id == Submission.id) &
+                       (SubmissionResult.dataset_id ==
+                        Task.active_dataset_id))\
+            .filter(Task.contest_id == contest.id)
+
+    aggregates = base_query(
+        func.count(Submission.id),
+        func.sum(case([(scored, 1)], else_=0)),
+        func.max(scored_score),
+        func.count(Token.id),
+        func.sum(case([(tokened & scored, 1)], else_=0)),
+        func.max(case([(tokened & scored, SubmissionResult.score)])))\
+        .outerjoin(Token, Token.submission_id == Submission.id)\
+        .group_by(Submission.user_id, Submission.task_id)
+
+    # The score of the last submission of each user on the tasks that
+    # need it (None if not scored yet).
+    last_scores = dict(
+        ((user_id, task_id), score)
+        for user_id, task_id, score in base_query(scored_score)
+        .filter(Task.score_mode != SCORE_MODE_MAX)
+        .distinct(Submission.user_id, Submission.task_id)
+        .order_by(Submission.user_id, Submission.task_id,
+                  Submission.timestamp.desc()))
+
+    ret = {}
+    for user_id, task_id, num, num_scored, max_score, \
+            num_tokened, num_tokened_scored, max_tokened_score \
+            in aggregates:
+        if (user_id, task_id) not in last_scores:
+            # Like in IOI 2013-: maximum score amongst all submissions.
+            score = max_score if max_score is not None else 0.0
+            partial = num_scored < num
+        else:
+            # Like in IOI 2010-2012: maximum score among all tokened
+            # submissions and the last submission.
+            last_score = last_scores[(user_id, task_id)]
+            partial = last_score is None or \
+                num_tokened_scored < num_tokened
+            score = max(last_score or 0.0, max_tokened_score or 0.0)
+        ret[(user_id, task_id)] = (score, partial)
+
+    return ret
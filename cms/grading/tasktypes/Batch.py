@@ -30,7 +30,7 @@ from cms import LANGUAGES, LANGUAGE_TO_SOURCE_EXT_MAP, \
     LANGUAGE_TO_HEADER_EXT_MAP, LANGUAGE_TO_OBJ_EXT_MAP
 from cms.grading import get_compilation_commands, get_evaluation_commands, \
     compilation_step, evaluation_step, human_evaluation_message, \
-    is_evaluation_passed, extract_outcome_and_text, white_diff_step
+    is_evaluation_passed, extract_outcome_and_text, white_diff_storage_step
 from cms.grading.ParameterTypes import ParameterTypeCollection, \
     ParameterTypeChoice, ParameterTypeString
 from cms.grading.TaskType import TaskType, \
@@ -305,15 +305,11 @@ class Batch(TaskType):
                 # Otherwise evaluate the output file.
                 else:
 
-                    # Put the reference solution into the sandbox
-                    sandbox.create_file_from_storage(
-                        "res.txt",
-                        job.output)
-
-                    # Check the solution with white_diff
+                    # Check the solution with white_diff, against the
+                    # reference solution in the storage
                     if self.parameters[2] == "diff":
-                        outcome, text = white_diff_step(
-                            sandbox, output_filename, "res.txt")
+                        outcome, text = white_diff_storage_step(
+                            sandbox, output_filename, job.output)
 
                     # Check the solution with a comparator
                     elif self.parameters[2] == "comparator":
@@ -349,6 +345,11 @@ class Batch(TaskType):
                             sandbox.create_file_from_storage(
                                 input_filename,
                                 job.input)
+                            # Link the reference solution (read-only)
+                            # into the sandbox
+                            sandbox.link_file_from_storage(
+                                "res.txt",
+                                job.output)
                             success, _ = evaluation_step(
                                 sandbox,
                                 [["./%s" % manager_filename,
@@ -33,8 +33,8 @@ import logging
 from cms.grading.TaskType import TaskType, \
     create_sandbox, delete_sandbox
 from cms.grading.ParameterTypes import ParameterTypeChoice
-from cms.grading import white_diff_step, evaluation_step, \
-    extract_outcome_and_text
+from cms.grading import storage_white_diff_digest, white_diff_digest, \
+    white_diff_outcome, evaluation_step, extract_outcome_and_text
 
 
 logger = logging.getLogger(__name__)
@@ -118,20 +118,16 @@ class OutputOnly(TaskType):
         output_digest = job.files["output_%s.txt" %
                                   job._key].digest
 
-        # Put the files into the sandbox
-        sandbox.create_file_from_storage(
-            "res.txt",
-            job.output)
-        sandbox.create_file_from_storage(
-            "output.txt",
-            output_digest)
-
         if self.parameters[0] == "diff":
             # No manager: I'll do a white_diff between the submission
-            # file and the correct output res.txt.
+            # file and the correct output, both taken from the storage.
+            # Only the digest of the latter is worth remembering.
             success = True
-            outcome, text = white_diff_step(
-                sandbox, "output.txt", "res.txt")
+            with file_cacher.get_file(output_digest) as output_file:
+                output_white_digest = white_diff_digest(output_file)
+            outcome, text = white_diff_outcome(
+                output_white_digest ==
+                storage_white_diff_digest(file_cacher, job.output))
 
         elif self.parameters[0] == "comparator":
             # Manager present: wonderful, he'll do all the job.
@@ -150,6 +146,13 @@ class OutputOnly(TaskType):
                 sandbox.create_file_from_storage(
                     "input.txt",
                     input_digest)
+                # Link the outputs (read-only) into the sandbox
+                sandbox.link_file_from_storage(
+                    "res.txt",
+                    job.output)
+                sandbox.link_file_from_storage(
+                    "output.txt",
+                    output_digest)
                 success, _ = evaluation_step(
                     sandbox,
                     [["./%s" % manager_filename,
@@ -33,7 +33,8 @@ from cms import LANGUAGES, LANGUAGE_TO_SOURCE_EXT_MAP, \
 from cms.grading.Sandbox import wait_without_std
 from cms.grading import get_compilation_commands, compilation_step, \
     evaluation_step_before_run, evaluation_step_after_run, \
-    is_evaluation_passed, human_evaluation_message, white_diff_step
+    is_evaluation_passed, human_evaluation_message, \
+    white_diff_storage_step
 from cms.grading.TaskType import TaskType, \
     create_sandbox, delete_sandbox
 from cms.db import Executable
@@ -289,13 +290,8 @@ class TwoSteps(TaskType):
 
                 # If not asked otherwise, evaluate the output file
                 if not job.only_execution:
-                    # Put the reference solution into the sandbox
-                    second_sandbox.create_file_from_storage(
-                        "res.txt",
-                        job.output)
-
-                    outcome, text = white_diff_step(
-                        second_sandbox, "output.txt", "res.txt")
+                    outcome, text = white_diff_storage_step(
+                        second_sandbox, "output.txt", job.output)
 
         # Whatever happened, we conclude.
         job.success = success
@@ -360,6 +360,15 @@ class PriorityQueue(object):
         """
         return self.length() == 0
 
+    def get_sorted_entries(self):
+        """Return the entries of the queue, in the order in which they
+        would be extracted.
+
+        return ([QueueEntry]): the entries of the queue.
+
+        """
+        return sorted(self._queue)
+
     def get_status(self):
         """Return the content of the queue. Note that the order may be not
         correct, but the first element is the one at the top.
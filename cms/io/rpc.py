@@ -28,6 +28,7 @@ import functools
 import json
 import logging
 import socket
+import struct
 import traceback
 import uuid
 from weakref import WeakSet
@@ -37,12 +38,103 @@ import gevent.coros
 import gevent.socket
 import gevent.event
 
-from cms import Address, get_service_address
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from cms import Address, config, get_service_address
 
 
 logger = logging.getLogger(__name__)
 
 
+# Messages can travel on the wire in two formats. The legacy one is a
+# JSON document terminated by "\r\n". The framed one is a header
+# made of a null byte (which can never start a JSON document), the
+# identifier of the codec used to serialize the message and the
+# length of the payload (as an unsigned 32-bit big-endian integer),
+# followed by the payload itself. Readers accept both formats on any
+# connection; clients start with the legacy one and switch to a
+# framed one once the server has agreed to it (see NEGOTIATE_METHOD).
+FRAME_MARKER = b"\x00"
+FRAME_HEADER = struct.Struct(b"!cBI")
+
+# Name of the pseudo-method clients call to agree on a codec. Servers
+# not knowing it just answer with an error, and the legacy format
+# keeps being used.
+NEGOTIATE_METHOD = "__negotiate"
+
+
+def _json_encode(message):
+    return json.dumps(message, encoding='utf-8')
+
+
+def _json_decode(data):
+    return json.loads(data, encoding='utf-8')
+
+
+def _msgpack_encode(message):
+    # Strings are all packed as raw and unpacked as unicode, to get
+    # the same semantics as JSON.
+    return msgpack.packb(message, use_bin_type=False)
+
+
+def _msgpack_decode(data):
+    try:
+        return msgpack.unpackb(data, raw=False)
+    except Exception as error:
+        raise ValueError("%s" % error)
+
+
+# Map from codec names to their identifier in the frame header and
+# their encoding and decoding functions. Encoders raise TypeError or
+# ValueError on data they cannot represent, decoders raise ValueError
+# on malformed input.
+CODECS = {
+    "json": (1, _json_encode, _json_decode),
+}
+if msgpack is not None:
+    CODECS["msgpack"] = (2, _msgpack_encode, _msgpack_decode)
+
+CODEC_NAMES = dict((codec_id, name)
+                   for name, (codec_id, _, _) in CODECS.iteritems())
+
+
+def encode_message(message, codec=None):
+    """Serialize a request or a response.
+
+    message (dict): the message to encode.
+    codec (unicode|None): the name of the codec to use, or None for
+        the legacy JSON format.
+
+    return (bytes): the encoded message.
+
+    raise (TypeError, ValueError): if the message cannot be encoded.
+
+    """
+    if codec is None:
+        return _json_encode(message)
+    return CODECS[codec][1](message)
+
+
+def decode_message(data, codec=None):
+    """Deserialize a request or a response.
+
+    data (bytes): the payload of the message.
+    codec (unicode|None): the name of the codec it was encoded with,
+        or None for the legacy JSON format.
+
+    return (object): the decoded message.
+
+    raise (ValueError): if the data is malformed.
+
+    """
+    if codec is None:
+        return _json_decode(data)
+    return CODECS[codec][2](data)
+
+
 class RPCError(Exception):
     """Generic error during RPC communication."""
     pass
@@ -78,8 +170,9 @@ class RemoteServiceBase(object):
     will be fired.
 
     """
-    # Incoming messages larger than 1 MiB are dropped to avoid DOS
-    # attacks. XXX Check that this size is sensible.
+    # Incoming messages in the legacy format larger than 1 MiB are
+    # dropped to avoid DOS attacks. Framed messages aren't limited.
+    # XXX Check that this size is sensible.
     MAX_MESSAGE_SIZE = 1024 * 1024
 
     def __init__(self, remote_address):
@@ -193,10 +286,13 @@ class RemoteServiceBase(object):
     def _read(self):
         """Receive a message from the socket.
 
-        Read from the socket until a "\\r\\n" is found. That is what we
-        consider a "message" in the communication protocol.
+        Both formats of the protocol are accepted: if the message
+        starts with FRAME_MARKER the length in the header tells how
+        much to read, otherwise read until a "\\r\\n" is found.
 
-        return (bytes): the retrieved message.
+        return ((unicode|None, bytes)): the codec of the message (None
+            for the legacy format) and its payload; the payload is
+            empty if the connection was closed.
 
         raise (IOError): if reading fails.
 
@@ -208,7 +304,12 @@ class RemoteServiceBase(object):
             with self._read_lock:
                 if not self.connected:
                     raise IOError("Not connected.")
-                data = self._reader.readline(self.MAX_MESSAGE_SIZE)
+                first = self._reader.read(1)
+                if first == FRAME_MARKER:
+                    return self._read_frame()
+                data = first
+                if len(first) > 0 and first != b"\n":
+                    data += self._reader.readline(self.MAX_MESSAGE_SIZE - 1)
                 # If there weren't a "\r\n" between the last message
                 # and the EOF we would have a false positive here.
                 # Luckily there is one.
@@ -224,14 +325,44 @@ class RemoteServiceBase(object):
             self.finalize("Read failed.")
             raise error
 
-        return data
+        return None, data
+
+    def _read_frame(self):
+        """Read the rest of a framed message, after its marker.
+
+        Must be called with the read lock held.
+
+        return ((unicode, bytes)): the codec and the payload.
 
-    def _write(self, data):
+        raise (IOError): if the frame is truncated or malformed.
+
+        """
+        header = self._reader.read(FRAME_HEADER.size - 1)
+        if len(header) < FRAME_HEADER.size - 1:
+            self.finalize("Connection closed.")
+            raise IOError("Truncated frame header.")
+        _, codec_id, length = FRAME_HEADER.unpack(FRAME_MARKER + header)
+        data = self._reader.read(length)
+        if len(data) < length:
+            self.finalize("Connection closed.")
+            raise IOError("Truncated frame.")
+        if codec_id not in CODEC_NAMES:
+            # We can't know what's inside, but we know where it ends:
+            # the stream is still in sync.
+            logger.warning("Received a message with unknown codec %d.",
+                           codec_id)
+            return False, data
+        return CODEC_NAMES[codec_id], data
+
+    def _write(self, data, codec=None):
         """Send a message to the socket.
 
-        Automatically append "\\r\\n" to make it a correct message.
+        In the legacy format, automatically append "\\r\\n" to make it
+        a correct message; otherwise prepend the frame header.
 
         data (bytes): the message to transmit.
+        codec (unicode|None): the codec data was encoded with, or None
+            for the legacy format.
 
         raise (IOError): if writing fails.
 
@@ -239,7 +370,7 @@ class RemoteServiceBase(object):
         if not self.connected:
             raise IOError("Not connected.")
 
-        if len(data + b'\r\n') > self.MAX_MESSAGE_SIZE:
+        if codec is None and len(data) + 2 > self.MAX_MESSAGE_SIZE:
             logger.error(
                 "A message wasn't sent to %r because it was larger than %d "
                 "bytes (that is MAX_MESSAGE_SIZE). Consider raising that "
@@ -248,12 +379,22 @@ class RemoteServiceBase(object):
             # No need to call finalize.
             raise IOError("Message too long.")
 
+        if codec is None:
+            head, tail = b"", b"\r\n"
+        else:
+            head = FRAME_HEADER.pack(FRAME_MARKER, CODECS[codec][0],
+                                     len(data))
+            tail = b""
+
         try:
             with self._write_lock:
                 if not self.connected:
                     raise IOError("Not connected.")
-                # Does the same as self._socket.sendall.
-                self._writer.write(data + b'\r\n')
+                # Does the same as self._socket.sendall, but the
+                # buffered writer spares us concatenating the payload.
+                self._writer.write(head)
+                self._writer.write(data)
+                self._writer.write(tail)
                 self._writer.flush()
         except socket.error as error:
             logger.warning("Failed writing to socket: %s.", error)
@@ -309,41 +450,48 @@ class RemoteServiceServer(RemoteServiceBase):
         """
         while True:
             try:
-                data = self._read()
+                codec, data = self._read()
             except IOError:
                 break
 
-            if len(data) == 0:
+            if codec is None and len(data) == 0:
                 self.finalize("Connection closed.")
                 break
 
-            gevent.spawn(self.process_data, data)
+            gevent.spawn(self.process_data, data, codec)
 
-    def process_data(self, data):
+    def process_data(self, data, codec=None):
         """Handle the message.
 
-        JSON-decode it and forward it to process_incoming_request
+        Decode it and forward it to process_incoming_request
         (unconditionally!).
 
         data (bytes): the message read from the socket.
+        codec (unicode|None|False): the codec of the message (None for
+            the legacy format, False if unknown).
 
         """
         # Decode the incoming data.
         try:
-            message = json.loads(data, encoding='utf-8')
+            if codec is False:
+                raise ValueError("Unknown codec.")
+            message = decode_message(data, codec)
         except ValueError:
             logger.warning("Cannot parse incoming message, discarding.")
             return
 
-        self.process_incoming_request(message)
+        self.process_incoming_request(message, codec)
 
-    def process_incoming_request(self, request):
+    def process_incoming_request(self, request, codec=None):
         """Handle the request.
 
         Parse the request, execute the method it asks for, format the
-        result and send the response.
+        result and send the response, in the same format the request
+        came in.
 
-        request (dict): the JSON-decoded request.
+        request (dict): the decoded request.
+        codec (unicode|None): the codec of the request (None for the
+            legacy format).
 
         """
         # Validate the request.
@@ -364,11 +512,14 @@ class RemoteServiceServer(RemoteServiceBase):
 
         method_name = request["__method"]
 
-        if not hasattr(self.local_service, method_name):
-            response["__error"] = "Method %s doesn't exist." % method_name
+        if method_name == NEGOTIATE_METHOD:
+            method = self.negotiate
         else:
-            method = getattr(self.local_service, method_name)
+            method = getattr(self.local_service, method_name, None)
 
+        if method is None:
+            response["__error"] = "Method %s doesn't exist." % method_name
+        else:
             if not getattr(method, "rpc_callable", False):
                 response["__error"] = "Method %s isn't callable." % method_name
             else:
@@ -381,18 +532,35 @@ class RemoteServiceServer(RemoteServiceBase):
 
         # Encode it.
         try:
-            data = json.dumps(response, encoding='utf-8')
-        except (TypeError, ValueError):
-            logger.warning("JSON encoding failed.", exc_info=True)
+            data = encode_message(response, codec)
+        except (TypeError, ValueError, OverflowError):
+            logger.warning("Encoding failed.", exc_info=True)
             return
 
         # Send it.
         try:
-            self._write(data)
+            self._write(data, codec)
         except IOError:
             # Log messages have already been produced.
             return
 
+    @staticmethod
+    @rpc_method
+    def negotiate(codecs=None):
+        """Choose the codec for the framed format of the protocol.
+
+        codecs ([unicode]|None): the codecs the client supports, in
+            order of preference.
+
+        return (unicode|None): the first of them we support, or None
+            if the legacy format has to be kept.
+
+        """
+        for codec in codecs or []:
+            if codec in CODECS:
+                return codec
+        return None
+
 
 class RemoteServiceClient(RemoteServiceBase):
     """The client side of a RPC communication.
@@ -429,6 +597,10 @@ class RemoteServiceClient(RemoteServiceBase):
         self.pending_outgoing_requests = dict()
         self.pending_outgoing_requests_results = dict()
 
+        # The codec agreed with the server for the current connection,
+        # or None to use the legacy format.
+        self._codec = None
+
         self.auto_retry = auto_retry
 
     def _repr_remote(self):
@@ -440,6 +612,8 @@ class RemoteServiceClient(RemoteServiceBase):
         """See RemoteServiceBase.finalize."""
         super(RemoteServiceClient, self).finalize(reason)
 
+        self._codec = None
+
         for result in self.pending_outgoing_requests_results.itervalues():
             result.set_exception(RPCError(reason))
 
@@ -458,6 +632,32 @@ class RemoteServiceClient(RemoteServiceBase):
                          self._repr_remote(), error)
         else:
             self.initialize(sock, self.remote_service_coord)
+            self._negotiate()
+
+    def _negotiate(self):
+        """Ask the server to switch to the framed format.
+
+        Until the server answers, requests keep being sent in the
+        legacy format; servers reply in the format of each request, so
+        there's no need to wait.
+
+        """
+        codecs = [codec for codec in config.rpc_codecs if codec in CODECS]
+        if len(codecs) == 0:
+            return
+
+        sock = self._socket
+
+        def set_codec(result):
+            # Make sure the connection wasn't replaced in the meantime.
+            if self.connected and self._socket is sock \
+                    and result.successful() and result.value in CODECS:
+                self._codec = result.value
+                logger.debug("Using codec %s with %s.", self._codec,
+                             self._repr_remote())
+
+        self.execute_rpc(NEGOTIATE_METHOD, {"codecs": codecs})\
+            .rawlink(set_codec)
 
     def _run(self):
         """Maintain the connection up, if required.
@@ -497,28 +697,32 @@ class RemoteServiceClient(RemoteServiceBase):
         """
         while True:
             try:
-                data = self._read()
+                codec, data = self._read()
             except IOError:
                 break
 
-            if len(data) == 0:
+            if codec is None and len(data) == 0:
                 self.finalize("Connection closed.")
                 break
 
-            gevent.spawn(self.process_data, data)
+            gevent.spawn(self.process_data, data, codec)
 
-    def process_data(self, data):
+    def process_data(self, data, codec=None):
         """Handle the message.
 
-        JSON-decode it and forward it to process_incoming_response
+        Decode it and forward it to process_incoming_response
         (unconditionally!).
 
         data (bytes): the message read from the socket.
+        codec (unicode|None|False): the codec of the message (None for
+            the legacy format, False if unknown).
 
         """
         # Decode the incoming data.
         try:
-            message = json.loads(data, encoding='utf-8')
+            if codec is False:
+                raise ValueError("Unknown codec.")
+            message = decode_message(data, codec)
         except ValueError:
             logger.warning("Cannot parse incoming message, discarding.")
             return
@@ -531,7 +735,7 @@ class RemoteServiceClient(RemoteServiceBase):
         Parse the response, determine the request it's for and its
         associated result and fill it.
 
-        response (dict): the JSON-decoded response.
+        response (dict): the decoded response.
 
         """
         # Validate the response.
@@ -553,7 +757,11 @@ class RemoteServiceClient(RemoteServiceBase):
         if error is not None:
             err_msg = "%s signaled RPC for method %s was unsuccessful: %s." % (
                 self.remote_service_coord, request["__method"], error)
-            logger.error(err_msg)
+            if request["__method"] == NEGOTIATE_METHOD:
+                # Expected from servers that only know the legacy format.
+                logger.debug(err_msg)
+            else:
+                logger.error(err_msg)
             result.set_exception(RPCError(error))
         else:
             result.set(response["__data"])
@@ -580,15 +788,16 @@ class RemoteServiceClient(RemoteServiceBase):
         result = gevent.event.AsyncResult()
 
         # Encode it.
+        codec = self._codec
         try:
-            data = json.dumps(request, encoding='utf-8')
-        except (TypeError, ValueError):
-            result.set_exception(RPCError("JSON encoding failed."))
+            data = encode_message(request, codec)
+        except (TypeError, ValueError, OverflowError):
+            result.set_exception(RPCError("Encoding failed."))
             return result
 
         # Send it.
         try:
-            self._write(data)
+            self._write(data, codec)
         except IOError:
             result.set_exception(RPCError("Write failed."))
             return result
@@ -681,6 +890,7 @@ class FakeRemoteServiceClient(RemoteServiceClient):
         self.remote_service_coord = remote_service_coord
         self.pending_outgoing_requests = dict()
         self.pending_outgoing_requests_results = dict()
+        self._codec = None
         self.auto_retry = auto_retry
 
     def connect(self):
@@ -262,10 +262,12 @@ class TriggeredService(Service):
         for executor in self._executors:
             executor.dequeue(operation)
 
-    def start_sweeper(self, timeout):
+    def start_sweeper(self, timeout, immediately=True):
         """Start sweeper loop with given timeout.
 
         timeout (float): timeout in seconds.
+        immediately (bool): whether to sweep immediately or only after
+            the timeout.
 
         """
         if not self._sweeper_started:
@@ -273,11 +275,11 @@ class TriggeredService(Service):
             self._sweeper_timeout = timeout
 
             # TODO: link to greenlet and react to its death.
-            gevent.spawn(self._sweeper_loop)
+            gevent.spawn(self._sweeper_loop, immediately)
         else:
             logger.warning("Service tried to start the sweeper loop twice.")
 
-    def _sweeper_loop(self):
+    def _sweeper_loop(self, immediately=True):
         """Regularly check for missed operations.
 
         Run the sweep once every _sweeper_timeout seconds but make
@@ -294,7 +296,12 @@ class TriggeredService(Service):
         Any error during the sweep is sent to the logger and then
         suppressed, because the loop must go on.
 
+        immediately (bool): whether to sweep immediately or only after
+            the timeout.
+
         """
+        if not immediately:
+            self._sweeper_event.wait(self._sweeper_timeout)
         while True:
             self._sweeper_start = monotonic_time()
             self._sweeper_event.clear()
@@ -47,11 +47,18 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import codecs
 import curses
 import logging
+import os
 import sys
+from collections import deque
 
+import gevent
 import gevent.coros
+import gevent.event
+
+from cmscommon.datetime import monotonic_time
 
 
 class StreamHandler(logging.StreamHandler):
@@ -82,6 +89,102 @@ class FileHandler(logging.FileHandler):
         self.lock = gevent.coros.RLock()
 
 
+class RotatingFileHandler(FileHandler):
+    """A gevent-aware file handler that buffers writes and rotates.
+
+    Unlike FileHandler, records aren't flushed to disk one by one:
+    the stream is flushed only for records at WARNING or above and
+    when at least flush_interval seconds have passed since the last
+    flush. Whoever owns the handler should call flush() periodically
+    to write out the remaining data when the traffic stops.
+
+    When the file grows beyond max_bytes it is renamed with a ".1"
+    suffix (shifting older ones, up to backup_count of them) and a new
+    one is started with the same name.
+
+    """
+    BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, filename, mode='a', encoding=None, max_bytes=0,
+                 backup_count=0, flush_interval=1.0):
+        """Initialize the handler.
+
+        filename (string): the path of the file.
+        mode (string): the mode to open the file with.
+        encoding (string|None): the encoding to write the file in.
+        max_bytes (int): the size at which to rotate (0 disables
+            rotation).
+        backup_count (int): how many old files to keep.
+        flush_interval (float): maximum time (in seconds) a record
+            (received while other records are coming) stays in the
+            buffer.
+
+        """
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self._size = 0
+        self._last_flush = monotonic_time()
+        FileHandler.__init__(self, filename, mode, encoding)
+
+    def _open(self):
+        """Open the file with a large buffer.
+
+        """
+        if self.encoding is None:
+            stream = open(self.baseFilename, self.mode, self.BUFFER_SIZE)
+        else:
+            stream = codecs.open(self.baseFilename, self.mode,
+                                 self.encoding, buffering=self.BUFFER_SIZE)
+        stream.seek(0, os.SEEK_END)
+        self._size = stream.tell()
+        return stream
+
+    def do_rollover(self):
+        """Close the current file, shift the old ones and reopen.
+
+        """
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        if self.backup_count > 0:
+            for i in xrange(self.backup_count - 1, 0, -1):
+                src = "%s.%d" % (self.baseFilename, i)
+                if os.path.exists(src):
+                    os.rename(src, "%s.%d" % (self.baseFilename, i + 1))
+            os.rename(self.baseFilename, self.baseFilename + ".1")
+        else:
+            os.remove(self.baseFilename)
+        self.mode = 'w'
+        self.stream = self._open()
+
+    def emit(self, record):
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            if 0 < self.max_bytes <= self._size:
+                self.do_rollover()
+            msg = self.format(record) + "\n"
+            self.stream.write(msg)
+            # In characters rather than bytes, but it's close enough.
+            self._size += len(msg)
+            if record.levelno >= logging.WARNING or \
+                    monotonic_time() - self._last_flush >= \
+                    self.flush_interval:
+                self.flush()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def flush(self):
+        """Write out the buffered data.
+
+        """
+        self._last_flush = monotonic_time()
+        FileHandler.flush(self)
+
+
 class LogServiceHandler(logging.Handler):
     """Send log messages to a remote centralized LogService.
 
@@ -101,17 +204,117 @@ class LogServiceHandler(logging.Handler):
     For args, we just format them into msg to produce the message. We
     then store the message as msg and drop args.
 
+    Records aren't sent one by one: they are put in a bounded queue
+    and a dedicated greenlet ships them in batches via LogBatch, so
+    that logging never blocks on the LogService. If the queue is full
+    (e.g., the LogService is slow or unreachable) records are dropped.
+    To tame chatty loggers, records below WARNING are also sampled: at
+    most sampling_rate of them per second are kept for each logger.
+    The number of records dropped for either reason is counted and
+    reported to the LogService with the next batch.
+
     """
-    def __init__(self, log_service):
+    # Maximum number of records in a single LogBatch call.
+    BATCH_SIZE = 100
+    # Maximum time (in seconds) a record waits before being sent.
+    FLUSH_INTERVAL = 0.1
+    # Maximum number of records waiting to be sent.
+    MAX_QUEUE_SIZE = 10000
+    # How long (in seconds) to wait for the LogService to acknowledge
+    # a batch before sending the next one anyway.
+    BATCH_TIMEOUT = 5.0
+
+    def __init__(self, log_service, sampling_rate=50):
         """Initialize the handler.
 
         Establish a connection to the given LogService.
 
         log_service (RemoteService): a handle for a remote LogService.
+        sampling_rate (int|None): maximum number of records below
+            WARNING to send per second for each logger, or None not to
+            sample.
 
         """
         logging.Handler.__init__(self)
         self._log_service = log_service
+        self.sampling_rate = sampling_rate
+
+        self._queue = deque()
+        self._queue_not_empty = gevent.event.Event()
+        # Number of records dropped because the queue was full, and
+        # because of sampling, since the last report.
+        self.dropped = 0
+        self.sampled_out = 0
+        # For each logger name, the second we are sampling and how
+        # many records have been kept in it.
+        self._sampling_windows = dict()
+
+        self._sender = gevent.spawn(self._send_loop)
+
+    def _sample(self, record):
+        """Decide whether to keep a record.
+
+        record (LogRecord): the record.
+
+        return (bool): False if the record has to be dropped.
+
+        """
+        if self.sampling_rate is None or record.levelno >= logging.WARNING:
+            return True
+        second = int(monotonic_time())
+        window, count = self._sampling_windows.get(record.name, (second, 0))
+        if window != second:
+            window, count = second, 0
+        if count >= self.sampling_rate:
+            self.sampled_out += 1
+            return False
+        self._sampling_windows[record.name] = (window, count + 1)
+        return True
+
+    def _report_drops(self):
+        """Return a record describing the dropped ones, if any.
+
+        return (dict|None): the attributes of a LogRecord, or None.
+
+        """
+        if self.dropped == 0 and self.sampled_out == 0:
+            return None
+        record = logging.makeLogRecord({
+            "name": __name__,
+            "levelno": logging.WARNING,
+            "levelname": "WARNING",
+            "msg": "%d log records dropped because the queue was full, "
+                   "%d because of sampling." % (self.dropped,
+                                                self.sampled_out)})
+        for filter_ in self.filters:
+            filter_.filter(record)
+        self.dropped = 0
+        self.sampled_out = 0
+        return dict(record.__dict__)
+
+    def _send_loop(self):
+        """Ship the queued records to the LogService, forever.
+
+        """
+        while True:
+            self._queue_not_empty.wait()
+            # Give other records the chance to join the batch.
+            if len(self._queue) < self.BATCH_SIZE:
+                gevent.sleep(self.FLUSH_INTERVAL)
+            batch = []
+            while len(self._queue) > 0 and len(batch) < self.BATCH_SIZE:
+                batch.append(self._queue.popleft())
+            if len(self._queue) == 0:
+                self._queue_not_empty.clear()
+            report = self._report_drops()
+            if report is not None:
+                batch.append(report)
+            try:
+                result = self._log_service.LogBatch(records=batch)
+                result.wait(timeout=self.BATCH_TIMEOUT)
+            except Exception:
+                # We cannot log this, obviously.
+                pass
 
     def createLock(self):
         """Set self.lock to a new gevent RLock.
@@ -124,6 +327,11 @@ class LogServiceHandler(logging.Handler):
     # for LogService.Log.
     def emit(self, record):
         try:
+            if not self._sample(record):
+                return
+            if len(self._queue) >= self.MAX_QUEUE_SIZE:
+                self.dropped += 1
+                return
             ei = record.exc_info
             if ei:
                 # just to get traceback text into record.exc_text ...
@@ -137,7 +345,8 @@ class LogServiceHandler(logging.Handler):
             d['args'] = None
             if ei:
                 record.exc_info = ei  # for next handler
-            self._log_service.Log(**d)
+            self._queue.append(d)
+            self._queue_not_empty.set()
         except (KeyboardInterrupt, SystemExit):
             raise
         except:
@@ -53,7 +53,8 @@ from cms.db import Session, Contest, User, Announcement, Question, Message, \
     Submission, File, Task, Dataset, Attachment, Manager, Testcase, \
     SubmissionFormatElement, Statement
 from cms.db.filecacher import FileCacher
-from cms.grading import compute_changes_for_dataset
+from cms.grading import compute_changes_for_dataset, contest_scores, \
+    count_changes_for_dataset, users_with_changes_for_dataset
 from cms.grading.tasktypes import get_task_type_class
 from cms.grading.scoretypes import get_score_type_class
 from cms.server import file_handler_gen, get_url_root, \
@@ -1070,28 +1071,43 @@ class DeleteDatasetHandler(BaseHandler):
 class ActivateDatasetHandler(BaseHandler):
     """Set a given dataset to be the active one for a task.
 
+    The preview of the changes is shown a page at a time, sorted by
+    user.
+
     """
+    # Number of changed submissions shown in each page.
+    PAGE_SIZE = 100
+
     def get(self, dataset_id):
         dataset = self.safe_get_item(Dataset, dataset_id)
         task = dataset.task
         self.contest = task.contest
 
-        changes = compute_changes_for_dataset(task.active_dataset, dataset)
-        notify_users = set()
+        try:
+            page = max(int(self.get_argument("page", "0")), 0)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+
+        summary = count_changes_for_dataset(task.active_dataset, dataset)
+        page_count = max((summary["submissions"] + self.PAGE_SIZE - 1) //
+                         self.PAGE_SIZE, 1)
+        page = min(page, page_count - 1)
+
+        changes = compute_changes_for_dataset(
+            task.active_dataset, dataset,
+            offset=page * self.PAGE_SIZE, limit=self.PAGE_SIZE)
 
         # By default, we will notify users who's public scores have changed, or
         # their non-public scores have changed but they have used a token.
-        for c in changes:
-            score_changed = c.old_score is not None or c.new_score is not None
-            public_score_changed = c.old_public_score is not None or \
-                c.new_public_score is not None
-            if public_score_changed or \
-                    (c.submission.tokened() and score_changed):
-                notify_users.add(c.submission.user.id)
+        notify_users = users_with_changes_for_dataset(
+            task.active_dataset, dataset, visible_only=True)
 
         self.r_params = self.render_params()
         self.r_params["task"] = task
         self.r_params["dataset"] = dataset
+        self.r_params["summary"] = summary
+        self.r_params["page"] = page
+        self.r_params["page_count"] = page_count
         self.r_params["changes"] = changes
         self.r_params["default_notify_users"] = notify_users
         self.render("activate_dataset.html", **self.r_params)
@@ -1101,6 +1117,22 @@ class ActivateDatasetHandler(BaseHandler):
         task = dataset.task
         self.contest = task.contest
 
+        # The users to notify have to be found before the switch.
+        notify = self.get_argument("notify", "visible")
+        if notify == "selected":
+            r = re.compile('notify_([0-9]+)$')
+            user_ids = set()
+            for k in self.request.arguments:
+                m = r.match(k)
+                if m:
+                    user_ids.add(int(m.group(1)))
+        elif notify in ("visible", "all"):
+            user_ids = users_with_changes_for_dataset(
+                task.active_dataset, dataset,
+                visible_only=notify == "visible")
+        else:
+            user_ids = set()
+
         task.active_dataset = dataset
 
         if try_commit(self.sql_session, self):
@@ -1117,13 +1149,11 @@ class ActivateDatasetHandler(BaseHandler):
         # Now send notifications to contestants.
         datetime = make_datetime()
 
-        r = re.compile('notify_([0-9]+)$')
         count = 0
-        for k in self.request.arguments:
-            m = r.match(k)
-            if not m:
-                continue
-            user = self.safe_get_item(User, m.group(1))
+        users = self.sql_session.query(User)\
+            .filter(User.contest_id == task.contest_id)\
+            .filter(User.id.in_(user_ids)).all() if user_ids else []
+        for user in users:
             message = Message(datetime,
                               self.get_argument("message_subject", ""),
                               self.get_argument("message_text", ""),
@@ -1139,6 +1169,20 @@ class ActivateDatasetHandler(BaseHandler):
         self.redirect("/task/%s" % task.id)
 
 
+class ActivateDatasetSummaryHandler(BaseHandler):
+    """Return, in JSON format, the number of submissions and users
+    whose scores would change if the dataset was activated.
+
+    """
+    def get(self, dataset_id):
+        dataset = self.safe_get_item(Dataset, dataset_id)
+        task = dataset.task
+
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(
+            count_changes_for_dataset(task.active_dataset, dataset)))
+
+
 class ToggleAutojudgeDatasetHandler(BaseHandler):
     """Toggle whether a given dataset is judged automatically or not.
 
@@ -1499,10 +1543,9 @@ class TaskHandler(BaseHandler):
 
         self.r_params = self.render_params()
         self.r_params["task"] = task
-        self.r_params["submissions"] = \
+        self.r_params["submission_count"] = \
             self.sql_session.query(Submission)\
-                .join(Task).filter(Task.id == task_id)\
-                .order_by(Submission.timestamp.desc()).all()
+                .filter(Submission.task_id == task.id).count()
         self.render("task.html", **self.r_params)
 
     def post(self, task_id):
@@ -1553,6 +1596,10 @@ class TaskHandler(BaseHandler):
 
                 self.get_time_limit(attrs, "time_limit_%d" % dataset.id)
                 self.get_memory_limit(attrs, "memory_limit_%d" % dataset.id)
+                name = "evaluation_cache_max_age_%d" % dataset.id
+                self.get_timedelta_sec(attrs, name)
+                if name in attrs:
+                    attrs["evaluation_cache_max_age"] = attrs.pop(name)
                 self.get_task_type(attrs, "task_type_%d" % dataset.id,
                                    "TaskTypeOptions_%d_" % dataset.id)
                 self.get_score_type(attrs, "score_type_%d" % dataset.id,
@@ -1582,12 +1629,29 @@ class DatasetSubmissionsHandler(BaseHandler):
     """Shows all submissions for this dataset, allowing the admin to
     view the results under different datasets.
 
+    The submissions are shown a page at a time, the most recent first.
+
     """
+    # Number of submissions shown in each page.
+    PAGE_SIZE = 50
+
     def get(self, dataset_id):
         dataset = self.safe_get_item(Dataset, dataset_id)
         task = dataset.task
         self.contest = task.contest
 
+        try:
+            page = max(int(self.get_argument("page", "0")), 0)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+
+        query = self.sql_session.query(Submission)\
+            .filter(Submission.task == task)
+        submission_count = query.count()
+        page_count = max((submission_count + self.PAGE_SIZE - 1) //
+                         self.PAGE_SIZE, 1)
+        page = min(page, page_count - 1)
+
         self.r_params = self.render_params()
         self.r_params["task"] = task
         self.r_params["active_dataset"] = task.active_dataset
@@ -1596,15 +1660,18 @@ class DatasetSubmissionsHandler(BaseHandler):
             self.sql_session.query(Dataset)\
                             .filter(Dataset.task == task)\
                             .order_by(Dataset.description).all()
+        self.r_params["submission_count"] = submission_count
+        self.r_params["page"] = page
+        self.r_params["page_count"] = page_count
         self.r_params["submissions"] = \
-            self.sql_session.query(Submission)\
-                            .filter(Submission.task == task)\
-                            .options(joinedload(Submission.task))\
-                            .options(joinedload(Submission.user))\
-                            .options(joinedload(Submission.files))\
-                            .options(joinedload(Submission.token))\
-                            .options(joinedload(Submission.results))\
-                            .order_by(Submission.timestamp.desc()).all()
+            query.options(joinedload(Submission.task))\
+                 .options(joinedload(Submission.user))\
+                 .options(joinedload(Submission.files))\
+                 .options(joinedload(Submission.token))\
+                 .options(joinedload(Submission.results))\
+                 .order_by(Submission.timestamp.desc(), Submission.id.desc())\
+                 .offset(page * self.PAGE_SIZE)\
+                 .limit(self.PAGE_SIZE).all()
         self.render("submissionlist.html", **self.r_params)
 
 
@@ -1612,32 +1679,107 @@ class RankingHandler(BaseHandler):
     """Shows the ranking for a contest.
 
     """
+    # Number of users sent to the client at a time by the txt and csv
+    # formats.
+    CHUNK_SIZE = 100
+
+    def get_ranking(self):
+        """Yield the rows of the ranking of the current contest.
+
+        The scores are computed by a few aggregate queries, so that
+        memory usage is proportional to the number of users and tasks,
+        and not to the number of submissions.
+
+        yield ((User, [(float, bool)], float, bool)): a non-hidden
+            user, the score (rounded) and the partial flag on each task
+            of the contest, and the global score and partial flag.
+
+        """
+        tasks = self.contest.tasks
+        scores = contest_scores(self.sql_session, self.contest)
+        users = self.sql_session.query(User)\
+            .filter(User.contest_id == self.contest.id)\
+            .filter(User.hidden == False)\
+            .order_by(User.username)  # noqa
+        for user in users:
+            task_scores = []
+            score = 0.0
+            partial = False
+            for task in tasks:
+                t_score, t_partial = scores.get((user.id, task.id),
+                                                (0.0, False))
+                t_score = round(t_score, task.score_precision)
+                task_scores.append((t_score, t_partial))
+                score += t_score
+                partial = partial or t_partial
+            yield user, task_scores, \
+                round(score, self.contest.score_precision), partial
+
+    def write_ranking(self, header, format_row):
+        """Send the ranking to the client, a chunk at a time.
+
+        header (unicode): the first line.
+        format_row (function): takes the elements of a row of the
+            ranking (see get_ranking) and returns the line to write.
+
+        """
+        chunk = [header]
+        for row in self.get_ranking():
+            chunk.append(format_row(*row))
+            if len(chunk) >= self.CHUNK_SIZE:
+                self.write("".join(chunk))
+                self.flush()
+                chunk = []
+        self.write("".join(chunk))
+
     def get(self, contest_id, format="online"):
-        # This validates the contest id.
-        self.safe_get_item(Contest, contest_id)
-
-        # This massive joined load gets all the information which we will need
-        # to generating the rankings.
-        self.contest = self.sql_session.query(Contest)\
-            .filter(Contest.id == contest_id)\
-            .options(joinedload('users'))\
-            .options(joinedload('users.submissions'))\
-            .options(joinedload('users.submissions.token'))\
-            .options(joinedload('users.submissions.results'))\
-            .first()
+        self.contest = self.safe_get_item(Contest, contest_id)
+        tasks = self.contest.tasks
+        precision = self.contest.score_precision
+
+        def mark(partial):
+            return "*" if partial else " "
 
-        self.r_params = self.render_params()
         if format == "txt":
             self.set_header("Content-Type", "text/plain")
             self.set_header("Content-Disposition",
                             "attachment; filename=\"ranking.txt\"")
-            self.render("ranking.txt", **self.r_params)
+
+            def format_row(user, task_scores, score, partial):
+                return "%20s %30s %s%s%s\n" % (
+                    user.username,
+                    "%s %s" % (user.first_name, user.last_name),
+                    "".join(("%%13.%dlf" % task.score_precision) % t_score
+                            + mark(t_partial) + " "
+                            for task, (t_score, t_partial)
+                            in zip(tasks, task_scores)),
+                    ("%%7.%dlf" % precision) % score, mark(partial))
+
+            self.write_ranking(
+                "%20s %30s %s%8s\n" % (
+                    "Username", "User",
+                    "".join("%14s " % task.name for task in tasks),
+                    "Global"),
+                format_row)
         elif format == "csv":
             self.set_header("Content-Type", "text/csv")
             self.set_header("Content-Disposition",
                             "attachment; filename=\"ranking.csv\"")
-            self.render("ranking.csv", **self.r_params)
+
+            def format_row(user, task_scores, score, partial):
+                return "%s,%s %s,%s%s,%s\n" % (
+                    user.username, user.first_name, user.last_name,
+                    "".join("%s,%s," % (t_score, mark(t_partial))
+                            for t_score, t_partial in task_scores),
+                    score, mark(partial))
+
+            self.write_ranking(
+                "Username,User,%sGlobal,P\n" % "".join(
+                    "%s,P," % task.name for task in tasks),
+                format_row)
         else:
+            self.r_params = self.render_params()
+            self.r_params["ranking"] = self.get_ranking()
             self.render("ranking.html", **self.r_params)
 
 
@@ -2002,6 +2144,7 @@ _aws_handlers = [
     (r"/rename_dataset/([0-9]+)", RenameDatasetHandler),
     (r"/delete_dataset/([0-9]+)", DeleteDatasetHandler),
     (r"/activate_dataset/([0-9]+)", ActivateDatasetHandler),
+    (r"/activate_dataset/([0-9]+)/summary", ActivateDatasetSummaryHandler),
     (r"/autojudge_dataset/([0-9]+)", ToggleAutojudgeDatasetHandler),
     (r"/add_testcase/([0-9]+)", AddTestcaseHandler),
     (r"/add_testcases/([0-9]+)", AddTestcasesHandler),
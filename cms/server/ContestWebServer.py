@@ -65,11 +65,13 @@ from sqlalchemy import func
 from werkzeug.http import parse_accept_header
 from werkzeug.datastructures import LanguageAccept
 
-from cms import ConfigError, ServiceCoord, config, filename_to_language
+from cms import ConfigError, ServiceCoord, config, filename_to_language, \
+    get_service_shards
 from cms.io import WebService
 from cms.db import Session, Contest, User, Task, Question, Submission, Token, \
     File, UserTest, UserTestFile, UserTestManager, PrintJob
 from cms.db.filecacher import FileCacher
+from cms.service import get_evaluation_service_shard
 from cms.grading.tasktypes import get_task_type
 from cms.grading.scoretypes import get_score_type
 from cms.server import file_handler_gen, actual_phase_required, \
@@ -450,8 +452,10 @@ class ContestWebServer(WebService):
                              "*", "LC_MESSAGES", "cms.mo"))]
 
         self.file_cacher = FileCacher(self)
-        self.evaluation_service = self.connect_to(
-            ServiceCoord("EvaluationService", 0))
+        # Each shard of ES judges the submissions of some tasks.
+        self.evaluation_services = [
+            self.connect_to(ServiceCoord("EvaluationService", i))
+            for i in xrange(get_service_shards("EvaluationService"))]
         self.scoring_service = self.connect_to(
             ServiceCoord("ScoringService", 0))
 
@@ -1153,8 +1157,9 @@ class SubmitHandler(BaseHandler):
             self.sql_session.add(File(filename, digest, submission=submission))
         self.sql_session.add(submission)
         self.sql_session.commit()
-        self.application.service.evaluation_service.new_submission(
-            submission_id=submission.id)
+        self.application.service.evaluation_services[
+            get_evaluation_service_shard(submission.task_id)]\
+            .new_submission(submission_id=submission.id)
         self.application.service.add_notification(
             self.current_user.username,
             self.timestamp,
@@ -1697,8 +1702,9 @@ class UserTestHandler(BaseHandler):
 
         self.sql_session.add(user_test)
         self.sql_session.commit()
-        self.application.service.evaluation_service.new_user_test(
-            user_test_id=user_test.id)
+        self.application.service.evaluation_services[
+            get_evaluation_service_shard(user_test.task_id)]\
+            .new_user_test(user_test_id=user_test.id)
         self.application.service.add_notification(
             self.current_user.username,
             self.timestamp,
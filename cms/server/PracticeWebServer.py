@@ -20,6 +20,8 @@
 import os
 import io
 import re
+import time
+import errno
 import hmac
 import json
 import urllib
@@ -31,46 +33,183 @@ import traceback
 import pkg_resources
 
 from base64 import b64decode, b64encode
+from collections import OrderedDict, namedtuple
 from datetime import datetime, timedelta
 
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy import desc
 from sqlalchemy.sql import or_, and_
 
-from cms import config, ServiceCoord, SOURCE_EXT_TO_LANGUAGE_MAP
-from cms.io import Service
+from cms import config, ServiceCoord, SOURCE_EXT_TO_LANGUAGE_MAP, \
+    get_service_shards
+from cms.io import Service, rpc_method
 from cms.db.filecacher import FileCacher
+from cms.service import get_evaluation_service_shard
+from cms.grading import SCORE_DETAILS_VERSION, render_score_details
+from cms.server import FILE_CACHE_MAX_AGE, digest_etag, etag_matches, \
+    parse_range_header, get_file_size
 from cms.db import SessionGen, User, Submission, File, Task, Test, Tag, \
     Forum, Topic, Post, TestScore, Institute, Region, Province, City, \
     TaskScore, PrivateMessage, Talk, TaskTag
 from cmscommon.datetime import make_timestamp, make_datetime
 from cmscommon.archive import Archive
+from cmscommon.eventsource import EventSource, Publisher
 
 from werkzeug.wrappers import Response, Request
 from werkzeug.wsgi import SharedDataMiddleware, wrap_file, responder
 from werkzeug.routing import Map, Rule
 from werkzeug.exceptions import HTTPException, NotFound, BadRequest, \
-    InternalServerError
+    Forbidden, InternalServerError
 
 import gevent
+import gevent.local
 import gevent.wsgi
+from gevent.socket import wait_write
+
+try:
+    from sendfile import sendfile
+except ImportError:
+    sendfile = None
 
 logger = logging.getLogger(__name__)
-local = gevent.local.local()
+
+
+class RequestLocal(gevent.local.local):
+    '''State of the request served by the current greenlet. The User
+    object is loaded only when a handler needs more than its id and
+    access level, which are known from the token.
+
+    '''
+    def __init__(self):
+        self._user = None
+        self.user_id = None
+
+    @property
+    def user(self):
+        if self._user is None and self.user_id is not None:
+            self._user = self.session.query(User).get(self.user_id)
+        return self._user
+
+    @user.setter
+    def user(self, user):
+        self._user = user
+        self.user_id = user.id if user is not None else None
+
+
+local = RequestLocal()
+
+
+CachedUser = namedtuple('CachedUser',
+                        ['id', 'username', 'password', 'access_level'])
+
+
+class UserCache(object):
+    '''LRU cache of the recently authenticated users, to avoid a query
+    on every request. Entries also expire after a while, so that the
+    changes made by other services (e.g. AWS) are eventually seen.
+
+    '''
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        # For each user id, the time of insertion and the CachedUser,
+        # from the least to the most recently used.
+        self._entries = OrderedDict()
+
+    def get(self, user_id):
+        entry = self._entries.pop(user_id, None)
+        if entry is None or entry[0] + self.ttl < time.time():
+            return None
+        self._entries[user_id] = entry
+        return entry[1]
+
+    def put(self, user):
+        self._entries.pop(user.id, None)
+        self._entries[user.id] = (time.time(), user)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
+
+
+class FileWrapper(object):
+    '''Iterable over a byte range of a file, to be used as a WSGI
+    response body. WSGIHandler recognizes it and, when possible,
+    transmits the file with sendfile instead of iterating over it.
+
+    '''
+    def __init__(self, fobj, start, length):
+        self.fobj = fobj
+        self.start = start
+        self.remaining = length
+        self.fobj.seek(start)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.remaining <= 0:
+            raise StopIteration
+        data = self.fobj.read(min(self.remaining, FileCacher.CHUNK_SIZE))
+        if not data:
+            raise StopIteration
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        try:
+            return self.fobj.fileno()
+        except (AttributeError, EnvironmentError, io.UnsupportedOperation):
+            return None
+
+    def close(self):
+        self.fobj.close()
 
 
 class WSGIHandler(gevent.wsgi.WSGIHandler):
+    def process_result(self):
+        if sendfile is None or not isinstance(self.result, FileWrapper) \
+                or self.result.fileno() is None:
+            return gevent.wsgi.WSGIHandler.process_result(self)
+
+        # Writing an empty chunk sends the headers.
+        self.write(b'')
+        sock_fd = self.socket.fileno()
+        file_fd = self.result.fileno()
+        offset = self.result.start
+        while self.result.remaining > 0:
+            try:
+                sent = sendfile(sock_fd, file_fd, offset,
+                                self.result.remaining)
+            except (IOError, OSError) as error:
+                if error.errno == errno.EAGAIN:
+                    wait_write(sock_fd)
+                    continue
+                raise
+            if sent == 0:
+                break
+            offset += sent
+            self.result.remaining -= sent
+            self.response_length += sent
+
     def format_request(self):
         if self.time_finish:
             delta = '%.6f' % (self.time_finish - self.time_start)
         else:
             delta = '-'
         client_address = self.environ['REMOTE_ADDR']
+        requestline = getattr(self, 'requestline', '')
+        # Don't log the credentials older clients put in the query
+        # string of the event stream.
+        if (getattr(self, 'path', None) or '').split('?')[0] \
+                .endswith('/events'):
+            requestline = re.sub(r'\?\S*', '', requestline)
         return '%s %s %s %s' % (
             client_address or '-',
             (getattr(self, 'status', None) or '000').split()[0],
             delta,
-            getattr(self, 'requestline', ''))
+            requestline)
 
     def log_request(self):
         logger.info(self.format_request())
@@ -91,7 +230,83 @@ class Server(gevent.wsgi.WSGIServer):
     handler_class = WSGIHandler
 
 
+class SubmissionEventSource(EventSource):
+    '''Push to each user the changes in the status of their own
+    submissions, so that the frontend does not have to poll them.
+
+    Clients authenticate with the events_username and events_token
+    cookies (not in the URL, which ends up in logs and histories),
+    checked by the given function (see APIHandler.authenticate).
+
+    '''
+    def __init__(self, authenticate):
+        EventSource.__init__(self)
+        self._authenticate = authenticate
+        self._user_pubs = dict()
+
+    def get_publisher(self, request):
+        username = request.cookies.get('events_username')
+        token = request.cookies.get('events_token')
+        if username is None or token is None:
+            raise Forbidden()
+        # They are URI-encoded by the client.
+        username = urllib.unquote(username)
+        token = urllib.unquote(token)
+        with SessionGen() as session:
+            user = self._authenticate(username, token, session)
+        if user is None:
+            raise Forbidden()
+        user_id = user.id
+        if user_id not in self._user_pubs:
+            self._user_pubs[user_id] = Publisher(self._CACHE_SIZE)
+        return self._user_pubs[user_id]
+
+    def is_listening(self, user_id):
+        '''Return whether a user has an open event stream.
+
+        '''
+        pub = self._user_pubs.get(user_id)
+        return pub is not None and pub.has_subscribers()
+
+    def send_to_user(self, user_id, event, data):
+        '''Send an event to the streams of a user, if any.
+
+        '''
+        if user_id in self._user_pubs:
+            self._user_pubs[user_id].put(event, data)
+
+    def cleanup(self):
+        '''Forget the users that are not listening anymore. Clients
+        reconnecting afterwards will be asked to reinit.
+
+        '''
+        for user_id in self._user_pubs.keys():
+            if not self._user_pubs[user_id].has_subscribers():
+                del self._user_pubs[user_id]
+
+    def get_stats(self):
+        '''Return the metrics of the streams of all users, summed, with
+        the number of users having a publisher.
+
+        '''
+        stats = dict()
+        for pub in self._user_pubs.itervalues():
+            for key, value in pub.get_stats().iteritems():
+                stats[key] = stats.get(key, 0) + value
+        stats['users'] = len(self._user_pubs)
+        return stats
+
+
 class APIHandler(object):
+    # Number of users kept in the authentication cache, and for how
+    # long (in seconds) they are trusted without asking the database.
+    USER_CACHE_SIZE = 10000
+    USER_CACHE_TTL = 300
+
+    # Tokens are renewed when they have less than this fraction of
+    # their duration left.
+    TOKEN_RENEWAL = 0.5
+
     def __init__(self, parent):
         self.router = Map([
             Rule('/', methods=['GET', 'POST'], endpoint='root'),
@@ -99,10 +314,14 @@ class APIHandler(object):
                  endpoint='dbfile'),
             Rule('/files/<digest>/<name>', methods=['GET', 'POST'],
                  endpoint='dbfile'),
+            Rule('/events', methods=['GET'], endpoint='events'),
             Rule('/<target>', methods=['POST'], endpoint='jsondata')
         ], encoding_errors='strict')
         self.file_cacher = parent.file_cacher
-        self.evaluation_service = parent.evaluation_service
+        self.evaluation_services = parent.evaluation_services
+        self.user_cache = UserCache(APIHandler.USER_CACHE_SIZE,
+                                    APIHandler.USER_CACHE_TTL)
+        self.event_source = SubmissionEventSource(self.authenticate)
         self.EMAIL_REG = re.compile(r'[^@]+@[^@]+\.[^@]+')
         self.USERNAME_REG = re.compile(r'^[A-Za-z0-9_\.]+$')
 
@@ -126,6 +345,8 @@ class APIHandler(object):
                 return self.file_handler(environ, 'index.html')
             elif endpoint == 'dbfile':
                 return self.dbfile_handler(environ, args)
+            elif endpoint == 'events':
+                return self.event_source
         except HTTPException as e:
             return e
 
@@ -146,16 +367,16 @@ class APIHandler(object):
                     return BadRequest()
 
         with SessionGen() as local.session:
-            try:
-                username = data['username']
-                token = data['token']
-                local.user = self.get_user(username, token)
-            except (BadRequest, KeyError):
-                local.user = None
-            if local.user is None:
-                local.access_level = 7  # Access level of unlogged user
-            else:
-                local.access_level = local.user.access_level
+            local.user = None
+            local.token = None
+            local.access_level = 7  # Access level of unlogged user
+            if 'username' in data and 'token' in data:
+                user = self.authenticate(data['username'], data['token'],
+                                         local.session)
+                if user is not None:
+                    local.user_id = user.id
+                    local.token = data['token']
+                    local.access_level = user.access_level
 
             try:
                 local.data = data
@@ -193,6 +414,82 @@ class APIHandler(object):
         except UnicodeDecodeError:
             return None
 
+    def sign_token(self, payload, password):
+        return hmac.new(config.secret_key.encode('utf-8'),
+                        ('%s:%s' % (payload, password)).encode('utf-8'),
+                        hashlib.sha256).hexdigest()
+
+    def make_token(self, user):
+        '''Return a new session token for the user, valid for
+        config.token_duration seconds or until the password changes.
+
+        '''
+        payload = '%d:%d' % (user.id, int(time.time()) +
+                             config.token_duration)
+        return '%s:%s' % (payload, self.sign_token(payload, user.password))
+
+    def parse_token(self, token):
+        '''Return the user id and the expiration time of a token, or
+        None if it is not a session token.
+
+        '''
+        try:
+            user_id, expiry, signature = token.split(':')
+            return int(user_id), int(expiry)
+        except (AttributeError, ValueError):
+            return None
+
+    def authenticate(self, username, token, session):
+        '''Return the CachedUser owning a session token, or None if
+        the token is invalid or expired. The database is queried only
+        if the user is not in the cache.
+
+        Tokens from before session tokens existed (i.e., the hash of
+        the password) are still accepted, but always need a query.
+
+        '''
+        parsed = self.parse_token(token)
+        if parsed is None:
+            try:
+                user = session.query(User)\
+                    .filter(User.username == username)\
+                    .filter(User.password == token).first()
+            except UnicodeDecodeError:
+                return None
+            if user is None:
+                return None
+            return CachedUser(user.id, user.username, user.password,
+                              user.access_level)
+
+        user_id, expiry = parsed
+        if expiry < time.time():
+            return None
+        user = self.user_cache.get(user_id)
+        if user is None:
+            db_user = session.query(User).get(user_id)
+            if db_user is None:
+                return None
+            user = CachedUser(db_user.id, db_user.username,
+                              db_user.password, db_user.access_level)
+            self.user_cache.put(user)
+        if user.username != username:
+            return None
+        signature = self.sign_token(token.rsplit(':', 1)[0], user.password)
+        if not hmac.compare_digest(signature.encode('utf-8'),
+                                   token.rsplit(':', 1)[1].encode('utf-8')):
+            return None
+        return user
+
+    def renew_token(self):
+        '''Put a new token in the response if the one of the request
+        is old or about to expire.
+
+        '''
+        parsed = self.parse_token(local.token)
+        if parsed is None or parsed[1] - time.time() < \
+                config.token_duration * APIHandler.TOKEN_RENEWAL:
+            local.resp['token'] = self.make_token(local.user)
+
     def check_user(self, username):
         if len(username) < 4:
             return 'Username is too short'
@@ -247,6 +544,27 @@ class APIHandler(object):
         info['tasks_solved'] = -1
         return info
 
+    def get_submission_info(self, s):
+        info = dict()
+        info['id'] = s.id
+        info['task_id'] = s.task_id
+        info['timestamp'] = make_timestamp(s.timestamp)
+        info['files'] = []
+        for name, f in s.files.iteritems():
+            fi = dict()
+            if s.language is None:
+                fi['name'] = name
+            else:
+                fi['name'] = name.replace('%l', s.language)
+            fi['digest'] = f.digest
+            info['files'].append(fi)
+        result = s.get_result()
+        for i in ['compilation_outcome', 'evaluation_outcome']:
+            info[i] = getattr(result, i, None)
+        if result is not None and result.score is not None:
+            info['score'] = round(result.score, 2)
+        return info
+
     # Handlers that do not require JSON data
     def file_handler(self, environ, filename):
         path = os.path.join(
@@ -267,14 +585,41 @@ class APIHandler(object):
         return response
 
     def dbfile_handler(self, environ, args):
+        # Files are addressed by digest, so they never change.
+        etag = digest_etag(args['digest'])
+        response = Response()
+        response.headers[b'ETag'] = etag
+        response.headers[b'Cache-Control'] = \
+            b'public, max-age=%d, immutable' % FILE_CACHE_MAX_AGE
+        if etag_matches(environ.get('HTTP_IF_NONE_MATCH'), etag):
+            response.status_code = 304
+            return response
+
         try:
             fobj = self.file_cacher.get_file(args['digest'])
         except KeyError:
             raise NotFound()
 
-        response = Response()
-        response.status_code = 200
+        size = get_file_size(fobj)
+        try:
+            byte_range = parse_range_header(environ.get('HTTP_RANGE'), size)
+        except ValueError:
+            fobj.close()
+            response.status_code = 416
+            response.headers[b'Content-Range'] = b'bytes */%d' % size
+            return response
+
         response.mimetype = 'application/octet-stream'
+        response.headers[b'Accept-Ranges'] = b'bytes'
+        if byte_range is None:
+            start, stop = 0, size
+            response.status_code = 200
+        else:
+            start, stop = byte_range
+            response.status_code = 206
+            response.headers[b'Content-Range'] = \
+                b'bytes %d-%d/%d' % (start, stop - 1, size)
+        response.headers[b'Content-Length'] = str(stop - start)
 
         if 'name' in args:
             if not args["name"].endswith(".pdf"):
@@ -286,7 +631,7 @@ class APIHandler(object):
             if mimetype is not None:
                 response.mimetype = mimetype
 
-        response.response = wrap_file(environ, fobj)
+        response.response = FileWrapper(fobj, start, stop - start)
         response.direct_passthrough = True
         return response
 
@@ -336,7 +681,7 @@ class APIHandler(object):
                                         for r in out]
 
     def sso_handler(self):
-        if local.user is None:
+        if local.user_id is None:
             return 'Unauthorized'
         payload = local.data['payload']
         sig = local.data['sig']
@@ -418,7 +763,7 @@ class APIHandler(object):
             if user is None:
                 return 'login.error'
             else:
-                local.resp['token'] = token
+                local.resp['token'] = self.make_token(user)
                 local.resp['user'] = self.get_user_info(user)
         elif local.data['action'] == 'get':
             user = local.session.query(User)\
@@ -445,7 +790,7 @@ class APIHandler(object):
             users, local.resp['num'] = self.sliced_query(query)
             local.resp['users'] = map(self.get_user_info, users)
         elif local.data['action'] == 'update':
-            if local.user is None:
+            if local.user_id is None:
                 return 'Unauthorized'
             if 'institute' in local.data and \
                local.data['institute'] is not None:
@@ -466,17 +811,19 @@ class APIHandler(object):
                     return 'Password\'s too short'
                 new_token = self.hashpw(local.data['password'])
                 local.user.password = new_token
-                local.resp['token'] = new_token
+                self.user_cache.invalidate(local.user_id)
+                local.resp['token'] = self.make_token(local.user)
             local.session.commit()
         else:
             return 'Bad request'
 
     def heartbeat_handler(self):
-        if local.user is None:
+        if local.user_id is None:
             return 'Unauthorized'
         local.resp['unreadtalks'] = local.session.query(Talk)\
-            .filter(Talk.receiver_id == local.user.id)\
+            .filter(Talk.receiver_id == local.user_id)\
             .filter(Talk.read == False).count()
+        self.renew_token()
 
     def task_handler(self):
         if local.data['action'] == 'list':
@@ -507,10 +854,10 @@ class APIHandler(object):
                 task['name'] = t.name
                 task['title'] = t.title
 
-                if local.user is not None:
+                if local.user_id is not None:
                     taskscore = local.session.query(TaskScore)\
                         .filter(TaskScore.task_id == t.id)\
-                        .filter(TaskScore.user_id == local.user.id).first()
+                        .filter(TaskScore.user_id == local.user_id).first()
 
                     if taskscore is not None:
                         task['score'] = taskscore.score
@@ -649,10 +996,10 @@ class APIHandler(object):
                     'description': t.description,
                     'max_score': t.max_score
                 }
-                if local.user is not None:
+                if local.user_id is not None:
                     testscore = local.session.query(TestScore)\
                         .filter(TestScore.test_id == t.id)\
-                        .filter(TestScore.user_id == local.user.id).first()
+                        .filter(TestScore.user_id == local.user_id).first()
                     if testscore is not None:
                         test['score'] = testscore.score
                 local.resp['tests'].append(test)
@@ -720,12 +1067,12 @@ class APIHandler(object):
                                 local.resp[i] = [q.wrong_score, 'wrong']
                     if local.resp.get(i, None) is None:
                         local.resp[i] = [q.score, 'correct']
-            if local.user is not None:
+            if local.user_id is not None:
                 score = sum([local.resp[i][0] for i in
                              xrange(len(test.questions))])
                 testscore = local.session.query(TestScore)\
                     .filter(TestScore.test_id == test.id)\
-                    .filter(TestScore.user_id == local.user.id).first()
+                    .filter(TestScore.user_id == local.user_id).first()
                 if testscore is None:
                     testscore = TestScore(score=score)
                     testscore.user = local.user
@@ -744,40 +1091,20 @@ class APIHandler(object):
                 .filter(Task.name == local.data['task_name']).first()
             if task is None:
                 return 'Not found'
-            if local.user is None:
+            if local.user_id is None:
                 return 'Unauthorized'
             subs = local.session.query(Submission)\
-                .filter(Submission.user_id == local.user.id)\
+                .filter(Submission.user_id == local.user_id)\
                 .filter(Submission.task_id == task.id)\
                 .order_by(desc(Submission.timestamp)).all()
-            submissions = []
-            for s in subs:
-                submission = dict()
-                submission['id'] = s.id
-                submission['task_id'] = s.task_id
-                submission['timestamp'] = make_timestamp(s.timestamp)
-                submission['files'] = []
-                for name, f in s.files.iteritems():
-                    fi = dict()
-                    if s.language is None:
-                        fi['name'] = name
-                    else:
-                        fi['name'] = name.replace('%l', s.language)
-                    fi['digest'] = f.digest
-                    submission['files'].append(fi)
-                result = s.get_result()
-                for i in ['compilation_outcome', 'evaluation_outcome']:
-                    submission[i] = getattr(result, i, None)
-                if result is not None and result.score is not None:
-                    submission['score'] = round(result.score, 2)
-                submissions.append(submission)
-            local.resp['submissions'] = submissions
+            local.resp['submissions'] = [self.get_submission_info(s)
+                                         for s in subs]
         elif local.data['action'] == 'details':
             s = local.session.query(Submission)\
                 .filter(Submission.id == local.data['id']).first()
             if s is None:
                 return 'Not found'
-            if local.user is None or s.user_id != local.user.id:
+            if local.user_id is None or s.user_id != local.user_id:
                 return 'Unauthorized'
             submission = dict()
             submission['id'] = s.id
@@ -801,27 +1128,23 @@ class APIHandler(object):
             if result is not None and result.score is not None:
                 submission['score'] = round(result.score, 2)
             if result is not None and result.score_details is not None:
-                tmp = json.loads(result.score_details)
-                if len(tmp) > 0 and 'text' in tmp[0]:
-                    subt = dict()
-                    subt['testcases'] = tmp
-                    subt['score'] = submission['score']
-                    subt['max_score'] = 100
-                    submission['score_details'] = [subt]
+                # Use the rendering stored by ScoringService, unless it
+                # is missing or outdated.
+                if result.rendered_score_details_version == \
+                        SCORE_DETAILS_VERSION:
+                    details = result.rendered_score_details
                 else:
-                    submission['score_details'] = tmp
-                for subtask in submission['score_details']:
-                    for testcase in subtask['testcases']:
-                        data = json.loads(testcase['text'])
-                        testcase['text'] = data[0] % tuple(data[1:])
+                    details = render_score_details(result.score,
+                                                   result.score_details)
+                submission['score_details'] = json.loads(details)
             else:
                 submission['score_details'] = None
             local.resp = submission
         elif local.data['action'] == 'new':
-            if local.user is None:
+            if local.user_id is None:
                 return 'Unauthorized'
             lastsub = local.session.query(Submission)\
-                .filter(Submission.user_id == local.user.id)\
+                .filter(Submission.user_id == local.user_id)\
                 .order_by(desc(Submission.timestamp)).first()
             if lastsub is not None and \
                make_datetime() - lastsub.timestamp < timedelta(seconds=20):
@@ -914,8 +1237,9 @@ class APIHandler(object):
             local.session.add(submission)
             local.session.commit()
 
-            # Notify ES
-            self.evaluation_service.new_submission(
+            # Notify the ES judging the task
+            self.evaluation_services[get_evaluation_service_shard(
+                submission.task_id)].new_submission(
                 submission_id=submission.id
             )
 
@@ -1018,7 +1342,7 @@ class APIHandler(object):
                 local.resp['topics'].append(topic)
         elif local.data['action'] == 'new':
             return "Not anymore"
-            if local.user is None:
+            if local.user_id is None:
                 return 'Unauthorized'
             forum = local.session.query(Forum)\
                 .filter(Forum.access_level >= local.access_level)\
@@ -1081,7 +1405,7 @@ class APIHandler(object):
                 local.resp['posts'].append(post)
         elif local.data['action'] == 'new':
             return "Not anymore"
-            if local.user is None:
+            if local.user_id is None:
                 return 'Unauthorized'
             topic = local.session.query(Topic)\
                 .filter(Topic.id == local.data['topic']).first()
@@ -1104,7 +1428,7 @@ class APIHandler(object):
             local.session.commit()
         elif local.data['action'] == 'delete':
             return "Not anymore"
-            if local.user is None:
+            if local.user_id is None:
                 return 'Unauthorized'
             post = local.session.query(Post)\
                 .filter(Post.id == local.data['id']).first()
@@ -1127,7 +1451,7 @@ class APIHandler(object):
             local.session.commit()
         elif local.data['action'] == 'edit':
             return "Not anymore"
-            if local.user is None:
+            if local.user_id is None:
                 return 'Unauthorized'
             post = local.session.query(Post)\
                 .filter(Post.id == local.data['id']).first()
@@ -1146,8 +1470,8 @@ class APIHandler(object):
         if local.data['action'] == 'list':
             query = local.session.query(Talk)\
                 .filter(or_(
-                    Talk.sender_id == local.user.id,
-                    Talk.receiver_id == local.user.id))\
+                    Talk.sender_id == local.user_id,
+                    Talk.receiver_id == local.user_id))\
                 .filter(Talk.pms.any())\
                 .order_by(desc(Talk.timestamp))
             talks, local.resp['num'] = self.sliced_query(query)
@@ -1167,18 +1491,18 @@ class APIHandler(object):
                     talk['last_pm_text'] = txt
                 local.resp['talks'].append(talk)
         elif local.data['action'] == 'get':
-            if local.user is None:
+            if local.user_id is None:
                 return 'Unauthorized'
             other = local.session.query(User)\
                 .filter(User.username == local.data['other']).first()
             talk = local.session.query(Talk)\
                 .filter(or_(
                     and_(
-                        Talk.sender_id == local.user.id,
+                        Talk.sender_id == local.user_id,
                         Talk.receiver_id == other.id),
                     and_(
                         Talk.sender_id == other.id,
-                        Talk.receiver_id == local.user.id))).first()
+                        Talk.receiver_id == local.user_id))).first()
             if talk is None:
                 talk = Talk(timestamp=make_datetime())
                 talk.sender = local.user
@@ -1216,7 +1540,7 @@ class APIHandler(object):
                 local.resp['pms'].append(pm)
         elif local.data['action'] == 'new':
             return "Not anymore"
-            if local.user is None:
+            if local.user_id is None:
                 return 'Unauthorized'
             talk = local.session.query(Talk)\
                 .filter(Talk.id == local.data['id']).first()
@@ -1226,7 +1550,7 @@ class APIHandler(object):
                 return 'You must enter some text'
             pm = PrivateMessage(text=local.data['text'],
                                 timestamp=make_datetime())
-            pm.sender_id = local.user.id
+            pm.sender_id = local.user_id
             pm.talk = talk
             if talk.sender_id != pm.sender_id:
                 talk.sender, talk.receiver = talk.receiver, talk.sender
@@ -1242,18 +1566,28 @@ class PracticeWebServer(Service):
     '''Service that runs the web server for practice.
 
     '''
+    # How often (in seconds) we drop the event streams of the users
+    # that disconnected.
+    EVENT_SOURCE_CLEANUP_INTERVAL = 60.0
+
     def __init__(self, shard):
         Service.__init__(self, shard=shard)
 
         self.address = config.contest_listen_address[shard]
         self.port = config.contest_listen_port[shard]
         self.file_cacher = FileCacher(self)
-        self.evaluation_service = self.connect_to(
-            ServiceCoord('EvaluationService', 0))
+        self.evaluation_services = [
+            self.connect_to(ServiceCoord('EvaluationService', i))
+            for i in xrange(get_service_shards('EvaluationService'))]
 
-        handler = APIHandler(self)
+        self.handler = APIHandler(self)
 
-        self.wsgi_app = SharedDataMiddleware(handler, {
+        self.event_source = self.handler.event_source
+        self.add_timeout(self.event_source.cleanup, None,
+                         PracticeWebServer.EVENT_SOURCE_CLEANUP_INTERVAL,
+                         immediately=False)
+
+        self.wsgi_app = SharedDataMiddleware(self.handler, {
             '/':          ('cms.web', 'practice'),
             '/assets':    ('cms.web', 'assets'),
             '/resources': '/home/ioi/resources'
@@ -1263,3 +1597,35 @@ class PracticeWebServer(Service):
         server = Server((self.address, self.port), self.wsgi_app)
         gevent.spawn(server.serve_forever)
         Service.run(self)
+
+    @rpc_method
+    def submission_updated(self, submission_id, user_id):
+        '''Push the new status of a submission to its owner.
+
+        As scoring can raise the access level of the user, we also
+        drop them from the authentication cache.
+
+        submission_id (int): the id of the submission that changed.
+        user_id (int): the id of its user.
+
+        '''
+        self.handler.user_cache.invalidate(user_id)
+        if not self.event_source.is_listening(user_id):
+            return
+        with SessionGen() as session:
+            submission = Submission.get_from_id(submission_id, session)
+            if submission is None:
+                logger.warning('Submission %d not found.', submission_id)
+                return
+            data = json.dumps(self.handler.get_submission_info(submission))
+        self.event_source.send_to_user(user_id, u'submission',
+                                       data.decode('utf-8'))
+
+    @rpc_method
+    def event_stats(self):
+        '''Return the metrics of the submission event streams.
+
+        return (dict): see SubmissionEventSource.get_stats.
+
+        '''
+        return self.event_source.get_stats()
@@ -28,6 +28,8 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import io
+import os
 import time
 import logging
 from datetime import datetime, timedelta
@@ -37,8 +39,6 @@ from functools import wraps
 from tornado.web import RequestHandler
 import tornado.locale
 
-import gevent
-
 from cms.db.filecacher import FileCacher
 from cmscommon.datetime import make_datetime, utc
 
@@ -554,6 +554,106 @@ def encode_for_url(url_fragment):
     return quote(url_fragment.encode('utf-8'), safe='')
 
 
+# Files stored in the FileCacher are addressed by their digest and
+# never change, so clients are allowed to keep them for a year.
+FILE_CACHE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def digest_etag(digest):
+    """Return the (strong) HTTP entity tag of a file with this digest.
+
+    digest (unicode): the digest of the file.
+
+    return (unicode): the quoted entity tag.
+
+    """
+    return "\"%s\"" % digest
+
+
+def etag_matches(if_none_match, etag):
+    """Tell whether an If-None-Match header matches the given tag.
+
+    if_none_match (unicode|None): the value of the header, if given.
+    etag (unicode): the (quoted) entity tag of the resource.
+
+    return (bool): True if the client already has the resource.
+
+    """
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        # Weak comparison is what RFC 7232 prescribes for GETs.
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def parse_range_header(value, size):
+    """Parse the Range header of a request for a resource.
+
+    Only a single range of bytes is supported: anything else (i.e.
+    multiple ranges, other units or a malformed header) is ignored
+    and the whole resource should be served, as RFC 7233 allows.
+
+    value (unicode|None): the value of the header, if given.
+    size (int): the size in bytes of the resource.
+
+    return ((int, int)|None): the first byte to send and the one
+        following the last, or None if the whole resource has to be
+        sent.
+
+    raise (ValueError): if the range is valid but not satisfiable.
+
+    """
+    if value is None:
+        return None
+    unit, _, spec = value.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, sep, last = (v.strip() for v in spec.partition("-"))
+    if sep != "-" or (first == "" and last == "") \
+            or not (first == "" or first.isdigit()) \
+            or not (last == "" or last.isdigit()):
+        return None
+
+    if first == "":
+        # Suffix range: the last bytes of the resource.
+        if int(last) == 0 or size == 0:
+            raise ValueError("Range not satisfiable.")
+        return max(size - int(last), 0), size
+
+    start = int(first)
+    if last != "" and int(last) < start:
+        return None
+    if start >= size:
+        raise ValueError("Range not satisfiable.")
+    stop = size if last == "" else min(int(last) + 1, size)
+    return start, stop
+
+
+def get_file_size(fobj):
+    """Return the size of an open binary file-like object.
+
+    fobj (fileobj): a seekable file-like object.
+
+    return (int): its size in bytes.
+
+    """
+    try:
+        return os.fstat(fobj.fileno()).st_size
+    except (AttributeError, EnvironmentError, io.UnsupportedOperation):
+        position = fobj.tell()
+        fobj.seek(0, io.SEEK_END)
+        size = fobj.tell()
+        fobj.seek(position)
+        return size
+
+
 def file_handler_gen(BaseClass):
     """This generates an extension of the BaseHandler that allows us
     to send files to the user. This *Gen is needed because the code in
@@ -570,53 +670,77 @@ def file_handler_gen(BaseClass):
 
         """
         def fetch(self, digest, content_type, filename):
-            """Sends the RPC to the FS.
+            """Send the file with the given digest to the user.
+
+            Since files are immutable the digest is used as a strong
+            entity tag, conditional requests are answered with a 304
+            and (single) byte ranges are supported.
 
             """
             if digest == "":
                 logger.error("No digest given")
                 self.finish()
                 return
+
+            etag = digest_etag(digest)
+            self.set_header("ETag", etag)
+            self.set_header("Cache-Control",
+                            "private, max-age=%d, immutable" %
+                            FILE_CACHE_MAX_AGE)
+            if etag_matches(self.request.headers.get("If-None-Match"),
+                            etag):
+                self.set_status(304)
+                self.finish()
+                return
+
             try:
-                self.temp_file = \
-                    self.application.service.file_cacher.get_file(digest)
+                fobj = self.application.service.file_cacher.get_file(digest)
             except Exception as error:
                 logger.error("Exception while retrieving file `%s'. %r",
                              filename, error)
                 self.finish()
                 return
 
-            self.set_header("Content-Type", content_type)
-            self.set_header("Content-Disposition",
-                            "attachment; filename=\"%s\"" % filename)
-            self.start_time = time.time()
-            self.size = 0
-
-            # TODO - Here I'm changing things as few as possible when
-            # switching from the asynchronous to the greenlet-based
-            # framework; at some point this should be rewritten in a
-            # somewhat more greenlet-idomatic way...
-            ret = True
-            while ret:
-                ret = self._fetch_write_chunk()
-                gevent.sleep(0)
-
-        def _fetch_write_chunk(self):
-            """Send a chunk of the file to the browser.
-
-            """
-            data = self.temp_file.read(FileCacher.CHUNK_SIZE)
-            length = len(data)
-            self.size += length / 1024.0 / 1024.0
-            self.write(data)
-            if length < FileCacher.CHUNK_SIZE:
-                self.temp_file.close()
-                duration = time.time() - self.start_time
-                logger.info("%.3lf seconds for %.3lf MB",
-                            duration, self.size)
-                self.finish()
-                return False
-            return True
+            start_time = time.time()
+            with fobj:
+                size = get_file_size(fobj)
+                try:
+                    byte_range = parse_range_header(
+                        self.request.headers.get("Range"), size)
+                except ValueError:
+                    self.set_status(416)
+                    self.set_header("Content-Range", "bytes */%d" % size)
+                    self.finish()
+                    return
+
+                self.set_header("Content-Type", content_type)
+                self.set_header("Content-Disposition",
+                                "attachment; filename=\"%s\"" % filename)
+                self.set_header("Accept-Ranges", "bytes")
+                if byte_range is None:
+                    start, stop = 0, size
+                else:
+                    start, stop = byte_range
+                    self.set_status(206)
+                    self.set_header("Content-Range", "bytes %d-%d/%d" %
+                                    (start, stop - 1, size))
+                self.set_header("Content-Length", stop - start)
+
+                # Tornado's WSGI adapter buffers the whole body anyway,
+                # so there is no point in yielding between chunks.
+                fobj.seek(start)
+                remaining = stop - start
+                while remaining > 0:
+                    data = fobj.read(min(remaining, FileCacher.CHUNK_SIZE))
+                    if not data:
+                        break
+                    remaining -= len(data)
+                    self.write(data)
+
+            logger.info("%.3lf seconds for %.3lf MB",
+                        time.time() - start_time,
+                        (stop - start) / 1024.0 / 1024.0)
+            self.finish()
 
     return FileHandler
 
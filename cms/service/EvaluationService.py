@@ -34,24 +34,34 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import copy
+import heapq
+import io
+import json
 import logging
+import os
 import random
+import socket
+import tempfile
+from collections import OrderedDict, defaultdict
 from datetime import timedelta
 from functools import wraps
 
+import gevent
 import gevent.coros
 from gevent.event import Event
-from sqlalchemy import func, not_
+from sqlalchemy import func, not_, tuple_
+from sqlalchemy.orm import joinedload
 
-from cms import ServiceCoord, get_service_shards
+from cms import ServiceCoord, config, get_service_shards
 from cms.io import Executor, PriorityQueue, QueueItem, TriggeredService, \
     rpc_method
-from cms.db import Session, SessionGen, Contest, Dataset, Submission, \
-    SubmissionResult, Task, UserTest, UserTestResult
-from cms.service import get_submissions, get_submission_results, \
-    get_datasets_to_judge
+from cms.db import Session, SessionGen, Dataset, Evaluation, \
+    Submission, SubmissionResult, Task, Testcase, UserTest, UserTestResult
+from cms.service import get_submission_ids, get_datasets_to_judge, \
+    get_evaluation_service_shard, get_worker_evaluation_service_shard
 from cmscommon.datetime import make_datetime, make_timestamp
-from cms.grading.Job import JobGroup
+from cms.grading.Job import EvaluationJob, JobGroup
 
 
 logger = logging.getLogger(__name__)
@@ -134,12 +144,15 @@ def user_test_to_evaluate(user_test_result):
         r.evaluation_tries < EvaluationService.MAX_USER_TEST_EVALUATION_TRIES
 
 
-def submission_get_operations(submission, dataset):
+def submission_get_operations(submission, dataset, testcase_costs=None):
     """Generate all operations originating from a submission for a given
     dataset.
 
     submission (Submission): a submission;
     dataset (Dataset): a dataset.
+    testcase_costs ({unicode: float}|None): the estimated durations
+        of the evaluations on each testcase; if given, the evaluations
+        are generated longest first.
 
     yield (ESOperation, int, datetime): an iterator providing triplets
         consisting of a ESOperation for a certain operation to
@@ -165,7 +178,15 @@ def submission_get_operations(submission, dataset):
             else PriorityQueue.PRIORITY_LOW
         if not dataset.active:
             priority = PriorityQueue.PRIORITY_EXTRA_LOW
-        for testcase_codename in sorted(dataset.testcases.iterkeys()):
+        testcase_codenames = sorted(dataset.testcases.iterkeys())
+        if testcase_costs is not None:
+            # The evaluations have the same priority and timestamp, so
+            # they are extracted in this order: starting from the
+            # longest ones keeps the last to end, and thus the whole
+            # submission, from waiting for a long one started late.
+            testcase_codenames.sort(
+                key=lambda codename: -testcase_costs.get(codename, 0.0))
+        for testcase_codename in testcase_codenames:
             yield ESOperation(ESOperation.EVALUATION,
                               submission.id,
                               dataset.id,
@@ -346,6 +367,102 @@ class ESOperation(QueueItem):
         return result
 
 
+class CostModel(object):
+    """This class estimates how long the workers take to perform the
+    operations.
+
+    Evaluations are estimated for each testcase: the first time a
+    dataset is needed, the estimates are the average execution times
+    of the evaluations on each testcase already in the database (of
+    the reference solution as well as of the other submissions), plus
+    a fixed overhead. All estimates are then updated with the actual
+    durations of the operations, as moving averages.
+
+    """
+
+    # Seconds spent by a worker on an evaluation besides running the
+    # program (creating the sandbox, fetching the files, ...).
+    OPERATION_OVERHEAD = 0.5
+    # Estimate for the types of operations never completed yet.
+    DEFAULT_COST = 2.0
+    # Weight of a new duration in the moving averages.
+    UPDATE_WEIGHT = 0.2
+    # Maximum number of datasets whose estimates are kept in memory.
+    DATASET_CACHE_SIZE = 100
+
+    def __init__(self):
+        # The estimates for the testcases (a dictionary indexed by
+        # codename) of the datasets, indexed by dataset id, from the
+        # least to the most recently used; and for each operation type.
+        self._testcase_costs = OrderedDict()
+        self._type_costs = dict()
+
+    def get_testcase_costs(self, dataset):
+        """Return the estimated durations of the evaluations on each
+        testcase of a dataset, loading them if needed.
+
+        dataset (Dataset): the dataset.
+
+        return ({unicode: float}): the estimates in seconds, indexed
+            by testcase codename.
+
+        """
+        try:
+            costs = self._testcase_costs.pop(dataset.id)
+        except KeyError:
+            averages = dict(
+                (codename, float(average))
+                for codename, average in dataset.sa_session.query(
+                    Testcase.codename, func.avg(Evaluation.execution_time))
+                .join(Evaluation, Evaluation.testcase_id == Testcase.id)
+                .filter(Testcase.dataset_id == dataset.id)
+                .filter(Evaluation.execution_time != None)
+                .group_by(Testcase.codename).all())  # noqa
+            # Testcases never evaluated get the mean of the others.
+            default = sum(averages.itervalues()) / len(averages) \
+                if len(averages) > 0 else 0.0
+            costs = dict(
+                (codename,
+                 averages.get(codename, default) + self.OPERATION_OVERHEAD)
+                for codename in dataset.testcases.iterkeys())
+            if len(self._testcase_costs) >= self.DATASET_CACHE_SIZE:
+                self._testcase_costs.popitem(last=False)
+        self._testcase_costs[dataset.id] = costs
+        return costs
+
+    def get_cost(self, operation):
+        """Return the estimated duration of an operation.
+
+        operation (ESOperation): the operation.
+
+        return (float): the estimate in seconds.
+
+        """
+        if operation.type_ == ESOperation.EVALUATION:
+            costs = self._testcase_costs.get(operation.dataset_id)
+            if costs is not None and operation.testcase_codename in costs:
+                return costs[operation.testcase_codename]
+        return self._type_costs.get(operation.type_, self.DEFAULT_COST)
+
+    def add_duration(self, operation, duration):
+        """Update the estimates with the duration of an operation.
+
+        operation (ESOperation): the operation completed.
+        duration (float): how long it took, in seconds.
+
+        """
+        def update(estimate):
+            return estimate + self.UPDATE_WEIGHT * (duration - estimate)
+
+        self._type_costs[operation.type_] = \
+            update(self._type_costs.get(operation.type_, duration))
+        if operation.type_ == ESOperation.EVALUATION:
+            costs = self._testcase_costs.get(operation.dataset_id)
+            if costs is not None and operation.testcase_codename in costs:
+                costs[operation.testcase_codename] = \
+                    update(costs[operation.testcase_codename])
+
+
 class WorkerPool(object):
     """This class keeps the state of the workers attached to ES, and
     allow the ES to get a usable worker when it needs it.
@@ -380,6 +497,10 @@ class WorkerPool(object):
         self._schedule_disabling = {}
         self._ignore = {}
 
+        # Workers that may still be running an operation assigned by a
+        # previous ES, whose result would never arrive.
+        self._orphaned = set()
+
         # Event set when there are workers available to take jobs. It
         # is only guaranteed that if a worker is available, then this
         # event is set. In other words, the fact that this event is
@@ -428,6 +549,11 @@ class WorkerPool(object):
         """
         shard = worker_coord.shard
         logger.info("Worker %s online again.", shard)
+        if shard in self._orphaned:
+            self._orphaned.discard(shard)
+            logger.info("Asking worker %s to drop the operation assigned "
+                        "by the previous ES.", shard)
+            self._worker[shard].ignore_job()
         self._worker[shard].precache_files(contest_id=self._service.contest_id)
         # We don't requeue the operation, because a connection lost
         # does not invalidate a potential result given by the worker
@@ -539,6 +665,67 @@ class WorkerPool(object):
             logger.debug("Worker %s released.", shard)
         return ret
 
+    def get_assignments(self):
+        """Return the operations assigned to the workers whose result
+        is still expected.
+
+        return ([(int, ESOperation, (int, datetime))]): the shard of
+            the worker, its operation and the side data (priority and
+            timestamp) of the operation.
+
+        """
+        return [(shard, self._operation[shard], self._side_data[shard])
+                for shard in self._worker
+                if isinstance(self._operation[shard], QueueItem)
+                and not self._ignore[shard]]
+
+    def set_orphaned(self, shards):
+        """Declare that some workers may be running an operation
+        assigned by a previous ES, so that they are asked to drop it as
+        soon as they connect.
+
+        shards ([int]): the workers.
+
+        """
+        self._orphaned.update(shard for shard in shards
+                              if shard in self._worker)
+
+    def get_start_time(self, shard):
+        """Return when a worker started its current operation.
+
+        shard (int): the worker.
+
+        return (datetime|None): the start time, or None if the worker
+            is not busy.
+
+        """
+        return self._start_time.get(shard)
+
+    def get_free_times(self, cost_model, now):
+        """Estimate when the workers will be able to take a new
+        operation.
+
+        cost_model (CostModel): the estimates of the durations.
+        now (datetime): the current time.
+
+        return ([float]): for each worker that is (or will be)
+            available, the seconds after now when it will be free.
+
+        """
+        result = []
+        for shard in self._worker:
+            operation = self._operation[shard]
+            if operation == WorkerPool.WORKER_DISABLED \
+                    or self._schedule_disabling[shard]:
+                continue
+            if isinstance(operation, QueueItem):
+                elapsed = (now - self._start_time[shard]).total_seconds()
+                result.append(
+                    max(0.0, cost_model.get_cost(operation) - elapsed))
+            elif self._worker[shard].connected:
+                result.append(0.0)
+        return result
+
     def find_worker(self, operation, require_connection=False,
                     random_worker=False):
         """Return a worker whose assigned operation is operation.
@@ -588,6 +775,25 @@ class WorkerPool(object):
         self._ignore[shard] = True
         self._worker[shard].ignore_job()
 
+    def ignore_operations(self, predicate):
+        """Mark all the operations satisfying a condition to be
+        ignored, and try to inform their workers.
+
+        predicate (function): a function taking an ESOperation and
+            returning whether to ignore it.
+
+        return (int): the number of operations ignored.
+
+        """
+        count = 0
+        for shard, operation in self._operation.iteritems():
+            if isinstance(operation, ESOperation) and \
+                    not self._ignore[shard] and predicate(operation):
+                self._ignore[shard] = True
+                self._worker[shard].ignore_job()
+                count += 1
+        return count
+
     def get_status(self):
         """Returns a dict with info about the current status of all
         workers.
@@ -750,16 +956,30 @@ class EvaluationExecutor(Executor):
         self.pool = WorkerPool(self.evaluation_service)
 
         # QueueItem (ESOperation) we have extracted from the queue,
-        # but not yet finished to execute.
+        # but not yet finished to execute, and its QueueEntry.
         self._currently_executing = None
+        self._currently_executing_entry = None
 
         # Whether execute need to drop the currently executing
         # operation.
         self._drop_current = False
 
+        # The submission operations in the queue, indexed by the id of
+        # their submission, to find them without scanning the queue.
+        self._queued_by_submission = defaultdict(set)
+
+        # The workers are partitioned between the shards of ES.
+        workers = 0
         for i in xrange(get_service_shards("Worker")):
-            worker = ServiceCoord("Worker", i)
-            self.pool.add_worker(worker)
+            if get_worker_evaluation_service_shard(i) == \
+                    self.evaluation_service.shard:
+                worker = ServiceCoord("Worker", i)
+                self.pool.add_worker(worker)
+                workers += 1
+        if workers == 0:
+            logger.error("No workers for shard %d of EvaluationService: "
+                         "configure at least as many workers as shards.",
+                         self.evaluation_service.shard)
 
     def execute(self, entry):
         """Execute an operation in the queue.
@@ -770,17 +990,27 @@ class EvaluationExecutor(Executor):
         entry (QueueEntry): entry containing the operation to perform.
 
         """
+        self._forget(entry.item)
         self._currently_executing = entry.item
+        self._currently_executing_entry = entry
         side_data = (entry.priority, entry.timestamp)
-        res = None
-        while res is None and not self._drop_current:
-            self.pool.wait_for_workers()
-            if self._drop_current:
-                break
-            res = self.pool.acquire_worker(entry.item,
-                                           side_data=side_data)
-        self._drop_current = False
-        self._currently_executing = None
+        try:
+            if entry.item.type_ == ESOperation.COMPILATION and \
+                    self.evaluation_service.compile_from_cache(
+                        entry.item, lambda: self._drop_current):
+                return
+            res = None
+            while res is None and not self._drop_current:
+                self.pool.wait_for_workers()
+                if self._drop_current or \
+                        not self.evaluation_service.owns_queue():
+                    break
+                res = self.pool.acquire_worker(entry.item,
+                                               side_data=side_data)
+        finally:
+            self._drop_current = False
+            self._currently_executing = None
+            self._currently_executing_entry = None
 
     def dequeue(self, operation):
         """Remove an item from the queue.
@@ -800,6 +1030,103 @@ class EvaluationExecutor(Executor):
                 self._drop_current = True
             else:
                 raise
+        else:
+            self._forget(operation)
+
+    def enqueue(self, item, priority=None, timestamp=None):
+        """Add an item to the queue, indexing it by submission.
+
+        See Executor.enqueue.
+
+        """
+        ret = super(EvaluationExecutor, self).enqueue(
+            item, priority, timestamp)
+        if ret and item.type_ in (ESOperation.COMPILATION,
+                                  ESOperation.EVALUATION):
+            self._queued_by_submission[item.object_id].add(item)
+        return ret
+
+    def _forget(self, operation):
+        """Remove an operation leaving the queue from the index.
+
+        operation (ESOperation): the operation.
+
+        """
+        if operation.type_ in (ESOperation.COMPILATION,
+                               ESOperation.EVALUATION):
+            queued = self._queued_by_submission.get(operation.object_id)
+            if queued is not None:
+                queued.discard(operation)
+                if len(queued) == 0:
+                    del self._queued_by_submission[operation.object_id]
+
+    def get_submission_operations(self, submission_id):
+        """Return the operations of a submission in the queue, or
+        extracted from it but still waiting for a worker.
+
+        submission_id (int): the id of the submission.
+
+        return ([ESOperation]): the compilation and evaluation
+            operations of the submission that can be dequeued.
+
+        """
+        operations = set(self._queued_by_submission.get(submission_id, ()))
+        current = self._currently_executing
+        if current is not None and current.object_id == submission_id \
+                and current.type_ in (ESOperation.COMPILATION,
+                                      ESOperation.EVALUATION):
+            operations.add(current)
+        return list(operations)
+
+    def get_pending_operations(self):
+        """Return the operations still to be completed, in the order
+        they were started or will be.
+
+        return ([(ESOperation, int, datetime)]): the operations assigned
+            to the workers, the one waiting for a worker and those in
+            the queue, with their priorities and timestamps.
+
+        """
+        result = [(operation, side_data[0], side_data[1])
+                  for _, operation, side_data in self.pool.get_assignments()]
+        entry = self._currently_executing_entry
+        if entry is not None and not self._drop_current:
+            result.append((entry.item, entry.priority, entry.timestamp))
+        result.extend((entry.item, entry.priority, entry.timestamp)
+                      for entry in self._operation_queue.get_sorted_entries())
+        return result
+
+    def get_expected_ends(self, cost_model):
+        """Estimate when the operations in the queue will be completed.
+
+        The workers are simulated taking the operations in the order
+        they are extracted from the queue, each lasting its estimated
+        duration.
+
+        cost_model (CostModel): the estimates of the durations.
+
+        return ([(ESOperation, datetime)]): the operations waiting for
+            a worker and their expected completion times; empty if no
+            worker is available.
+
+        """
+        now = make_datetime()
+        free_times = self.pool.get_free_times(cost_model, now)
+        if len(free_times) == 0:
+            return []
+        heapq.heapify(free_times)
+
+        operations = [entry.item for entry in
+                      self._operation_queue.get_sorted_entries()]
+        if self._currently_executing is not None:
+            operations.insert(0, self._currently_executing)
+
+        result = []
+        for operation in operations:
+            end = heapq.heappop(free_times) + cost_model.get_cost(operation)
+            heapq.heappush(free_times, end)
+            result.append((operation, now + timedelta(seconds=end)))
+        return result
 
 
 def with_post_finish_lock(func):
@@ -837,17 +1164,112 @@ class EvaluationService(TriggeredService):
     # How often we check if a worker is connected.
     WORKER_CONNECTION_CHECK_TIME = timedelta(seconds=10)
 
+    # Maximum number of compilation and evaluation outcomes kept to be
+    # reused.
+    COMPILATION_CACHE_SIZE = 10000
+    EVALUATION_CACHE_SIZE = 100000
+
+    # Number of submissions invalidated and enqueued at a time when
+    # rejudging, and seconds to wait between two such chunks.
+    REJUDGE_CHUNK_SIZE = 100
+    REJUDGE_CHUNK_INTERVAL = 0.5
+    # Number of completed rejudges whose progress is still reported.
+    REJUDGE_HISTORY_SIZE = 10
+
+    # Seconds between two snapshots of the queue, and after which a
+    # snapshot not updated means that the ES saving it has stopped.
+    QUEUE_SNAPSHOT_INTERVAL = 5.0
+    QUEUE_SNAPSHOT_STALE = 30.0
+
+    # Maximum number of evaluation outcomes received from the workers
+    # kept in memory before storing them, and seconds after which
+    # they are stored anyway.
+    EVALUATION_BUFFER_SIZE = 100
+    EVALUATION_BUFFER_INTERVAL = 0.02
+
+    # Seconds to wait for the other shards when collecting their
+    # status.
+    SHARD_STATUS_TIMEOUT = 5.0
+
     def __init__(self, shard, contest_id):
         super(EvaluationService, self).__init__(shard)
 
         self.contest_id = contest_id
         self.post_finish_lock = gevent.coros.RLock()
 
+        # Who is saving the snapshot of the queue: an ES restarted on
+        # the same machine can restore it immediately, one on another
+        # machine stands by while it is kept updated. We remember when
+        # we last confirmed that we own it, and whether another ES
+        # took it over meanwhile (see owns_queue).
+        self._queue_owner = "%s/%d" % (socket.gethostname(), shard)
+        self._queue_snapshot_path = config.queue_snapshot_path
+        self._queue_confirmed = None
+        self._superseded = False
+        if self._queue_snapshot_path is not None:
+            if get_service_shards("EvaluationService") > 1:
+                self._queue_snapshot_path += ".%d" % shard
+            self._wait_for_takeover()
+
+        # Outcomes of the successful submission compilations (exported
+        # CompilationJobs) and of the evaluations (pairs of the time
+        # they were obtained and the relevant fields of EvaluationJob),
+        # indexed by their cache key, from the least to the most
+        # recently used; and the operations that must not use them.
+        self._compilation_cache = OrderedDict()
+        self._compilation_cache_hits = 0
+        self._compilation_cache_misses = 0
+        self._evaluation_cache = OrderedDict()
+        self._evaluation_cache_hits = 0
+        self._evaluation_cache_misses = 0
+        self._cache_bypass = set()
+
+        # The progress of the rejudges (see invalidate_submission),
+        # the running ones and the last completed.
+        self._rejudges = []
+
+        # The successful evaluations (EvaluationJobs) received from
+        # the workers and not yet stored, indexed by their operation,
+        # and the greenlet that will store them (see
+        # flush_evaluations).
+        self._evaluation_buffer = OrderedDict()
+        self._evaluation_flusher = None
+
+        # The estimates of the durations of the operations, used to
+        # order the evaluations of a submission and to show when the
+        # queued operations will be completed.
+        self.cost_model = CostModel()
+
         self.scoring_service = self.connect_to(
             ServiceCoord("ScoringService", 0))
 
+        # PracticeWebServers push the status of the submissions to the
+        # users, so we tell them when it changes.
+        self.practice_web_servers = [
+            self.connect_to(ServiceCoord("PracticeWebServer", i))
+            for i in xrange(get_service_shards("PracticeWebServer"))]
+
+        # The other shards: each judges the submissions and user tests
+        # of its tasks (see get_evaluation_service_shard) with its own
+        # workers (see get_worker_evaluation_service_shard); any of
+        # them receives the requests for all of them, and reports the
+        # status of all of them.
+        self.other_evaluation_services = dict(
+            (i, self.connect_to(ServiceCoord("EvaluationService", i)))
+            for i in xrange(get_service_shards("EvaluationService"))
+            if i != shard)
+
         self.add_executor(EvaluationExecutor(self))
-        self.start_sweeper(117.0)
+
+        # After restoring the queue, a sweep is only needed for the
+        # operations missed in the last seconds, so it can wait.
+        restored = False
+        if self._queue_snapshot_path is not None:
+            restored = self.restore_queue()
+            self.add_timeout(self.save_queue, None,
+                             EvaluationService.QUEUE_SNAPSHOT_INTERVAL,
+                             immediately=False)
+        self.start_sweeper(117.0, immediately=not restored)
 
         self.add_timeout(self.check_workers_timeout, None,
                          EvaluationService.WORKER_TIMEOUT_CHECK_TIME
@@ -858,6 +1280,230 @@ class EvaluationService(TriggeredService):
                          .total_seconds(),
                          immediately=False)
 
+    def _load_queue_snapshot(self):
+        """Read the snapshot of the queue.
+
+        return (dict|None): the snapshot, as saved by save_queue, or
+            None if there is no valid one.
+
+        """
+        try:
+            with io.open(self._queue_snapshot_path, "rb") as snapshot_file:
+                return json.load(snapshot_file)
+        except IOError:
+            return None
+        except ValueError:
+            logger.warning("Invalid queue snapshot %s, ignoring it.",
+                           self._queue_snapshot_path)
+            return None
+
+    def _wait_for_takeover(self):
+        """Stand by while another ES is keeping the snapshot of the
+        queue updated, then claim the snapshot.
+
+        This happens before listening, so the standby can be reached
+        only if the address of this shard in core_services moves to
+        its machine when it takes over (for example, a virtual IP
+        managed by keepalived or similar); otherwise it must run on
+        the same machine as the ES it replaces.
+
+        """
+        while True:
+            snapshot = self._load_queue_snapshot()
+            if snapshot is None or snapshot["owner"] == self._queue_owner:
+                break
+            age = make_timestamp() - snapshot["time"]
+            if age > EvaluationService.QUEUE_SNAPSHOT_STALE:
+                logger.info("Taking over from %s.", snapshot["owner"])
+                break
+            logger.info("Standing by while %s is running.", snapshot["owner"])
+            gevent.sleep(EvaluationService.QUEUE_SNAPSHOT_STALE - age)
+
+        # From now on, the ES we replace finds out that it has been
+        # superseded (see owns_queue).
+        if snapshot is not None:
+            snapshot["owner"] = self._queue_owner
+            snapshot["time"] = make_timestamp()
+            self._write_queue_snapshot(snapshot)
+        self._queue_confirmed = make_timestamp()
+
+    def owns_queue(self, force=False):
+        """Return whether this ES is still in charge of the queue,
+        that is, no standby took it over while this one was stalled
+        (for longer than QUEUE_SNAPSHOT_STALE).
+
+        The snapshot is read again only if the ownership was last
+        confirmed long enough ago that a standby could have found it
+        stale. If another ES took over, this one stops dispatching
+        operations and storing their outcomes, and exits.
+
+        force (bool): whether to read the snapshot in any case.
+
+        return (bool): True if this ES is in charge of the queue.
+
+        """
+        if self._queue_snapshot_path is None:
+            return True
+        if self._superseded:
+            return False
+        if not force and self._queue_confirmed is not None and \
+                make_timestamp() - self._queue_confirmed < \
+                EvaluationService.QUEUE_SNAPSHOT_STALE / 2:
+            return True
+        snapshot = self._load_queue_snapshot()
+        if snapshot is not None and snapshot["owner"] != self._queue_owner:
+            logger.critical("%s took over the queue, exiting.",
+                            snapshot["owner"])
+            self._superseded = True
+            self.exit()
+            return False
+        return True
+
+    def _write_queue_snapshot(self, snapshot):
+        """Replace atomically the snapshot of the queue.
+
+        snapshot (dict): the snapshot (see save_queue).
+
+        """
+        directory = os.path.dirname(os.path.abspath(
+            self._queue_snapshot_path))
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as temp_file:
+                json.dump(snapshot, temp_file)
+            os.rename(temp_path, self._queue_snapshot_path)
+        except:
+            os.remove(temp_path)
+            raise
+
+    def save_queue(self):
+        """Save a snapshot of the queue, with the operations assigned
+        to the workers, to restore them if ES is restarted.
+
+        The buffered evaluations are stored first, so that all pending
+        operations are either in the snapshot or in the database. The
+        file is replaced atomically, and only if no other ES took it
+        over.
+
+        """
+        if not self.owns_queue(force=True):
+            return
+        self.flush_evaluations()
+        executor = self.get_executor()
+        snapshot = {
+            "owner": self._queue_owner,
+            "time": make_timestamp(),
+            "workers": [shard for shard, _, _ in
+                        executor.pool.get_assignments()],
+            "operations": [
+                (operation.to_dict(), priority, make_timestamp(timestamp))
+                for operation, priority, timestamp
+                in executor.get_pending_operations()],
+            }
+        self._write_queue_snapshot(snapshot)
+        self._queue_confirmed = snapshot["time"]
+
+    def owns_task(self, task_id):
+        """Return whether this shard judges the submissions and user
+        tests of a task.
+
+        task_id (int): the id of the task.
+
+        return (bool): True if the task belongs to this shard.
+
+        """
+        return get_evaluation_service_shard(task_id) == self.shard
+
+    def _get_owned_task_ids(self, session):
+        """Return the ids of the tasks of the contest judged by this
+        shard.
+
+        session (Session): the database session to use.
+
+        return ([int]): the ids of the tasks.
+
+        """
+        return [task_id for task_id, in session.query(Task.id)
+                .filter(Task.contest_id == self.contest_id)
+                if self.owns_task(task_id)]
+
+    def _ask_shard(self, es_shard, method, **kwargs):
+        """Call an RPC method of another shard and wait for its answer.
+
+        es_shard (int): the shard to ask.
+        method (unicode): the name of the method.
+        kwargs (dict): the arguments of the method.
+
+        return (object|None): the answer, or None if the shard did not
+            give one in time.
+
+        """
+        result = getattr(self.other_evaluation_services[es_shard],
+                         method)(**kwargs)
+        try:
+            return result.get(timeout=EvaluationService.SHARD_STATUS_TIMEOUT)
+        except (Exception, gevent.Timeout) as error:
+            logger.warning("Cannot get %s from shard %d: %s.",
+                           method, es_shard, error)
+            return None
+
+    def _ask_other_shards(self, method, **kwargs):
+        """Call an RPC method of the other shards and wait for their
+        answers.
+
+        method (unicode): the name of the method.
+        kwargs (dict): the arguments of the method.
+
+        return ([object]): the answers of the shards that gave one in
+            time.
+
+        """
+        results = [getattr(service, method)(**kwargs)
+                   for service in self.other_evaluation_services.values()]
+        answers = []
+        for result in results:
+            try:
+                answers.append(result.get(
+                    timeout=EvaluationService.SHARD_STATUS_TIMEOUT))
+            except (Exception, gevent.Timeout) as error:
+                logger.warning("Cannot get %s from another shard: %s.",
+                               method, error)
+        return answers
+
+    def restore_queue(self):
+        """Enqueue the operations in the snapshot of the queue, if they
+        still need to be performed, with their priorities and
+        timestamps. The operations that were assigned to the workers
+        come first; the workers are asked to drop them, as their
+        results would never arrive.
+
+        return (bool): True if a snapshot has been restored.
+
+        """
+        snapshot = self._load_queue_snapshot()
+        if snapshot is None:
+            return False
+
+        restored = 0
+        with SessionGen() as session:
+            for item, priority, timestamp in snapshot["operations"]:
+                operation = ESOperation(item["type"], item["object_id"],
+                                        item["dataset_id"],
+                                        item["testcase_codename"])
+                try:
+                    restored += self.enqueue(
+                        operation, priority, make_datetime(timestamp),
+                        check_again=True, extra={"session": session})
+                except Exception:
+                    # The submission or dataset may have been deleted.
+                    logger.warning("Cannot restore operation `%s'.",
+                                   operation, exc_info=True)
+        self.get_executor().pool.set_orphaned(snapshot["workers"])
+
+        logger.info("Restored %d operations of %d from the queue "
+                    "snapshot.", restored, len(snapshot["operations"]))
+        return True
+
     def submission_enqueue_operations(self, submission, check_again=False):
         """Push in queue the operations required by a submission.
 
@@ -882,13 +1528,40 @@ class EvaluationService(TriggeredService):
                     "submission_result":
                     submission.get_result_or_create(dataset)
                 }
+                reused = 0
+                testcase_costs = self.cost_model.get_testcase_costs(dataset)
                 for operation, priority, timestamp in \
-                        submission_get_operations(submission, dataset):
+                        submission_get_operations(submission, dataset,
+                                                  testcase_costs):
+                    if operation.type_ == ESOperation.EVALUATION and \
+                            self.evaluate_from_cache(
+                                operation, submission, dataset,
+                                extra["submission_result"]):
+                        reused += 1
+                        continue
                     new_operations += \
                         self.enqueue(operation, priority, timestamp,
                                      check_again=check_again, extra=extra)
+                if reused > 0:
+                    self.evaluations_reused(extra["submission_result"])
         return new_operations
 
+    def evaluations_reused(self, submission_result):
+        """Store the evaluations taken from the cache, ending the
+        evaluation if they were the last ones missing.
+
+        submission_result (SubmissionResult): the submission result
+            the evaluations were added to.
+
+        """
+        if len(submission_result.evaluations) == \
+                len(submission_result.dataset.testcases):
+            submission_result.set_evaluation_outcome()
+            submission_result.evaluation_tries += 1
+            self.evaluation_ended(submission_result)
+        else:
+            submission_result.sa_session.commit()
+
     def user_test_enqueue_operations(self, user_test, check_again=False):
         """Push in queue the operations required by a user test.
 
@@ -916,14 +1589,22 @@ class EvaluationService(TriggeredService):
         """
         counter = 0
         with SessionGen() as session:
-            contest = session.query(Contest).\
-                filter_by(id=self.contest_id).first()
-
-            # Scan through submissions and user tests
-            for submission in contest.get_submissions():
+            task_ids = self._get_owned_task_ids(session)
+            if len(task_ids) == 0:
+                return counter
+
+            # Scan through submissions and user tests of our tasks.
+            submissions = session.query(Submission)\
+                .filter(Submission.task_id.in_(task_ids))\
+                .options(joinedload(Submission.token))\
+                .options(joinedload(Submission.results)).all()
+            for submission in submissions:
                 counter += self.submission_enqueue_operations(submission,
                                                               check_again=True)
-            for user_test in contest.get_user_tests():
+            user_tests = session.query(UserTest)\
+                .filter(UserTest.task_id.in_(task_ids))\
+                .options(joinedload(UserTest.results)).all()
+            for user_test in user_tests:
                 counter += self.user_test_enqueue_operations(user_test,
                                                              check_again=True)
 
@@ -999,15 +1680,23 @@ class EvaluationService(TriggeredService):
         return stats
 
     @rpc_method
-    def workers_status(self):
+    def workers_status(self, aggregate=True):
         """Returns a dictionary (indexed by shard number) whose values
         are the information about the corresponding worker. See
         WorkerPool.get_status for more details.
 
+        aggregate (bool): whether to include the workers of the other
+            shards.
+
         returns (dict): the dict with the workers information.
 
         """
-        return self.get_executor().pool.get_status()
+        status = self.get_executor().pool.get_status()
+        if aggregate:
+            for other_status in self._ask_other_shards(
+                    "workers_status", aggregate=False):
+                status.update(other_status)
+        return status
 
     def check_workers_timeout(self):
         """We ask WorkerPool for the unresponsive workers, and we put
@@ -1064,6 +1753,7 @@ class EvaluationService(TriggeredService):
                 testcase_codename))
         return any([operation in self.get_executor().pool
                     or operation in self.get_executor()
+                    or operation in self._evaluation_buffer
                     for operation in operations])
 
     def user_test_busy(self, user_test_id, dataset_id):
@@ -1152,10 +1842,16 @@ class EvaluationService(TriggeredService):
         type_, object_id, dataset_id, testcase_codename, _, \
             shard = plus
 
+        # The ES that took over performs the operation again.
+        if not self.owns_queue():
+            return
+
         # Restore operation from its fields.
         operation = ESOperation(
             type_, object_id, dataset_id, testcase_codename)
 
+        start_time = self.get_executor().pool.get_start_time(shard)
+
         # We notify the pool that the worker is available again for
         # further work (no matter how the current request turned out,
         # even if the worker encountered an error). If the pool
@@ -1190,6 +1886,28 @@ class EvaluationService(TriggeredService):
         logger.info("Operation `%s' for submission %s completed. Success: %s.",
                     operation, object_id, job_success)
 
+        # Failures are not representative of the usual durations.
+        if job_success and start_time is not None:
+            self.cost_model.add_duration(
+                operation, (make_datetime() - start_time).total_seconds())
+
+        # Evaluations are many and quick, so they are not stored one
+        # at a time but in batches (failures leave nothing to store).
+        if type_ == ESOperation.EVALUATION:
+            if job_success:
+                for codename, job in job_group.jobs.iteritems():
+                    self.cache_evaluation(job)
+                    self._evaluation_buffer[ESOperation(
+                        type_, object_id, dataset_id, codename)] = job
+                if len(self._evaluation_buffer) >= \
+                        EvaluationService.EVALUATION_BUFFER_SIZE:
+                    self.flush_evaluations()
+                elif self._evaluation_flusher is None:
+                    self._evaluation_flusher = gevent.spawn_later(
+                        EvaluationService.EVALUATION_BUFFER_INTERVAL,
+                        self.flush_evaluations)
+            return
+
         # We get the submission from DB and update it.
         with SessionGen() as session:
             if type_ == ESOperation.COMPILATION:
@@ -1217,31 +1935,10 @@ class EvaluationService(TriggeredService):
 
                 if job_success:
                     job_group.to_submission_compilation(submission_result)
+                    self.cache_compilation(job_group.jobs[""])
 
                 self.compilation_ended(submission_result)
 
-            elif type_ == ESOperation.EVALUATION:
-                submission_result = SubmissionResult.get_from_id(
-                    (object_id, dataset_id), session)
-                if submission_result is None:
-                    logger.error("[action_finished] Couldn't find "
-                                 "submission %d(%d) in the database.",
-                                 object_id, dataset_id)
-                    return
-
-                if job_success:
-                    job_group.to_submission_evaluation(submission_result)
-
-                # Submission evaluation will be ended only when
-                # evaluation for each testcase is available.
-
-                dataset = Dataset.get_from_id(dataset_id, session)
-                if len(submission_result.evaluations) == \
-                        len(dataset.testcases):
-                    submission_result.set_evaluation_outcome()
-                    submission_result.evaluation_tries += 1
-                    self.evaluation_ended(submission_result)
-
             elif type_ == ESOperation.USER_TEST_COMPILATION:
                 user_test_result = UserTestResult.get_from_id(
                     (object_id, dataset_id), session)
@@ -1280,6 +1977,258 @@ class EvaluationService(TriggeredService):
 
             session.commit()
 
+    @with_post_finish_lock
+    def flush_evaluations(self):
+        """Store the buffered evaluations in a single transaction.
+
+        If the transaction fails, they are stored one at a time, so
+        that only the ones causing the failure are discarded. Then the
+        evaluation of the submission results that now have an
+        evaluation for each testcase is ended.
+
+        """
+        self._evaluation_flusher = None
+        if len(self._evaluation_buffer) == 0:
+            return
+        buffered = self._evaluation_buffer
+        self._evaluation_buffer = OrderedDict()
+        if not self.owns_queue():
+            return
+
+        try:
+            updated = self._store_evaluations(buffered)
+        except Exception:
+            logger.warning("Cannot store %d evaluations at once, storing "
+                           "them one by one.", len(buffered), exc_info=True)
+            updated = set()
+            for operation, job in buffered.iteritems():
+                try:
+                    updated |= self._store_evaluations({operation: job})
+                except Exception:
+                    logger.error("[flush_evaluations] Cannot store the "
+                                 "outcome of operation `%s', discarding "
+                                 "it.", operation, exc_info=True)
+        if len(updated) == 0:
+            return
+
+        try:
+            self._end_evaluations(updated)
+        except Exception:
+            logger.error("[flush_evaluations] Cannot end the evaluation of "
+                         "%d submission results.", len(updated),
+                         exc_info=True)
+
+    def _store_evaluations(self, buffered):
+        """Store some evaluations in a single transaction.
+
+        buffered ({ESOperation: EvaluationJob}): the outcomes of the
+            evaluation operations.
+
+        return ({(int, int)}): the submission and dataset ids of the
+            submission results that got new evaluations.
+
+        """
+        keys = set((operation.object_id, operation.dataset_id)
+                   for operation in buffered)
+        with SessionGen() as session:
+            testcase_ids = dict(
+                ((dataset_id, codename), testcase_id)
+                for dataset_id, codename, testcase_id in session.query(
+                    Testcase.dataset_id, Testcase.codename, Testcase.id)
+                .filter(Testcase.dataset_id.in_(
+                    set(dataset_id for _, dataset_id in keys))).all())
+            existing = set(session.query(
+                SubmissionResult.submission_id, SubmissionResult.dataset_id)
+                .filter(tuple_(SubmissionResult.submission_id,
+                               SubmissionResult.dataset_id).in_(keys))
+                .all())
+
+            updated = set()
+            for operation, job in buffered.iteritems():
+                key = (operation.object_id, operation.dataset_id)
+                testcase_id = testcase_ids.get(
+                    (operation.dataset_id, operation.testcase_codename))
+                if key not in existing or testcase_id is None:
+                    logger.error("[flush_evaluations] Couldn't find "
+                                 "submission %d(%d) or testcase %s in the "
+                                 "database.", operation.object_id,
+                                 operation.dataset_id,
+                                 operation.testcase_codename)
+                    continue
+                evaluation = job.to_evaluation()
+                evaluation.submission_id = operation.object_id
+                evaluation.dataset_id = operation.dataset_id
+                evaluation.testcase_id = testcase_id
+                session.add(evaluation)
+                updated.add(key)
+            session.commit()
+            logger.debug("Stored %d evaluations.", len(buffered))
+        return updated
+
+    def _end_evaluations(self, keys):
+        """End the evaluation of the submission results that have an
+        evaluation for each testcase. This is found counting their
+        evaluations in the database, instead of loading them.
+
+        keys ({(int, int)}): the submission and dataset ids of the
+            submission results to check.
+
+        """
+        with SessionGen() as session:
+            testcase_counts = dict(session.query(
+                Testcase.dataset_id, func.count(Testcase.id))
+                .filter(Testcase.dataset_id.in_(
+                    set(dataset_id for _, dataset_id in keys)))
+                .group_by(Testcase.dataset_id).all())
+            evaluated = [
+                (submission_id, dataset_id)
+                for submission_id, dataset_id, count in session.query(
+                    Evaluation.submission_id, Evaluation.dataset_id,
+                    func.count(Evaluation.id))
+                .filter(tuple_(Evaluation.submission_id,
+                               Evaluation.dataset_id).in_(keys))
+                .group_by(Evaluation.submission_id, Evaluation.dataset_id)
+                .all()
+                if count == testcase_counts.get(dataset_id)]
+
+            if len(evaluated) == 0:
+                return
+            for submission_result in session.query(SubmissionResult)\
+                    .filter(tuple_(SubmissionResult.submission_id,
+                                   SubmissionResult.dataset_id)
+                            .in_(evaluated))\
+                    .options(joinedload(SubmissionResult.submission))\
+                    .all():
+                submission_result.set_evaluation_outcome()
+                submission_result.evaluation_tries += 1
+                self.evaluation_ended(submission_result)
+
+    def cache_compilation(self, job):
+        """Store the outcome of a submission compilation, if it can be
+        reused.
+
+        Only successful compilations are stored, as failures could be
+        caused by a transient condition (e.g., a timeout on a loaded
+        worker).
+
+        job (CompilationJob): a completed compilation job.
+
+        """
+        if not job.success or not job.compilation_success:
+            return
+        self._compilation_cache[job.get_cache_key()] = job.export_to_dict()
+        while len(self._compilation_cache) > \
+                EvaluationService.COMPILATION_CACHE_SIZE:
+            self._compilation_cache.popitem(last=False)
+
+    def compile_from_cache(self, operation, dropped=None):
+        """Complete a submission compilation reusing the outcome of an
+        identical one, if available.
+
+        operation (ESOperation): a compilation operation.
+        dropped (function|None): tells if the operation has been
+            dropped (e.g. dequeued) meanwhile, in which case the
+            outcome is not stored.
+
+        return (bool): True if the operation has been completed (or
+            dropped).
+
+        """
+        if operation in self._cache_bypass:
+            self._cache_bypass.discard(operation)
+            return False
+
+        with SessionGen() as session:
+            submission = Submission.get_from_id(operation.object_id, session)
+            dataset = Dataset.get_from_id(operation.dataset_id, session)
+            if submission is None or dataset is None:
+                return False
+            key = JobGroup.from_submission_compilation(
+                submission, dataset).jobs[""].get_cache_key()
+            job_dict = self._compilation_cache.pop(key, None)
+            if job_dict is None:
+                self._compilation_cache_misses += 1
+                return False
+            self._compilation_cache[key] = job_dict
+            self._compilation_cache_hits += 1
+
+            logger.info("Reusing a previous compilation for submission "
+                        "%d(%d).", operation.object_id, operation.dataset_id)
+            if dropped is not None and dropped():
+                logger.info("Compilation of submission %d(%d) dropped.",
+                            operation.object_id, operation.dataset_id)
+                return True
+            job_group = JobGroup.import_from_dict(
+                {"jobs": {"": copy.deepcopy(job_dict)}, "success": True})
+            submission_result = submission.get_result_or_create(dataset)
+            submission_result.compilation_tries += 1
+            job_group.to_submission_compilation(submission_result)
+            self.compilation_ended(submission_result)
+            session.commit()
+        return True
+
+    def cache_evaluation(self, job):
+        """Store the outcome of a submission evaluation, to be reused
+        by the datasets that allow it.
+
+        job (EvaluationJob): a completed evaluation job.
+
+        """
+        if not job.success:
+            return
+        self._evaluation_cache[job.get_cache_key()] = (make_datetime(), {
+            "outcome": job.outcome,
+            "text": job.text,
+            "plus": job.plus,
+            "shard": job.shard,
+            "sandboxes": job.sandboxes,
+            })
+        while len(self._evaluation_cache) > \
+                EvaluationService.EVALUATION_CACHE_SIZE:
+            self._evaluation_cache.popitem(last=False)
+
+    def evaluate_from_cache(self, operation, submission, dataset,
+                            submission_result):
+        """Add the evaluation of a submission on a testcase reusing the
+        outcome of an identical one, if the dataset allows it and one
+        recent enough is available.
+
+        operation (ESOperation): an evaluation operation.
+        submission (Submission): its submission.
+        dataset (Dataset): its dataset.
+        submission_result (SubmissionResult): its submission result.
+
+        return (bool): True if the evaluation has been added.
+
+        """
+        if operation in self._cache_bypass:
+            self._cache_bypass.discard(operation)
+            return False
+        if dataset.evaluation_cache_max_age is None:
+            return False
+        if self.operation_busy(operation) or \
+                not submission_to_evaluate_on_testcase(
+                    submission_result, operation.testcase_codename):
+            return False
+
+        codename = operation.testcase_codename
+        key = JobGroup.from_submission_evaluation(
+            submission, dataset, codename).jobs[codename].get_cache_key()
+        entry = self._evaluation_cache.pop(key, None)
+        if entry is None or \
+                make_datetime() - entry[0] > dataset.evaluation_cache_max_age:
+            self._evaluation_cache_misses += 1
+            return False
+        self._evaluation_cache[key] = entry
+        self._evaluation_cache_hits += 1
+
+        logger.info("Reusing a previous evaluation for submission %d(%d) "
+                    "on testcase %s.", operation.object_id,
+                    operation.dataset_id, codename)
+        JobGroup({codename: EvaluationJob(**entry[1])}) \
+            .to_submission_evaluation(submission_result)
+        return True
+
     def compilation_ended(self, submission_result):
         """Actions to be performed when we have a submission that has
         ended compilation . In particular: we queue evaluation if
@@ -1297,6 +2246,8 @@ class EvaluationService(TriggeredService):
             logger.info("Submission %d(%d) was compiled successfully.",
                         submission_result.submission_id,
                         submission_result.dataset_id)
+            submission_result.sa_session.commit()
+            self.submission_updated(submission_result)
 
         # If instead submission failed compilation, we inform
         # ScoringService of the new submission. We need to commit
@@ -1332,6 +2283,21 @@ class EvaluationService(TriggeredService):
         submission_result.sa_session.commit()
         self.submission_enqueue_operations(submission)
 
+    def submission_updated(self, submission_result):
+        """Tell the PracticeWebServers that a submission result
+        changed. Only results on the active dataset are shown to the
+        users, so the others are ignored.
+
+        submission_result (SubmissionResult): the submission result.
+
+        """
+        submission = submission_result.submission
+        if submission_result.dataset is submission.task.active_dataset:
+            for practice_web_server in self.practice_web_servers:
+                practice_web_server.submission_updated(
+                    submission_id=submission.id,
+                    user_id=submission.user_id)
+
     def evaluation_ended(self, submission_result):
         """Actions to be performed when we have a submission that has
         been evaluated. In particular: we inform ScoringService on
@@ -1464,6 +2430,12 @@ class EvaluationService(TriggeredService):
                              "%d in the database.", submission_id)
                 return
 
+            if not self.owns_task(submission.task_id):
+                self.other_evaluation_services[get_evaluation_service_shard(
+                    submission.task_id)].new_submission(
+                        submission_id=submission_id)
+                return
+
             self.submission_enqueue_operations(submission)
 
             session.commit()
@@ -1486,10 +2458,28 @@ class EvaluationService(TriggeredService):
                              "in the database.", user_test_id)
                 return
 
+            if not self.owns_task(user_test.task_id):
+                self.other_evaluation_services[get_evaluation_service_shard(
+                    user_test.task_id)].new_user_test(
+                        user_test_id=user_test_id)
+                return
+
             self.user_test_enqueue_operations(user_test)
 
             session.commit()
 
+    @rpc_method
+    def search_operations_not_done(self, propagate=True):
+        """Make the sweeper loop fire the sweeper as soon as possible.
+
+        propagate (bool): whether to do the same on the other shards.
+
+        """
+        if propagate:
+            for service in self.other_evaluation_services.itervalues():
+                service.search_operations_not_done(propagate=False)
+        super(EvaluationService, self).search_operations_not_done()
+
     @rpc_method
     @with_post_finish_lock
     def invalidate_submission(self,
@@ -1497,7 +2487,9 @@ class EvaluationService(TriggeredService):
                               dataset_id=None,
                               user_id=None,
                               task_id=None,
-                              level="compilation"):
+                              level="compilation",
+                              use_cache=True,
+                              propagate=True):
         """Request to invalidate some computed data.
 
         Invalidate the compilation and/or evaluation data of the
@@ -1509,10 +2501,11 @@ class EvaluationService(TriggeredService):
           or, if None, to any dataset of any task of the contest this
           service is running for.
 
-        The data is cleared, the operations involving the submissions
-        currently enqueued are deleted, and the ones already assigned to
-        the workers are ignored. New appropriate operations are
-        enqueued.
+        The operations involving the submissions currently enqueued
+        are deleted, and the ones already assigned to the workers are
+        ignored. Then, in the background and a chunk of submissions at
+        a time, the data is cleared and new appropriate operations are
+        enqueued; the progress is reported by rejudge_status.
 
         submission_id (int|None): id of the submission to invalidate,
             or None.
@@ -1521,6 +2514,11 @@ class EvaluationService(TriggeredService):
         user_id (int|None): id of the user to invalidate, or None.
         task_id (int|None): id of the task to invalidate, or None.
         level (string): 'compilation' or 'evaluation'
+        use_cache (bool): if False, the submissions are compiled and
+            evaluated again even if identical compilations or
+            evaluations were already done.
+        propagate (bool): whether to forward the request to the other
+            shards, each invalidating the submissions of its tasks.
 
         """
         logger.info("Invalidation request received.")
@@ -1531,65 +2529,190 @@ class EvaluationService(TriggeredService):
             raise ValueError(
                 "Unexpected invalidation level `%s'." % level)
 
+        if propagate:
+            for service in self.other_evaluation_services.itervalues():
+                service.invalidate_submission(
+                    submission_id=submission_id, dataset_id=dataset_id,
+                    user_id=user_id, task_id=task_id, level=level,
+                    use_cache=use_cache, propagate=False)
+
         with SessionGen() as session:
-            # First we load all involved submissions.
-            submissions = get_submissions(
+            # Only the submissions of its task can have results on a
+            # dataset.
+            if dataset_id is not None and task_id is None \
+                    and submission_id is None:
+                dataset = Dataset.get_from_id(dataset_id, session)
+                if dataset is None:
+                    raise ValueError("Unknown dataset %d." % dataset_id)
+                task_id = dataset.task_id
+
+            submission_ids = get_submission_ids(
                 # Give contest_id only if all others are None.
                 self.contest_id
                 if {user_id, task_id, submission_id} == {None}
                 else None,
-                user_id, task_id, submission_id, session)
-
-            # Then we get all relevant operations, and we remove them
-            # both from the queue and from the pool (i.e., we ignore
-            # the workers involved in those operations).
-            operations = get_relevant_operations_(
-                level, submissions, dataset_id)
-            for operation in operations:
-                try:
+                user_id, task_id, submission_id, session,
+                task_ids=self._get_owned_task_ids(session)
+                if self.other_evaluation_services else None)
+
+        # We remove the operations involving the submissions both from
+        # the queue and from the pool (i.e., we ignore the workers
+        # involved in those operations) right away; the results are
+        # invalidated and the submissions enqueued again a chunk at a
+        # time by another greenlet, not to stall the service.
+        self._drop_submission_operations(
+            set(submission_ids), dataset_id, level)
+
+        progress = {
+            "level": level,
+            "started": make_timestamp(),
+            "submissions": len(submission_ids),
+            "done": 0,
+            "results": 0,
+            "operations": 0,
+            "finished": False,
+            }
+        self._rejudges.append(progress)
+        gevent.spawn(self._rejudge, submission_ids, dataset_id, level,
+                     use_cache, progress)
+
+    def _drop_submission_operations(self, submission_ids, dataset_id,
+                                    level):
+        """Remove the operations involving some submissions from the
+        queue, and ignore the ones assigned to the workers.
+
+        submission_ids ({int}): the ids of the submissions.
+        dataset_id (int|None): the id of the dataset of the operations
+            to drop, or None for all datasets.
+        level (string): 'compilation' to drop all operations, or
+            'evaluation' to drop only the evaluations.
+
+        """
+        def involved(operation):
+            return operation.object_id in submission_ids \
+                and (dataset_id is None or
+                     operation.dataset_id == dataset_id) \
+                and (operation.type_ == ESOperation.EVALUATION or
+                     (operation.type_ == ESOperation.COMPILATION and
+                      level == "compilation"))
+
+        executor = self.get_executor()
+        for submission_id in submission_ids:
+            for operation in executor.get_submission_operations(
+                    submission_id):
+                if involved(operation):
                     self.dequeue(operation)
-                except KeyError:
-                    pass  # Ok, the operation wasn't in the queue.
-                try:
-                    self.get_executor().pool.ignore_operation(operation)
-                except LookupError:
-                    pass  # Ok, the operation wasn't in the pool.
+        executor.pool.ignore_operations(involved)
+
+    def _rejudge(self, submission_ids, dataset_id, level, use_cache,
+                 progress):
+        """Invalidate the results of some submissions and enqueue them
+        again, a chunk at a time.
+
+        The results of each chunk are blanked with a few bulk SQL
+        statements, and then the submissions of the chunk are loaded
+        (together with their results) to be enqueued again.
+
+        submission_ids ([int]): the ids of the submissions.
+        dataset_id (int|None): the id of the dataset of the results to
+            invalidate, or None for all datasets.
+        level (string): 'compilation' or 'evaluation'.
+        use_cache (bool): whether the compilations and evaluations can
+            be taken from the caches.
+        progress (dict): the progress of the rejudge, updated while
+            going on.
 
-            # Then we find all existing results in the database, and
-            # we remove them.
-            submission_results = get_submission_results(
-                # Give contest_id only if all others are None.
-                self.contest_id
-                if {user_id, task_id, submission_id, dataset_id} == {None}
-                else None,
-                user_id, task_id, submission_id, dataset_id, session)
-            logger.info("Submission results to invalidate %s for: %d.",
-                        level, len(submission_results))
-            for submission_result in submission_results:
-                # We invalidate the appropriate data and queue the
-                # operations to recompute those data.
-                if level == "compilation":
-                    submission_result.invalidate_compilation()
-                elif level == "evaluation":
-                    submission_result.invalidate_evaluation()
-
-            # Finally, we re-enqueue the operations for the
-            # submissions.
-            for submission in submissions:
-                self.submission_enqueue_operations(submission)
+        """
+        size = EvaluationService.REJUDGE_CHUNK_SIZE
+        try:
+            for i in xrange(0, len(submission_ids), size):
+                chunk = submission_ids[i:i + size]
+                with self.post_finish_lock:
+                    # Operations may have been enqueued in the
+                    # meantime, e.g. by the sweeper; the evaluations
+                    # already received are stored to be invalidated.
+                    self._drop_submission_operations(
+                        set(chunk), dataset_id, level)
+                    self.flush_evaluations()
+                    with SessionGen() as session:
+                        progress["results"] += \
+                            SubmissionResult.invalidate_in_bulk(
+                                session, level, chunk, dataset_id)
+                        session.commit()
+
+                with SessionGen() as session:
+                    submissions = session.query(Submission)\
+                        .filter(Submission.id.in_(chunk))\
+                        .options(joinedload(Submission.results))\
+                        .order_by(Submission.id).all()
+                    for submission in submissions:
+                        if not use_cache:
+                            # Only the operations that are going to be
+                            # enqueued, the entries being removed when
+                            # they are executed.
+                            judged = set(
+                                dataset.id for dataset in
+                                get_datasets_to_judge(submission.task))
+                            self._cache_bypass.update(
+                                operation for operation in
+                                get_relevant_operations_(
+                                    level, [submission], dataset_id)
+                                if operation.dataset_id in judged)
+                        progress["operations"] += \
+                            self.submission_enqueue_operations(submission)
+                    session.commit()
+
+                progress["done"] += len(chunk)
+                logger.info("Rejudged %d submissions out of %d.",
+                            progress["done"], progress["submissions"])
+                gevent.sleep(EvaluationService.REJUDGE_CHUNK_INTERVAL)
+        except Exception:
+            logger.error("Unexpected error while rejudging.", exc_info=True)
+        finally:
+            progress["finished"] = True
+            finished = [p for p in self._rejudges if p["finished"]]
+            for p in finished[:-EvaluationService.REJUDGE_HISTORY_SIZE]:
+                self._rejudges.remove(p)
 
-            session.commit()
+    @rpc_method
+    def rejudge_status(self, aggregate=True):
+        """Return the progress of the rejudges requested through
+        invalidate_submission.
+
+        return ([dict]): for each rejudge, running or among the last
+            completed, its level, its starting time, the number of
+            submissions involved and of the ones already done, the
+            number of results invalidated and of operations enqueued,
+            and whether it has finished. Each shard reports separately
+            its part of a rejudge.
+
+        aggregate (bool): whether to include the other shards.
+
+        """
+        rejudges = list(self._rejudges)
+        if aggregate:
+            for other_rejudges in self._ask_other_shards(
+                    "rejudge_status", aggregate=False):
+                rejudges.extend(other_rejudges)
+            rejudges.sort(key=lambda r: r["started"])
+        return rejudges
 
     @rpc_method
-    def disable_worker(self, shard):
+    def disable_worker(self, shard, propagate=True):
         """Disable a specific worker (recovering its assigned operations).
 
         shard (int): the shard of the worker.
+        propagate (bool): whether to forward the request to the shard
+            of ES the worker belongs to, if it is another one.
 
         returns (bool): True if everything went well.
 
         """
         logger.info("Received request to disable worker %s.", shard)
+        es_shard = get_worker_evaluation_service_shard(shard)
+        if es_shard != self.shard:
+            return propagate and self._ask_shard(
+                es_shard, "disable_worker", shard=shard, propagate=False)
 
         lost_operations = []
         try:
@@ -1604,15 +2727,21 @@ class EvaluationService(TriggeredService):
         return True
 
     @rpc_method
-    def enable_worker(self, shard):
+    def enable_worker(self, shard, propagate=True):
         """Enable a specific worker.
 
         shard (int): the shard of the worker.
+        propagate (bool): whether to forward the request to the shard
+            of ES the worker belongs to, if it is another one.
 
         returns (bool): True if everything went well.
 
         """
         logger.info("Received request to enable worker %s.", shard)
+        es_shard = get_worker_evaluation_service_shard(shard)
+        if es_shard != self.shard:
+            return propagate and self._ask_shard(
+                es_shard, "enable_worker", shard=shard, propagate=False)
         try:
             self.get_executor().pool.enable_worker(shard)
         except ValueError:
@@ -1621,7 +2750,39 @@ class EvaluationService(TriggeredService):
         return True
 
     @rpc_method
-    def queue_status(self):
+    def cache_status(self, aggregate=True):
+        """Return the usage of the compilation and evaluation caches.
+
+        aggregate (bool): whether to add up the caches of the other
+            shards.
+
+        return (dict): for "compilation" and "evaluation", the number
+            of outcomes stored ("size"), and of the ones that were
+            ("hits") or weren't ("misses") found in the cache.
+
+        """
+        status = {
+            "compilation": {
+                "size": len(self._compilation_cache),
+                "hits": self._compilation_cache_hits,
+                "misses": self._compilation_cache_misses,
+                },
+            "evaluation": {
+                "size": len(self._evaluation_cache),
+                "hits": self._evaluation_cache_hits,
+                "misses": self._evaluation_cache_misses,
+                },
+            }
+        if aggregate:
+            for other_status in self._ask_other_shards(
+                    "cache_status", aggregate=False):
+                for cache, counts in other_status.iteritems():
+                    for key, value in counts.iteritems():
+                        status[cache][key] += value
+        return status
+
+    @rpc_method
+    def queue_status(self, aggregate=True):
         """Return the status of the queue.
 
         Parent method returns list of queues of each executor, but in
@@ -1639,9 +2800,23 @@ class EvaluationService(TriggeredService):
         The entries are then ordered by priority and timestamp (the
         same criteria used to look at what to complete next).
 
+        Each entry also has the time when its last operation is
+        expected to be completed (see CostModel), or None if there is
+        no estimate.
+
+        aggregate (bool): whether to include the queues of the other
+            shards.
+
         return ([QueueEntry]): the list with the queued elements.
 
         """
+        expected_ends = dict()
+        for operation, end in self.get_executor().get_expected_ends(
+                self.cost_model):
+            key = (str(operation.type_), str(operation.object_id),
+                   str(operation.dataset_id))
+            expected_ends[key] = max(end, expected_ends.get(key, end))
+
         entries = super(EvaluationService, self).queue_status()[0]
         entries_by_key = dict()
         for entry in entries:
@@ -1653,7 +2828,14 @@ class EvaluationService(TriggeredService):
             else:
                 entries_by_key[key] = entry
                 entries_by_key[key]["item"]["multiplicity"] = 1
+                entry["expected_end"] = make_timestamp(expected_ends[key]) \
+                    if key in expected_ends else None
+        entries = entries_by_key.values()
+        if aggregate:
+            for other_entries in self._ask_other_shards(
+                    "queue_status", aggregate=False):
+                entries.extend(other_entries)
         return sorted(
-            entries_by_key.values(),
+            entries,
             lambda x, y: cmp((x["priority"], x["timestamp"]),
                              (y["priority"], y["timestamp"])))
@@ -34,7 +34,8 @@ import logging
 from collections import deque
 
 from cms import config, mkdir
-from cms.log import root_logger, shell_handler, FileHandler, CustomFormatter
+from cms.log import root_logger, shell_handler, RotatingFileHandler, \
+    CustomFormatter
 from cms.io import Service, rpc_method
 
 
@@ -48,6 +49,15 @@ class LogService(Service):
 
     LAST_MESSAGES_COUNT = 100
 
+    # Size at which the log file is rotated, and how many old ones are
+    # kept.
+    MAX_LOG_SIZE = 100 * 1024 * 1024
+    LOG_BACKUP_COUNT = 10
+
+    # Maximum time (in seconds) log messages stay buffered in memory
+    # before being written to the file.
+    FLUSH_INTERVAL = 1.0
+
     def __init__(self, shard):
         Service.__init__(self, shard)
 
@@ -61,8 +71,10 @@ class LogService(Service):
         log_filename = "%d.log" % int(time.time())
 
         # Install a global file handler.
-        self.file_handler = FileHandler(os.path.join(log_dir, log_filename),
-                                        mode='w', encoding='utf-8')
+        self.file_handler = RotatingFileHandler(
+            os.path.join(log_dir, log_filename), mode='w', encoding='utf-8',
+            max_bytes=self.MAX_LOG_SIZE, backup_count=self.LOG_BACKUP_COUNT,
+            flush_interval=self.FLUSH_INTERVAL)
         self.file_handler.setLevel(logging.DEBUG)
         self.file_handler.setFormatter(CustomFormatter(False))
         root_logger.addHandler(self.file_handler)
@@ -77,6 +89,8 @@ class LogService(Service):
 
         self._last_messages = deque(maxlen=self.LAST_MESSAGES_COUNT)
 
+        self.add_timeout(self.file_handler.flush, None, self.FLUSH_INTERVAL)
+
     @rpc_method
     def Log(self, **kwargs):
         """Log a message.
@@ -122,6 +136,17 @@ class LogService(Service):
                 "timestamp": record.created,
                 "exc_text": getattr(record, "exc_text", None)})
 
+    @rpc_method
+    def LogBatch(self, records):
+        """Log several messages.
+
+        records ([dict]): the attributes of the LogRecords, each as
+            described in Log.
+
+        """
+        for record in records:
+            self.Log(**record)
+
     @rpc_method
     def last_messages(self):
         return list(self._last_messages)
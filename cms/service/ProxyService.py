@@ -29,8 +29,15 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import functools
+import gzip
+import hashlib
+import io
+import itertools
 import json
 import logging
+import os
+import random
 import string
 
 import gevent
@@ -38,11 +45,13 @@ import gevent.queue
 
 import requests
 import requests.exceptions
-from urlparse import urljoin, urlsplit
+from sqlalchemy import and_
+from urlparse import urljoin, urlsplit, urlunsplit
 
-from cms import config
+from cms import config, mkdir
 from cms.io import Executor, QueueItem, TriggeredService, rpc_method
-from cms.db import SessionGen, Contest, Task, Submission
+from cms.db import SessionGen, Contest, Task, Submission, SubmissionResult, \
+    Token, User
 from cms.grading.scoretypes import get_score_type
 from cmscommon.datetime import make_timestamp
 
@@ -54,6 +63,18 @@ class CannotSendError(Exception):
     pass
 
 
+class RejectedDataError(CannotSendError):
+    """The ranking refused the data: sending it again won't help."""
+    pass
+
+
+# Request bodies at least this long are compressed.
+GZIP_THRESHOLD = 1024
+
+# How long to wait for the ranking to answer a request.
+REQUEST_TIMEOUT = 60.0
+
+
 def encode_id(entity_id):
     """Encode the id using only A-Za-z0-9_.
 
@@ -70,41 +91,115 @@ def encode_id(entity_id):
     return encoded_id
 
 
-def safe_put_data(ranking, resource, data, operation):
+def data_version(*values):
+    """Return a short digest identifying some data sent to rankings.
+
+    values ([object]): JSON-encodable values determining the data.
+
+    return (unicode): the digest.
+
+    """
+    return hashlib.sha1(json.dumps(values)).hexdigest()[:16].decode('ascii')
+
+
+def ranking_id(ranking):
+    """Return the URL of a ranking without the credentials.
+
+    ranking (bytes): the URL of ranking server.
+
+    return (unicode): the URL, without username and password.
+
+    """
+    url = urlsplit(ranking)
+    netloc = url.hostname
+    if url.port is not None:
+        netloc += ":%d" % url.port
+    return urlunsplit((url.scheme, netloc, url.path, "", "")).decode('utf-8')
+
+
+def safe_put_data(ranking, resource, data, operation, session=None,
+                  compress=True):
     """Send some data to ranking using a PUT request.
 
+    Large bodies are compressed with gzip, if asked to. As a ranking
+    that doesn't understand the compression answers 400 too, a
+    compressed body it refuses is sent again once, uncompressed: only
+    refusing the latter means refusing the data.
+
     ranking (bytes): the URL of ranking server.
     resource (bytes): the relative path of the entity.
     data (dict): the data to JSON-encode and send.
     operation (unicode): a human-readable description of the operation
         we're performing (to produce log messages).
+    session (requests.Session|None): the session to send the request
+        with, to reuse its connections.
+    compress (bool): whether large bodies may be compressed.
+
+    return (bool): False if the ranking refused the compressed body
+        but accepted the uncompressed one, True otherwise.
 
     raise (CannotSendError): in case of communication errors.
+    raise (RejectedDataError): if the ranking refused the data.
 
     """
+    if session is None:
+        session = requests
+    body = json.dumps(data, encoding="utf-8")
+    headers = {'content-type': 'application/json'}
+    compressed = compress and len(body) >= GZIP_THRESHOLD
+    if compressed:
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode="wb") as compressor:
+            compressor.write(body)
+        body = buf.getvalue()
+        headers['content-encoding'] = 'gzip'
     try:
         url = urljoin(ranking, resource)
         # XXX With requests-1.2 auth is automatically extracted from
         # the URL: there is no need for this.
         auth = urlsplit(url)
-        res = requests.put(url, json.dumps(data, encoding="utf-8"),
-                           auth=(auth.username, auth.password),
-                           headers={'content-type': 'application/json'},
-                           verify=config.https_certfile)
+        res = session.put(url, body,
+                          auth=(auth.username, auth.password),
+                          headers=headers,
+                          verify=config.https_certfile,
+                          timeout=REQUEST_TIMEOUT)
     except requests.exceptions.RequestException as error:
         msg = "%s while %s: %s." % (type(error).__name__, operation, error)
         logger.warning(msg)
         raise CannotSendError(msg)
+    if res.status_code == 400 and compressed:
+        logger.warning("Status %s while %s with a compressed body, "
+                       "sending it again uncompressed.",
+                       res.status_code, operation)
+        safe_put_data(ranking, resource, data, operation, session,
+                      compress=False)
+        return False
+    if res.status_code == 400:
+        msg = "Status %s while %s." % (res.status_code, operation)
+        logger.error(msg)
+        raise RejectedDataError(msg)
     if 400 <= res.status_code < 600:
         msg = "Status %s while %s." % (res.status_code, operation)
         logger.warning(msg)
         raise CannotSendError(msg)
+    return True
 
 
 class ProxyOperation(QueueItem):
-    def __init__(self, type_, data):
+    def __init__(self, type_, data, ack=None):
+        """Create the operation.
+
+        type_ (int): the entity type (see ProxyExecutor).
+        data (dict): the entities to send, indexed by their id.
+        ack ((unicode, int, unicode)|None): what the ranking is known
+            to have once it acknowledged the data, as a kind ("scores"
+            or "tokens"), a submission id and the version of the data
+            (see data_version).
+
+        """
         self.type_ = type_
         self.data = data
+        self.ack = ack
 
     def __str__(self):
         return "sending data of type %s to ranking" % (
@@ -112,7 +207,8 @@ class ProxyOperation(QueueItem):
 
     def to_dict(self):
         return {"type": self.type_,
-                "data": self.data}
+                "data": self.data,
+                "ack": self.ack}
 
 
 class ProxyExecutor(Executor):
@@ -123,8 +219,14 @@ class ProxyExecutor(Executor):
 
     It maintains a queue of data to send. At each "round" the queue is
     emptied (i.e. all jobs are fetched) and the data is then "combined"
-    to minimize the number of actual HTTP requests: they'll be at most
-    one per entity type.
+    with what is still to be sent to minimize the number of actual
+    HTTP requests: they'll be one per entity type, unless there are
+    more than MAX_BATCH_SIZE entities of that type. Requests reuse
+    the connections to the ranking.
+
+    Data is forgotten only once the ranking acknowledged it: on
+    failure, the executor waits (exponentially longer after each
+    consecutive failure) and sends again only what wasn't received.
 
     Each entity type is identified by a integral class-level constant.
 
@@ -153,30 +255,52 @@ class ProxyExecutor(Executor):
     TYPE_COUNT = len(RESOURCE_PATHS)
 
     # How long we wait after having failed to push data to a ranking
-    # before trying again.
+    # before trying again: the wait starts from FAILURE_WAIT_MIN and
+    # doubles at each consecutive failure, up to FAILURE_WAIT (with
+    # some randomness, to avoid retrying all at the same time).
+    FAILURE_WAIT_MIN = 1.0
     FAILURE_WAIT = 60.0
 
-    def __init__(self, ranking):
+    # The maximum number of entities to send in a single request.
+    MAX_BATCH_SIZE = 1000
+
+    def __init__(self, ranking, acknowledged_callback=None):
         """Create a proxy for the ranking at the given URL.
 
         ranking (bytes): a complete URL (containing protocol, username,
             password, hostname, port and prefix) where a ranking is
             supposed to listen.
+        acknowledged_callback (function|None): called with the list of
+            the acks (see ProxyOperation) of the operations whose data
+            the ranking received (and didn't reject).
 
         """
         super(ProxyExecutor, self).__init__(batch_executions=True)
 
         self._ranking = ranking
+        self._acknowledged_callback = acknowledged_callback
+
+        # Keeps the connections to the ranking alive.
+        self._session = requests.Session()
+        # Whether the ranking (still) seems to accept compressed data.
+        self._compress = True
+
+        # The data not yet received by the ranking, for each type,
+        # and the acks of the operations it comes from, indexed by the
+        # id of the entity whose reception they stand for.
+        self._pending = list(dict() for i in xrange(self.TYPE_COUNT))
+        self._pending_acks = list(dict() for i in xrange(self.TYPE_COUNT))
+
+        self._failures = 0
 
     def execute(self, entries):
         """Consume (i.e. send) the data put in the queue, forever.
 
         Pick all operations found in the queue (if there aren't any,
-        block waiting until there are), combine them and send HTTP
-        requests to the target ranking. Do it until something very bad
-        happens (i.e. some exception is raised). If communication fails
-        don't stop, just wait FAILURE_WAIT seconds before restarting
-        the loop.
+        block waiting until there are), combine them with the data
+        still to be sent and send HTTP requests to the target ranking.
+        If communication fails don't stop, just wait (see
+        FAILURE_WAIT) before sending what's left again.
 
         Do all this cooperatively: yield at every blocking operation
         (queue fetch, request send, failure wait, etc.). Since the
@@ -186,35 +310,92 @@ class ProxyExecutor(Executor):
             perform.
 
         """
-        # The cumulative data that we will try to send to the ranking,
-        # built by combining items in the queue.
-        data = list(dict() for i in xrange(self.TYPE_COUNT))
-
         for entry in entries:
-            data[entry.item.type_].update(entry.item.data)
+            type_ = entry.item.type_
+            self._pending[type_].update(entry.item.data)
+            for key in entry.item.data:
+                if entry.item.ack is not None:
+                    self._pending_acks[type_][key] = entry.item.ack
+                else:
+                    self._pending_acks[type_].pop(key, None)
+
+        while True:
+            try:
+                self._send_pending()
+            except CannotSendError:
+                # A log message has already been produced.
+                self._failures += 1
+                gevent.sleep(self._failure_wait())
+                continue
+            except Exception:
+                # Whoa! That's unexpected! We drop the data, as it
+                # could be what's causing the error.
+                logger.error("Unexpected error.", exc_info=True)
+                self._pending = list(dict() for i in xrange(self.TYPE_COUNT))
+                self._pending_acks = list(
+                    dict() for i in xrange(self.TYPE_COUNT))
+                gevent.sleep(self.FAILURE_WAIT)
+                return
+            break
 
-        try:
-            for i in xrange(self.TYPE_COUNT):
-                # Send entities of type i.
-                if len(data[i]) > 0:
-                    # We abuse the resource path as the English
-                    # (plural) name for the entity type.
-                    name = self.RESOURCE_PATHS[i]
-                    operation = "sending %s to ranking %s" % (name,
-                                                              self._ranking)
-
-                    logger.debug(operation.capitalize())
-                    safe_put_data(
-                        self._ranking, b"%s/" % name, data[i], operation)
-                    data[i].clear()
-
-        except CannotSendError:
-            # A log message has already been produced.
-            gevent.sleep(self.FAILURE_WAIT)
-        except:
-            # Whoa! That's unexpected!
-            logger.error("Unexpected error.", exc_info=True)
-            gevent.sleep(self.FAILURE_WAIT)
+        self._failures = 0
+
+    def _failure_wait(self):
+        """Return how long to wait after the last failure.
+
+        return (float): the time to wait, in seconds.
+
+        """
+        wait = min(self.FAILURE_WAIT,
+                   self.FAILURE_WAIT_MIN * 2 ** (self._failures - 1))
+        return wait * random.uniform(0.5, 1.0)
+
+    def _send_pending(self):
+        """Send the data still to be sent, in batches, type by type.
+
+        The acks of each batch the ranking received are reported as
+        soon as it is sent.
+
+        raise (CannotSendError): if a batch could not be sent; the
+            data not sent yet stays pending.
+
+        """
+        for i in xrange(self.TYPE_COUNT):
+            # We abuse the resource path as the English (plural)
+            # name for the entity type.
+            name = self.RESOURCE_PATHS[i]
+            pending = self._pending[i]
+            pending_acks = self._pending_acks[i]
+            while len(pending) > 0:
+                keys = list(itertools.islice(pending.iterkeys(),
+                                             self.MAX_BATCH_SIZE))
+                batch = dict((key, pending[key]) for key in keys)
+                operation = "sending %d %s to ranking %s" % (
+                    len(batch), name, self._ranking)
+
+                logger.debug(operation.capitalize())
+                try:
+                    if not safe_put_data(self._ranking, b"%s/" % name,
+                                         batch, operation, self._session,
+                                         compress=self._compress):
+                        logger.warning("Ranking %s doesn't accept "
+                                       "compressed data, not compressing "
+                                       "any more.", self._ranking)
+                        self._compress = False
+                except RejectedDataError:
+                    # Sending it again would be useless.
+                    logger.error("Dropping %d %s refused by ranking %s.",
+                                 len(batch), name, self._ranking)
+                    acks = []
+                else:
+                    acks = [pending_acks[key] for key in keys
+                            if key in pending_acks]
+                for key in keys:
+                    del pending[key]
+                    pending_acks.pop(key, None)
+                if self._acknowledged_callback is not None and \
+                        len(acks) > 0:
+                    self._acknowledged_callback(acks)
 
 
 class ProxyService(TriggeredService):
@@ -234,6 +415,10 @@ class ProxyService(TriggeredService):
 
     """
 
+    # How often we store on disk what the rankings received, if it
+    # changed.
+    WATERMARK_SAVE_INTERVAL = 10.0
+
     def __init__(self, shard, contest_id):
         """Start the service with the given parameters.
 
@@ -252,46 +437,173 @@ class ProxyService(TriggeredService):
 
         self.contest_id = contest_id
 
-        # Store what data we already sent to rankings, to avoid
-        # sending it twice.
-        self.scores_sent_to_rankings = set()
-        self.tokens_sent_to_rankings = set()
+        # Store, for each ranking, the versions of the scores and
+        # tokens of the submissions it received: it is kept on disk,
+        # so that after a restart we only send what the rankings miss
+        # or have outdated.
+        self.watermark_path = os.path.join(
+            config.data_dir, "proxy_%d.json" % self.contest_id)
+        self.acknowledged = self.load_watermark()
+        self._watermark_changed = False
+
+        # Store the versions of the data we already sent to rankings,
+        # indexed by submission id, to avoid sending it twice.
+        self.scores_sent_to_rankings = dict()
+        self.tokens_sent_to_rankings = dict()
 
         # Create one executor for each ranking.
         self.rankings = list()
         for ranking in config.rankings:
-            self.add_executor(ProxyExecutor(ranking.encode('utf-8')))
+            ranking = ranking.encode('utf-8')
+            acknowledged = self.acknowledged.setdefault(
+                ranking_id(ranking), {"scores": dict(), "tokens": dict()})
+            self.rankings.append(ranking)
+            self.add_executor(ProxyExecutor(
+                ranking,
+                functools.partial(self.data_acknowledged, acknowledged)))
+
+        # Data is sent again unless all rankings have its version.
+        if len(self.rankings) > 0:
+            acknowledged = [self.acknowledged[ranking_id(r)]
+                            for r in self.rankings]
+            self.scores_sent_to_rankings = dict(
+                (submission_id, version) for submission_id, version
+                in acknowledged[0]["scores"].iteritems()
+                if all(ack["scores"].get(submission_id) == version
+                       for ack in acknowledged[1:]))
+            self.tokens_sent_to_rankings = dict(
+                (submission_id, version) for submission_id, version
+                in acknowledged[0]["tokens"].iteritems()
+                if all(ack["tokens"].get(submission_id) == version
+                       for ack in acknowledged[1:]))
+
+        self.add_timeout(self.save_watermark, None,
+                         ProxyService.WATERMARK_SAVE_INTERVAL,
+                         immediately=False)
         self.start_sweeper(347.0)
 
         # Send some initial data to rankings.
         self.initialize()
 
+    def load_watermark(self):
+        """Load from disk what the rankings are known to have.
+
+        return ({unicode: {unicode: {int: unicode}}}): for each ranking
+            (see ranking_id), the versions (see data_version) of the
+            "scores" and "tokens" it received, indexed by submission
+            id.
+
+        """
+        try:
+            with io.open(self.watermark_path, "rb") as fin:
+                data = json.load(fin)
+            return dict(
+                (ranking, dict(
+                    (kind, dict((int(submission_id), version)
+                                for submission_id, version
+                                in versions.iteritems()))
+                    for kind, versions in acknowledged.iteritems()))
+                for ranking, acknowledged in data.iteritems())
+        except IOError:
+            return dict()
+        except (ValueError, AttributeError):
+            logger.warning("Ignoring corrupted or outdated file %s.",
+                           self.watermark_path)
+            return dict()
+
+    def save_watermark(self):
+        """Store on disk what the rankings are known to have, if it
+        changed since the last time.
+
+        """
+        if not self._watermark_changed:
+            return
+        self._watermark_changed = False
+        try:
+            mkdir(config.data_dir)
+            with io.open(self.watermark_path + ".tmp", "wb") as fout:
+                json.dump(self.acknowledged, fout)
+            os.rename(self.watermark_path + ".tmp", self.watermark_path)
+        except (IOError, OSError):
+            logger.warning("Cannot store the data sent to rankings in %s.",
+                           self.watermark_path, exc_info=True)
+            self._watermark_changed = True
+
+    def data_acknowledged(self, acknowledged, acks):
+        """Record that a ranking received some data.
+
+        acknowledged ({unicode: {int: unicode}}): the data the ranking
+            is known to have (see load_watermark).
+        acks ([(unicode, int, unicode)]): what it received (see
+            ProxyOperation).
+
+        """
+        for kind, submission_id, version in acks:
+            acknowledged[kind][submission_id] = version
+        self._watermark_changed = True
+
+    def forget_scores(self, submission_ids):
+        """Forget that the scores of some submissions were sent, as
+        they may have changed.
+
+        submission_ids ([int]): the ids of the submissions.
+
+        """
+        for submission_id in submission_ids:
+            self.scores_sent_to_rankings.pop(submission_id, None)
+            for acknowledged in self.acknowledged.itervalues():
+                acknowledged["scores"].pop(submission_id, None)
+        self._watermark_changed = True
+
     def _missing_operations(self):
         """Return a generator of data to be sent to the rankings..
 
+        Only the ids of the submissions to consider and the versions
+        of their data are loaded, and the submissions only when there
+        is something to send.
+
         """
         counter = 0
         with SessionGen() as session:
-            contest = Contest.get_from_id(self.contest_id, session)
-
-            for submission in contest.get_submissions():
-                if submission.user.hidden:
-                    continue
-
-                # The submission result can be None if the dataset has
-                # been just made live.
-                sr = submission.get_result()
-                if sr is None:
-                    continue
-
-                if sr.scored() and \
-                        submission.id not in self.scores_sent_to_rankings:
+            scored_ids = session.query(
+                Submission.id, SubmissionResult.score,
+                SubmissionResult.ranking_score_details)\
+                .join(Submission.task)\
+                .join(Submission.user)\
+                .join(SubmissionResult,
+                      and_(SubmissionResult.submission_id == Submission.id,
+                           SubmissionResult.dataset_id ==
+                           Task.active_dataset_id))\
+                .filter(Task.contest_id == self.contest_id)\
+                .filter(User.hidden == False)\
+                .filter(SubmissionResult.filter_scored())  # noqa
+            tokened_ids = session.query(Submission.id, Token.timestamp)\
+                .join(Submission.task)\
+                .join(Submission.user)\
+                .join(Token, Token.submission_id == Submission.id)\
+                .filter(Task.contest_id == self.contest_id)\
+                .filter(User.hidden == False)  # noqa
+
+            # The submission result can be missing if the dataset has
+            # been just made live: such submissions are not scored.
+            to_score = set(
+                id_ for id_, score, details in scored_ids
+                if self.scores_sent_to_rankings.get(id_) !=
+                data_version(score, details))
+            to_token = set(
+                id_ for id_, timestamp in tokened_ids
+                if self.tokens_sent_to_rankings.get(id_) !=
+                data_version(make_timestamp(timestamp)))
+
+            for submission_id in sorted(to_score | to_token):
+                submission = Submission.get_from_id(submission_id, session)
+
+                if submission_id in to_score:
                     for operation in self.operations_for_score(submission):
                         self.enqueue(operation)
                         counter += 1
 
-                if submission.tokened() and \
-                        submission.id not in self.tokens_sent_to_rankings:
+                if submission_id in to_token:
                     for operation in self.operations_for_token(submission):
                         self.enqueue(operation)
                         counter += 1
@@ -376,19 +688,23 @@ class ProxyService(TriggeredService):
             "time": int(make_timestamp(submission.timestamp))}
 
         # This check is probably useless.
+        version = None
         if submission_result is not None and submission_result.scored():
             # We're sending the unrounded score to RWS
             subchange_data["score"] = submission_result.score
             subchange_data["extra"] = \
                 json.loads(submission_result.ranking_score_details)
+            version = data_version(submission_result.score,
+                                   submission_result.ranking_score_details)
 
-        self.scores_sent_to_rankings.add(submission.id)
+        self.scores_sent_to_rankings[submission.id] = version
 
         return [
             ProxyOperation(ProxyExecutor.SUBMISSION_TYPE,
                            {submission_id: submission_data}),
             ProxyOperation(ProxyExecutor.SUBCHANGE_TYPE,
-                           {subchange_id: subchange_data})]
+                           {subchange_id: subchange_data},
+                           ("scores", submission.id, version))]
 
     def operations_for_token(self, submission):
         """Send the token for the given submission to all rankings.
@@ -411,13 +727,15 @@ class ProxyService(TriggeredService):
             "time": int(make_timestamp(submission.token.timestamp)),
             "token": True}
 
-        self.tokens_sent_to_rankings.add(submission.id)
+        version = data_version(make_timestamp(submission.token.timestamp))
+        self.tokens_sent_to_rankings[submission.id] = version
 
         return [
             ProxyOperation(ProxyExecutor.SUBMISSION_TYPE,
                            {submission_id: submission_data}),
             ProxyOperation(ProxyExecutor.SUBCHANGE_TYPE,
-                           {subchange_id: subchange_data})]
+                           {subchange_id: subchange_data},
+                           ("tokens", submission.id, version))]
 
     @rpc_method
     def reinitialize(self):
@@ -425,11 +743,23 @@ class ProxyService(TriggeredService):
 
         This method is usually called via RPC when someone knows that
         some basic data (i.e. contest, tasks or users) changed and
-        rankings need to be updated.
+        rankings need to be updated. As the rankings may then have
+        lost the scores and tokens too (e.g. one wiped or replaced at
+        the same URL), what they acknowledged is forgotten and all of
+        it is sent again.
 
         """
         logger.info("Reinitializing rankings.")
+        # Cleared in place, the executors' callbacks hold these dicts.
+        for acknowledged in self.acknowledged.itervalues():
+            for versions in acknowledged.itervalues():
+                versions.clear()
+        self.scores_sent_to_rankings.clear()
+        self.tokens_sent_to_rankings.clear()
+        self._watermark_changed = True
+        self.save_watermark()
         self.initialize()
+        self.search_operations_not_done()
 
     @rpc_method
     def submission_scored(self, submission_id):
@@ -456,6 +786,10 @@ class ProxyService(TriggeredService):
                             "not sent because user is hidden.", submission_id)
                 return
 
+            # The rankings have an outdated score until they receive
+            # the new one.
+            self.forget_scores([submission.id])
+
             # Update RWS.
             for operation in self.operations_for_score(submission):
                 self.enqueue(operation)
@@ -509,8 +843,13 @@ class ProxyService(TriggeredService):
             logger.info("Dataset update for task %d (dataset now is %d).",
                         task.id, dataset.id)
 
-            # max_score and/or extra_headers might have changed.
-            self.reinitialize()
+            # max_score and/or extra_headers might have changed; the
+            # rest the rankings have is still valid.
+            self.initialize()
+
+            # The rankings have the scores on the old dataset.
+            self.forget_scores(
+                [submission.id for submission in task.submissions])
 
             for submission in task.submissions:
                 # Update RWS.
@@ -31,10 +31,13 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import logging
+from collections import OrderedDict
 
-from cms import ServiceCoord, config
+from cms import ServiceCoord, config, get_service_shards
 from cms.io import Executor, QueueItem, TriggeredService, rpc_method
-from cms.db import SessionGen, Submission, Dataset, TaskScore, SubmissionResult
+from cms.db import SessionGen, Submission, Dataset, TaskScore, \
+    SubmissionResult, Testcase
+from cms.grading import SCORE_DETAILS_VERSION, render_score_details
 from cms.grading.scoretypes import get_score_type
 from cms.service import get_submission_results
 
@@ -57,9 +60,55 @@ class ScoringOperation(QueueItem):
 
 
 class ScoringExecutor(Executor):
-    def __init__(self, proxy_service):
+    # Maximum number of datasets whose ScoreType is kept in memory.
+    SCORE_TYPE_CACHE_SIZE = 100
+
+    def __init__(self, proxy_service, practice_web_servers=()):
         super(ScoringExecutor, self).__init__()
         self.proxy_service = proxy_service
+        self.practice_web_servers = practice_web_servers
+
+        # For each dataset id, the version of the dataset it was built
+        # from (see _get_dataset_version) and the ScoreType, from the
+        # least to the most recently used.
+        self._score_types = OrderedDict()
+
+    @staticmethod
+    def _get_dataset_version(dataset):
+        """Return all the data the ScoreType of a dataset depends on.
+
+        That is, the name and parameters of the score type and the
+        codenames and public flags of the testcases. Only the columns
+        needed are loaded, not whole Testcase objects.
+
+        dataset (Dataset): the dataset.
+
+        return (object): something that changes if the ScoreType has
+            to be rebuilt.
+
+        """
+        testcases = dataset.sa_session\
+            .query(Testcase.codename, Testcase.public)\
+            .filter(Testcase.dataset_id == dataset.id)\
+            .order_by(Testcase.codename).all()
+        return (dataset.score_type, dataset.score_type_parameters, testcases)
+
+    def _get_score_type(self, dataset):
+        """Return the ScoreType of a dataset, from the cache if valid.
+
+        dataset (Dataset): the dataset.
+
+        return (ScoreType): its score type.
+
+        """
+        version = self._get_dataset_version(dataset)
+        entry = self._score_types.pop(dataset.id, None)
+        if entry is None or entry[0] != version:
+            entry = (version, get_score_type(dataset=dataset))
+        self._score_types[dataset.id] = entry
+        while len(self._score_types) > self.SCORE_TYPE_CACHE_SIZE:
+            self._score_types.popitem(last=False)
+        return entry[1]
 
     def execute(self, entry):
         """Assign a score to a submission result.
@@ -108,8 +157,9 @@ class ScoringExecutor(Executor):
                                      (operation.submission_id,
                                       operation.dataset_id))
 
-            # Instantiate the score type.
-            score_type = get_score_type(dataset=dataset)
+            # Obtain the score type (instantiating it only if the
+            # dataset changed since the last time).
+            score_type = self._get_score_type(dataset)
 
             # Compute score and fill it in the database.
             submission_result.score, \
@@ -122,6 +172,20 @@ class ScoringExecutor(Executor):
             # Round submission score to 2 decimal places
             submission_result.score = round(submission_result.score, 2)
 
+            # Store the details as shown to the users, so that they
+            # do not need to be processed on each request.
+            try:
+                submission_result.rendered_score_details = \
+                    render_score_details(submission_result.score,
+                                         submission_result.score_details)
+                submission_result.rendered_score_details_version = \
+                    SCORE_DETAILS_VERSION
+            except Exception:
+                logger.warning("Cannot render the score details of "
+                               "submission result %d(%d).",
+                               operation.submission_id,
+                               operation.dataset_id, exc_info=True)
+
             # Store it.
             session.commit()
 
@@ -161,10 +225,15 @@ class ScoringExecutor(Executor):
                 .filter(TaskScore.task_id == submission.task_id).count()
             session.commit()
 
-            # If dataset is the active one, update RWS.
+            # If dataset is the active one, update RWS and the pages
+            # of the user.
             if dataset is submission.task.active_dataset:
                 self.proxy_service.submission_scored(
                     submission_id=submission.id)
+                for practice_web_server in self.practice_web_servers:
+                    practice_web_server.submission_updated(
+                        submission_id=submission.id,
+                        user_id=submission.user_id)
 
 
 class ScoringService(TriggeredService):
@@ -192,7 +261,14 @@ class ScoringService(TriggeredService):
             ServiceCoord("ProxyService", 0),
             must_be_present=ranking_enabled)
 
-        self.add_executor(ScoringExecutor(self.proxy_service))
+        # Set up communication with PracticeWebServers, to push the
+        # new scores to the users.
+        self.practice_web_servers = [
+            self.connect_to(ServiceCoord("PracticeWebServer", i))
+            for i in xrange(get_service_shards("PracticeWebServer"))]
+
+        self.add_executor(ScoringExecutor(self.proxy_service,
+                                          self.practice_web_servers))
         self.start_sweeper(347.0)
 
     def _missing_operations(self):
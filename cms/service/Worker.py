@@ -29,13 +29,15 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import logging
+from collections import OrderedDict
 
 import gevent.coros
 
 from cms.io import Service, rpc_method
 from cms.db import SessionGen, Contest
 from cms.db.filecacher import FileCacher
-from cms.grading import JobException
+from cms.grading import JobException, storage_white_diff_digest
+from cms.grading.Sandbox import abort_executions, allow_executions
 from cms.grading.tasktypes import get_task_type
 from cms.grading.Job import JobGroup
 
@@ -54,6 +56,9 @@ class Worker(Service):
     JOB_TYPE_COMPILATION = "compile"
     JOB_TYPE_EVALUATION = "evaluate"
 
+    # Maximum number of TaskType objects kept in memory.
+    TASK_TYPE_CACHE_SIZE = 100
+
     def __init__(self, shard):
         Service.__init__(self, shard)
         self.file_cacher = FileCacher(self)
@@ -61,22 +66,51 @@ class Worker(Service):
         self.work_lock = gevent.coros.RLock()
         self._ignore_job = False
 
+        # TaskType objects, indexed by their name and (JSON-encoded)
+        # parameters, which fully determine them, from the least to
+        # the most recently used.
+        self._task_types = OrderedDict()
+
+    def _get_task_type(self, name, parameters):
+        """Return a TaskType object, from the cache if possible.
+
+        name (unicode): the name of the TaskType class.
+        parameters (unicode): the JSON-encoded parameters.
+
+        return (TaskType): an instance of the TaskType.
+
+        """
+        key = (name, parameters)
+        task_type = self._task_types.pop(key, None)
+        if task_type is None:
+            task_type = get_task_type(name, parameters)
+        self._task_types[key] = task_type
+        while len(self._task_types) > self.TASK_TYPE_CACHE_SIZE:
+            self._task_types.popitem(last=False)
+        return task_type
+
     @rpc_method
     def ignore_job(self):
         """RPC that inform the worker that its result for the current
         action will be discarded. The worker will try to return as
         soon as possible even if this means that the result are
-        inconsistent.
+        inconsistent: the processes running in the sandboxes are
+        stopped, so that the worker is free again right away.
 
         """
         # We remember to quit as soon as possible.
         logger.info("Trying to interrupt job as requested.")
         self._ignore_job = True
+        abort_executions()
 
     @rpc_method
     def precache_files(self, contest_id):
         """RPC to ask the worker to precache of files in the contest.
 
+        The white diff digests of the reference outputs of the active
+        datasets are computed too, so that outputs can be checked just
+        by hashing them.
+
         contest_id (int): the id of the contest
 
         """
@@ -89,6 +123,11 @@ class Worker(Service):
             contest = Contest.get_from_id(contest_id, session)
             files = contest.enumerate_files(skip_submissions=True,
                                             skip_user_tests=True)
+            outputs = set(testcase.output
+                          for task in contest.tasks
+                          if task.active_dataset is not None
+                          for testcase in
+                          task.active_dataset.testcases.itervalues())
         for digest in files:
             try:
                 self.file_cacher.load(digest, if_needed=True)
@@ -96,6 +135,11 @@ class Worker(Service):
                 # No problem (at this stage) if we cannot find the
                 # file
                 pass
+        for digest in outputs:
+            try:
+                storage_white_diff_digest(self.file_cacher, digest)
+            except KeyError:
+                pass
 
         logger.info("Precaching finished.")
 
@@ -114,6 +158,7 @@ class Worker(Service):
 
             try:
                 self._ignore_job = False
+                allow_executions()
 
                 for k, job in job_group.jobs.iteritems():
                     logger.info("Starting job.",
@@ -125,15 +170,8 @@ class Worker(Service):
                     # The only TaskType that needs it is OutputOnly.
                     job._key = k
 
-                    # FIXME We're creating a new TaskType for each Job
-                    # even if, at the moment, a JobGroup always uses
-                    # the same TaskType and the same parameters. Yet,
-                    # this could change in the future, so the best
-                    # solution is to keep a cache of TaskTypes objects
-                    # (like ScoringService does with ScoreTypes, except
-                    # that we cannot index by Dataset ID here...).
-                    task_type = get_task_type(job.task_type,
-                                              job.task_type_parameters)
+                    task_type = self._get_task_type(
+                        job.task_type, job.task_type_parameters)
                     task_type.execute_job(job, self.file_cacher)
 
                     logger.info("Finished job.",
@@ -148,6 +186,13 @@ class Worker(Service):
                 return job_group.export_to_dict()
 
             except:
+                if self._ignore_job:
+                    # Failures are expected after the sandboxed
+                    # processes have been stopped, and the result is
+                    # going to be discarded anyway.
+                    logger.info("Job aborted.", exc_info=True)
+                    job_group.success = False
+                    return job_group.export_to_dict()
                 err_msg = "Worker failed."
                 logger.error(err_msg, exc_info=True)
                 raise JobException(err_msg)
@@ -158,7 +203,7 @@ class Worker(Service):
         else:
             err_msg = "Request received, but declined because of acquired " \
                 "lock (Worker is busy executing another job group, this " \
-                "should not happen: check if there are more than one ES " \
-                "running, or for bugs in ES."
+                "should not happen: check if there are more ES using this " \
+                "worker running, or for bugs in ES."
             logger.warning(err_msg)
             raise JobException(err_msg)
@@ -27,6 +27,7 @@ from __future__ import unicode_literals
 
 import logging
 
+from cms import config, get_service_shards
 from cms.db import SessionGen, User, Task, Submission, SubmissionResult
 
 
@@ -62,6 +63,79 @@ def get_submissions(contest_id=None, user_id=None, task_id=None,
             return get_submissions(
                 contest_id, user_id, task_id, submission_id, session)
 
+    return _filter_submissions(session.query(Submission), contest_id,
+                               user_id, task_id, submission_id).all()
+
+
+def get_submission_ids(contest_id=None, user_id=None, task_id=None,
+                       submission_id=None, session=None, task_ids=None):
+    """Search for the ids of the submissions that match the given
+    criteria, without loading the submissions.
+
+    See get_submissions for the meaning of the arguments.
+
+    task_ids ([int]|None): ids of the tasks the submissions must
+        belong to, or None.
+
+    return ([int]): the sorted list of the ids of the submissions
+        that match the given criteria.
+
+    """
+    if session is None:
+        with SessionGen() as session:
+            return get_submission_ids(
+                contest_id, user_id, task_id, submission_id, session,
+                task_ids)
+
+    if task_ids is not None and len(task_ids) == 0:
+        return []
+
+    query = _filter_submissions(session.query(Submission.id), contest_id,
+                                user_id, task_id, submission_id)
+    if task_ids is not None:
+        query = query.filter(Submission.task_id.in_(task_ids))
+    return [id_ for id_, in query.order_by(Submission.id)]
+
+
+def get_evaluation_service_shard(task_id):
+    """Return the shard of EvaluationService judging the submissions
+    and user tests of a task.
+
+    task_id (int): the id of the task.
+
+    return (int): the shard of EvaluationService.
+
+    """
+    return task_id % max(1, get_service_shards("EvaluationService"))
+
+
+def get_worker_evaluation_service_shard(worker_shard):
+    """Return the shard of EvaluationService a worker serves: the
+    workers are partitioned between them, as configured in
+    worker_evaluation_service_shards or else by their shard modulo
+    the number of shards of EvaluationService.
+
+    worker_shard (int): the shard of the worker.
+
+    return (int): the shard of EvaluationService.
+
+    """
+    shards = config.worker_evaluation_service_shards
+    if shards is not None and worker_shard < len(shards):
+        return shards[worker_shard]
+    return worker_shard % max(1, get_service_shards("EvaluationService"))
+
+
+def _filter_submissions(query, contest_id, user_id, task_id, submission_id):
+    """Filter a query on the submissions with the given criteria.
+
+    See get_submissions for the meaning of the arguments.
+
+    query (Query): a query on the submissions.
+
+    return (Query): the filtered query.
+
+    """
     if task_id is not None and contest_id is not None:
         raise ValueError("contest_id is superfluous if task_id is given")
     if user_id is not None and contest_id is not None:
@@ -73,7 +147,6 @@ def get_submissions(contest_id=None, user_id=None, task_id=None,
     if submission_id is not None and user_id is not None:
         raise ValueError("user_id is superfluous if submission_id is given")
 
-    query = session.query(Submission)
     if submission_id is not None:
         query = query.filter(Submission.id == submission_id)
     if user_id is not None:
@@ -83,7 +156,7 @@ def get_submissions(contest_id=None, user_id=None, task_id=None,
     if contest_id is not None:
         query = query.join(User).filter(User.contest_id == contest_id)\
             .join(Task).filter(Task.contest_id == contest_id)
-    return query.all()
+    return query
 
 
 def get_submission_results(contest_id=None, user_id=None, task_id=None,
@@ -27,7 +27,60 @@ angular.module('pws.tasks', ['pws.pagination'])
     var updInterval = {};
     var updAttempts = {};
     var timeout;
-    this.load = function(name) {
+    // The server pushes the changes of the submissions of the user
+    // on an event stream; polling is used only if the browser does
+    // not support it.
+    var source = null;
+    var sourceUser = null;
+    function listen() {
+      if (typeof EventSource === 'undefined' || !userManager.isLogged())
+        return false;
+      var user = userManager.getUser();
+      // The credentials are sent in cookies, which are kept up to date
+      // for the reconnections, rather than in the URL, which is logged.
+      var url = document.createElement('a');
+      url.href = 'events';
+      var attributes = '; path=' + url.pathname +
+          (location.protocol === 'https:' ? '; secure' : '');
+      document.cookie = 'events_username=' +
+          encodeURIComponent(user.username) + attributes;
+      document.cookie = 'events_token=' +
+          encodeURIComponent(user.token) + attributes;
+      if (source !== null && sourceUser === user.username)
+        return true;
+      if (source !== null)
+        source.close();
+      sourceUser = user.username;
+      source = new EventSource('events');
+      var opened = false;
+      source.addEventListener('open', function(event) {
+        // Changes that happened before we subscribed were not pushed.
+        if (opened)
+          return;
+        opened = true;
+        $rootScope.$apply(function() {
+          for (var name in $rootScope.submissions)
+            reload(name);
+        });
+      });
+      source.addEventListener('submission', function(event) {
+        $rootScope.$apply(function() {
+          var data = JSON.parse(event.data);
+          replaceSub(data['id'], data);
+          if ($rootScope.curSub == data['id'])
+            subDetails(data['id']);
+        });
+      });
+      source.addEventListener('reinit', function(event) {
+        // Some events were lost: reload everything.
+        $rootScope.$apply(function() {
+          for (var name in $rootScope.submissions)
+            reload(name);
+        });
+      });
+      return true;
+    }
+    function reload(name) {
       $http.post('submission', {
         'username': userManager.getUser().username,
         'token': userManager.getUser().token,
@@ -42,8 +95,12 @@ angular.module('pws.tasks', ['pws.pagination'])
       .error(function(data, status, headers, config) {
         notificationHub.serverError(status);
       });
+    }
+    this.load = function(name) {
+      reload(name);
       $timeout.cancel(timeout);
-      updSubs();
+      if (!listen())
+        updSubs();
     };
     function intervalFromAttempts(i) {
       if (i<10 || i==undefined)
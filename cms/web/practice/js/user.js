@@ -62,6 +62,8 @@ angular.module('pws.user', [])
             } else {
               var user = getIt();
               user.unreadtalks = data.unreadtalks;
+              if (data.hasOwnProperty('token'))
+                user.token = data.token;
               localStorage.setItem('user', JSON.stringify(user));
             }
           }).error(function(data, status, headers, config) {
@@ -104,6 +106,11 @@ angular.module('pws.user', [])
       },
       signout: function() {
         localStorage.removeItem('user');
+      },
+      setToken: function(token) {
+        var user = getIt();
+        user.token = token;
+        localStorage.setItem('user', JSON.stringify(user));
       }
     };
   })
@@ -392,7 +399,7 @@ angular.module('pws.user', [])
         .success(function(data, status, headers, config) {
           if (data.success == 1) {
             if (data.hasOwnProperty('token'))
-              localStorage.setItem('token', data['token']);
+              userManager.setToken(data['token']);
             notificationHub.createAlert('success', l10n.get('Changes recorded'), 2);
             $state.go('^.profile');
           } else if (data.success == 0) {
@@ -23,17 +23,16 @@ from __future__ import unicode_literals
 
 import re
 import time
-from collections import deque
 from weakref import WeakSet
 
 import six
 
 from gevent import Timeout
-from gevent.queue import Queue, Empty
+from gevent.event import Event
 from gevent.pywsgi import WSGIHandler
 
 from werkzeug.wrappers import Request
-from werkzeug.exceptions import NotAcceptable
+from werkzeug.exceptions import HTTPException, NotAcceptable
 
 
 __all__ = [
@@ -42,6 +41,11 @@ __all__ = [
     ]
 
 
+# Sent to the clients that missed some events, to make them reload
+# their whole state.
+REINIT_FRAME = b"event:reinit\n\n"
+
+
 def format_event(id_, event, data):
     """Format the parameters to be sent on an event stream.
 
@@ -88,9 +92,13 @@ class Publisher(object):
 
     Publish-subscribe is actually an improper name, as there's just one
     "topic", making it a simple broadcast system. The publisher class
-    is responsible for receiving messages to be sent, keeping them in
-    a cache for a while, instantiating subscribers, each with its own
-    queue, and pushing new messages to all these queues.
+    is responsible for receiving messages to be sent, encoding them
+    once and keeping them in a ring buffer for a while, and
+    instantiating subscribers, each of which is just a cursor in that
+    buffer. Publishing a message thus costs the same regardless of the
+    number of subscribers, and a slow subscriber cannot make the
+    memory usage grow: if it falls behind by more than the size of the
+    buffer it's asked to reinit and moved to the most recent message.
 
     """
     def __init__(self, size):
@@ -99,31 +107,111 @@ class Publisher(object):
         size (int): the number of messages to keep in cache.
 
         """
-        # We use a deque as it's efficient to add messages to one end
-        # and have the ones at the other end be dropped when the total
-        # number exceeds the given limit.
-        self._cache = deque(maxlen=size)
-        # We use a WeakSet as we want queues to be vanish automatically
-        # when no one else is using (i.e. fetching from) them.
-        self._sub_queues = WeakSet()
-
-    def put(self, event, data):
+        self._size = size
+        # The message with sequence number n (counting from zero all
+        # the messages ever put) is at position n % size of the ring
+        # buffer, together with its key. Keys are strictly increasing,
+        # which allows to binary search them.
+        self._keys = [None] * size
+        self._frames = [None] * size
+        self._next = 0
+        self._last_key = 0
+        # Set (and replaced) when a message is put, to wake up the
+        # subscribers waiting for it.
+        self._new_message = Event()
+        # We use a WeakSet as we want subscribers to be vanish
+        # automatically when no one else is using them.
+        self._subscribers = WeakSet()
+
+        # Metrics, see get_stats.
+        self._bytes = 0
+        self._buffered_bytes = 0
+        self._delivered = 0
+        self._reinits = 0
+
+    def put(self, event, data, key=None):
         """Dispatch a new item to all subscribers.
 
         See format_event for details about the parameters.
 
         event (unicode): the type of event the client will receive.
         data (unicode): the associated data.
+        key (int|None): the key of the message, from which its ID is
+            made; publishers that must give the same IDs to the same
+            messages (e.g. in different processes) pass it. If not
+            given, the clock is used.
 
         """
-        # Number of microseconds since epoch.
-        key = int(time.time() * 1000000)
+        # Number of microseconds since epoch if not given, anyway
+        # greater than the one of the last message.
+        if key is None:
+            key = int(time.time() * 1000000)
+        key = max(key, self._last_key + 1)
         msg = format_event("%x" % key, event, data)
-        # Put into cache.
-        self._cache.append((key, msg))
-        # Send to all subscribers.
-        for queue in self._sub_queues:
-            queue.put(msg)
+        # Put into the ring buffer, in place of the oldest message.
+        pos = self._next % self._size
+        if self._frames[pos] is not None:
+            self._buffered_bytes -= len(self._frames[pos])
+        self._keys[pos] = key
+        self._frames[pos] = msg
+        self._next += 1
+        self._last_key = key
+        self._bytes += len(msg)
+        self._buffered_bytes += len(msg)
+        # Wake up the subscribers.
+        new_message, self._new_message = self._new_message, Event()
+        new_message.set()
+
+    def _first(self):
+        """Return the sequence number of the oldest cached message.
+
+        """
+        return max(0, self._next - self._size)
+
+    def _find(self, key):
+        """Return the sequence number of the first cached message with
+        a key greater than the given one.
+
+        key (int): a key.
+
+        return (int): a sequence number.
+
+        """
+        low, high = self._first(), self._next
+        while low < high:
+            mid = (low + high) // 2
+            if self._keys[mid % self._size] > key:
+                high = mid
+            else:
+                low = mid + 1
+        return low
+
+    def wait(self, cursor):
+        """Block until there are messages after the given one.
+
+        cursor (int): the sequence number of the next message to read.
+
+        """
+        while cursor >= self._next:
+            self._new_message.wait()
+
+    def read(self, cursor):
+        """Return the messages from the given one on.
+
+        cursor (int): the sequence number of the next message to read.
+
+        return (([bytes], int)): the messages, possibly just a request
+            to reinit if some of them have already been dropped, and
+            the sequence number of the next message to read.
+
+        """
+        if cursor < self._first():
+            self._reinits += 1
+            return [REINIT_FRAME], self._next
+        frames = list(self._frames[i % self._size]
+                      for i in xrange(cursor, self._next))
+        self._delivered += len(frames)
+        return frames, self._next
 
     def get_subscriber(self, last_event_id=None):
         """Obtain a new subscriber.
@@ -139,23 +227,52 @@ class Publisher(object):
         return (Subscriber): a new subscriber instance.
 
         """
-        queue = Queue()
+        cursor = self._next
+        reinit = False
         # If a valid last_event_id is provided see if cache can supply
         # missed events.
         if last_event_id is not None and \
                 re.match("^[0-9A-Fa-f]+$", last_event_id):
             last_event_key = int(last_event_id, 16)
-            if len(self._cache) > 0 and last_event_key >= self._cache[0][0]:
+            first = self._first()
+            if self._next > first and \
+                    last_event_key >= self._keys[first % self._size]:
                 # All missed events are in cache.
-                for key, msg in self._cache:
-                    if key > last_event_key:
-                        queue.put(msg)
+                cursor = self._find(last_event_key)
             else:
                 # Some events may be missing. Ask to reinit.
-                queue.put(b"event:reinit\n\n")
-        # Store the queue and return a subscriber bound to it.
-        self._sub_queues.add(queue)
-        return Subscriber(queue)
+                reinit = True
+        subscriber = Subscriber(self, cursor, reinit)
+        self._subscribers.add(subscriber)
+        return subscriber
+
+    def has_subscribers(self):
+        """Return whether someone is listening to this publisher.
+
+        return (bool): True if at least one subscriber is alive.
+
+        """
+        return len(self._subscribers) > 0
+
+    def get_stats(self):
+        """Return the metrics of this publisher.
+
+        return (dict): the number of subscribers alive ("subscribers"),
+            of messages put ("messages") and of their bytes ("bytes"),
+            the bytes kept in the ring buffer ("buffered_bytes"), the
+            messages sent to subscribers ("delivered") and the number
+            of times a subscriber lagged behind and was asked to
+            reinit ("reinits").
+
+        """
+        return {
+            "subscribers": len(self._subscribers),
+            "messages": self._next,
+            "bytes": self._bytes,
+            "buffered_bytes": self._buffered_bytes,
+            "delivered": self._delivered,
+            "reinits": self._reinits,
+        }
 
 
 class Subscriber(object):
@@ -165,39 +282,45 @@ class Subscriber(object):
     it.
 
     """
-    def __init__(self, queue):
+    def __init__(self, publisher, cursor, reinit=False):
         """Create a new subscriber.
 
-        Make it wait for messages on the given queue, managed by the
-        Publisher.
+        Make it read the messages of the given publisher, from the
+        given one on.
 
-        queue (Queue): a message queue.
+        publisher (Publisher): the publisher.
+        cursor (int): the sequence number of the next message to read.
+        reinit (bool): whether to first ask the client to reinit.
 
         """
-        self._queue = queue
+        self._pub = publisher
+        self._cursor = cursor
+        self._reinit = reinit
 
     def get(self):
         """Retrieve new messages.
 
         Obtain all messages that were put in the associated publisher
         since this method was last called, or (on the first call) since
-        the last_event_id given to get_subscriber.
+        the last_event_id given to get_subscriber. If some of them have
+        already been removed from the cache, a request to reinit is
+        obtained instead, and the following calls will get the newer
+        messages.
 
         return ([objects]): the items put in the publisher, in order
             (actually, returns a generator, not a list).
 
-        raise (OutdatedError): if some of the messages it's supposed to
-            retrieve have already been removed from the cache.
-
         """
         # Block until we have something to do.
-        self._queue.peek()
+        if self._reinit:
+            self._reinit = False
+            yield REINIT_FRAME
+        else:
+            self._pub.wait(self._cursor)
         # Fetch all items that are immediately available.
-        try:
-            while True:
-                yield self._queue.get_nowait()
-        except Empty:
-            pass
+        frames, self._cursor = self._pub.read(self._cursor)
+        for frame in frames:
+            yield frame
 
 
 class EventSource(object):
@@ -227,7 +350,7 @@ class EventSource(object):
         """
         self._pub = Publisher(self._CACHE_SIZE)
 
-    def send(self, event, data):
+    def send(self, event, data, key=None):
         """Send the event to the stream.
 
         Intended for subclasses to push new events to clients. See
@@ -235,9 +358,37 @@ class EventSource(object):
 
         event (unicode): the type of the event.
         data (unicode): the data of the event.
+        key (int|None): the key of the event (see Publisher.put).
+
+        """
+        self._pub.put(event, data, key)
+
+    def get_publisher(self, request):
+        """Return the publisher whose events a request will receive.
+
+        Subclasses can override this to send different events to
+        different clients, or to refuse a request by raising an
+        HTTPException.
+
+        request (Request): the request of the client.
+
+        return (Publisher): the publisher to subscribe to.
+
+        raise (HTTPException): if the request should be refused.
 
         """
-        self._pub.put(event, data)
+        return self._pub
+
+    def get_stats(self):
+        """Return the metrics of the events sent.
+
+        Subclasses using other publishers than the default one should
+        override this.
+
+        return (dict): see Publisher.get_stats.
+
+        """
+        return self._pub.get_stats()
 
     def __call__(self, environ, start_response):
         """Execute this instance as a WSGI application.
@@ -305,6 +456,12 @@ class EventSource(object):
         if request.accept_mimetypes.quality(b"text/event-stream") <= 0:
             return NotAcceptable()(environ, start_response)
 
+        # Find out which events this client has to receive.
+        try:
+            pub = self.get_publisher(request)
+        except HTTPException as error:
+            return error(environ, start_response)
+
         # Initialize the response and get the write() callback. The
         # Cache-Control header is useless for conforming clients, as
         # the spec. already imposes that behavior on them, but we set
@@ -352,7 +509,7 @@ class EventSource(object):
                                              type=lambda x: x.decode('utf-8'))
 
         # We subscribe to the publisher to receive events.
-        sub = self._pub.get_subscriber(last_event_id)
+        sub = pub.get_subscriber(last_event_id)
 
         # Send some data down the pipe. We need that to make the user
         # agent announces the connection (see the spec.). Since it's a
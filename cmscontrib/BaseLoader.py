@@ -25,6 +25,163 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import io
+import json
+import logging
+import os
+
+import gevent.pool
+import gevent.threadpool
+
+from cmscontrib import sha1sum
+
+
+logger = logging.getLogger(__name__)
+
+
+class FileUploader(object):
+    """Store many files in a FileCacher at once.
+
+    Files are added by path: their digest is computed (in parallel,
+    when many are added together) and returned immediately, while the
+    actual storing is delayed until upload() is called. There, the
+    storage is asked in one go which files it has already, and only
+    the missing ones are sent, concurrently.
+
+    Optionally, the digests are remembered in a file, together with
+    the size and the modification time of the files they belong to,
+    so that unchanged files are not even read again the next time.
+
+    """
+
+    def __init__(self, file_cacher, cache_path=None, workers=8):
+        """Initialize the uploader.
+
+        file_cacher (FileCacher): the file cacher to store files into.
+        cache_path (string|None): the file where to remember the
+            digests, or None not to remember them.
+        workers (int): how many files to hash, and to send, at the
+            same time.
+
+        """
+        self.file_cacher = file_cacher
+        self.cache_path = cache_path
+        self.workers = workers
+
+        # Map from each path to (mtime, size, digest).
+        self.digests = dict()
+        if self.cache_path is not None:
+            try:
+                with io.open(self.cache_path, "rb") as fin:
+                    self.digests = dict(
+                        (path, tuple(value))
+                        for path, value in json.load(fin).iteritems())
+            except (IOError, ValueError):
+                pass
+
+        # Map from each digest to be stored to (path, description).
+        self.pending = dict()
+
+    def _digest(self, path):
+        """Return the digest of a file, hashing it only if needed.
+
+        path (string): the path of the file.
+
+        return (unicode): the digest of the file.
+
+        """
+        stat = os.stat(path)
+        cached = self.digests.get(path)
+        if cached is not None and \
+                cached[:2] == (stat.st_mtime, stat.st_size):
+            return cached[2]
+        digest = sha1sum(path).decode("ascii")
+        self.digests[path] = (stat.st_mtime, stat.st_size, digest)
+        return digest
+
+    def add(self, path, desc=""):
+        """Add a file to be stored.
+
+        path (string): the path of the file.
+        desc (unicode): the description of the file.
+
+        return (unicode): the digest of the file.
+
+        """
+        return self.add_many([(path, desc)])[0]
+
+    def add_many(self, files):
+        """Add many files to be stored, hashing them in parallel.
+
+        files ([(string, unicode)]): the paths and descriptions of the
+            files.
+
+        return ([unicode]): the digests of the files, in order.
+
+        """
+        # Real threads, as hashing doesn't yield to other greenlets
+        # (but it releases the GIL).
+        pool = gevent.threadpool.ThreadPool(self.workers)
+        try:
+            digests = pool.map(self._digest, [path for path, _ in files])
+        finally:
+            pool.kill()
+        for (path, desc), digest in zip(files, digests):
+            self.pending.setdefault(digest, (path, desc))
+        return digests
+
+    def upload(self):
+        """Store the files added so far that are not stored yet.
+
+        raise (RuntimeError): if a file could not be stored, or
+            changed after being added.
+
+        """
+        missing = set(self.pending) - \
+            self.file_cacher.filter_existing(self.pending.keys())
+        logger.info("Storing %d files (%d were already stored).",
+                    len(missing), len(self.pending) - len(missing))
+
+        def _put(digest):
+            """Store a file, returning whether it went well."""
+            path, desc = self.pending[digest]
+            try:
+                stored_digest = self.file_cacher.put_file_from_path(path,
+                                                                    desc)
+            except Exception:
+                logger.error("Cannot store file %s.", path, exc_info=True)
+                return False
+            if stored_digest != digest:
+                logger.error("File %s changed while importing.", path)
+                # Forget the digest, so the file is hashed again next
+                # time.
+                self.digests.pop(path, None)
+                return False
+            return True
+
+        pool = gevent.pool.Pool(self.workers)
+        try:
+            success = all(pool.imap_unordered(_put, sorted(missing)))
+        finally:
+            pool.kill()
+            self.pending = dict()
+            self._save_digests()
+        if not success:
+            raise RuntimeError("Some files could not be stored.")
+
+    def _save_digests(self):
+        """Write the known digests to the cache file, if any.
+
+        """
+        if self.cache_path is None:
+            return
+        try:
+            with io.open(self.cache_path, "wb") as fout:
+                json.dump(self.digests, fout)
+        except IOError:
+            logger.warning("Cannot write the digests cache %s.",
+                           self.cache_path, exc_info=True)
+
 
 class Loader(object):
     """Base class for deriving loaders.
@@ -40,11 +40,14 @@ from __future__ import unicode_literals
 import argparse
 import imp
 import io
+import json
+import multiprocessing
 import numpy
 import sys
 
 from cms import utf8_decoder
-from cms.db import SessionGen, Task
+from cms.db import SessionGen, Task, Submission, SubmissionResult, \
+    Evaluation, User
 from cms.db.filecacher import FileCacher
 
 
@@ -52,15 +55,29 @@ MAXP = 4
 MAXL = 1
 MAXE = 1
 
+# All the candidate models, as triples i, j, k, each standing for the
+# function x^i * log2(x)^j * (2^x)^k.
+MODELS = [(i, j, k)
+          for i in xrange(MAXP + 1)
+          for j in xrange(MAXL + 1)
+          for k in xrange(MAXE + 1)]
 
-def ijk_to_idx(i, j, k):
-    """Return the linear index associated to the triple i, j, k."""
-    return (MAXE + 1) * ((MAXL + 1) * i + j) + k
 
+def models_matrix(points_x):
+    """Evaluate all the models on the given points at once.
 
-def ijk_to_func(i, j, k):
-    """Return the function associated to the triple i, j, k."""
-    return lambda x: (x ** i) * (numpy.log2(x) ** j) * ((2 ** x) ** k)
+    points_x (numpy.ndarray): the x coordinates of the points.
+
+    return (numpy.ndarray): a matrix with a row for each model (in the
+        order of MODELS), and a column for each point.
+
+    """
+    exponents = numpy.array(MODELS, dtype=numpy.float64)
+    points_x = numpy.asarray(points_x, dtype=numpy.float64)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        return (points_x ** exponents[:, 0:1]) * \
+            (numpy.log2(points_x) ** exponents[:, 1:2]) * \
+            ((2 ** points_x) ** exponents[:, 2:3])
 
 
 class FileLengther(object):
@@ -130,172 +147,205 @@ def complexity_to_string(complexity):
     return string
 
 
-def extract_meaningful_points(testcases_lengths, submission):
+def extract_meaningful_points(testcases_lengths, evaluations):
     """Extract the meaningful points (consider the most expensive of
     the ones with common dimension, and throw away the ones without a
     time).
 
-    testcases_lengths ([float]): the dimensions of the testcases.
-    submission (Submission): the submission to grade.
+    testcases_lengths ({int: float}): the dimensions of the testcases,
+        indexed by their id.
+    evaluations ([(int, unicode, float)]): testcase id, outcome and
+        execution time of the evaluations of a submission.
 
-    return (([float], [float])): x and y coordinates of the points.
+    return (([float], [float])): x and y coordinates of the points,
+        sorted by x.
 
     """
-    points_x = []
-    points_y = []
-    last_length = -1
-    for idx, length in enumerate(testcases_lengths):
-        evaluation = submission.evaluations[idx]
-        if float(evaluation.outcome) == 1.0 and \
-                evaluation.execution_time is not None:
-            if length == last_length:
-                points_y[-1] = max(points_y[-1], evaluation.execution_time)
-            else:
-                points_x.append(length)
-                points_y.append(evaluation.execution_time)
-                last_length = length
-    return points_x, points_y
-
-
-def extract_complexity_submission(testcases_lengths, submission):
-    """Extract the complexity of a submission, writing two files in
-    the cwd, sub_<id>.dat and sub_<id>.info. In the first, there are
-    three columns, X, Y, YP, where X is the dimension of the testcase,
-    Y is the time used by the submission and YP is the time predicted
-    by the complexity model; in the seconds, there are the
-    coefficients and the residues computed for all possible
-    complexities. The first can be plotted using gnuplot:
-
-    plot "sub_<id>.dat" using 1:2, "sub_<id>.dat" using 1:3;
-
-    testcases_lengths ([float]): the dimensions of the testcases.
-    submission (Submission): the submission to grade.
-
-    return ([float, (int), float]): score, tuple representing the
-                                    complexity, confidence.
+    times = dict()
+    for testcase_id, outcome, execution_time in evaluations:
+        if float(outcome) == 1.0 and execution_time is not None:
+            length = testcases_lengths[testcase_id]
+            times[length] = max(times.get(length, execution_time),
+                                execution_time)
+    points_x = sorted(times)
+    return points_x, [times[x] for x in points_x]
 
-    """
-    result = [None, None, None]
 
-    points_x, points_y = extract_meaningful_points(testcases_lengths,
-                                                   submission)
-    print(submission.user.username, len(points_x))
+def extract_complexity_submission(submission):
+    """Extract the complexity of a submission.
+
+    All the models are fitted at once: as each of them has a single
+    coefficient, the least squares solutions and their residues are
+    computed for all of them with a few matrix operations.
+
+    submission ((int, unicode, float, [float], [float])): id, username
+        and score of the submission, and x and y coordinates of its
+        meaningful points.
+
+    return (dict|None): the results for the submission (see
+        extract_complexity), or None if there are too few points to
+        tell.
+
+    """
+    submission_id, username, score, points_x, points_y = submission
     if len(points_x) <= 6:
-        return result
+        return None
 
     # Rescaling.
     x_scale = max(points_x)
-    points_x = [x * 1.0 / x_scale for x in points_x]
+    points_x = numpy.array(points_x, dtype=numpy.float64) / x_scale
     y_scale = max(points_y)
+    points_y = numpy.array(points_y, dtype=numpy.float64)
     if y_scale > 0:
-        points_y = [y * 1.0 / y_scale for y in points_y]
-
-    res = []
-    residues = []
-    best_residue = -1
-    best_idxs = (-1, -1, -1)
-    sbest_residue = -1
-
-    for i in xrange(MAXP + 1):
-        for j in xrange(MAXL + 1):
-            for k in xrange(MAXE + 1):
-                matrix = []
-                for point_x in points_x:
-                    matrix.append([ijk_to_func(i, j, k)(point_x)])
-                points_y = numpy.array(points_y)
-                matrix = numpy.vstack(matrix)
-                res.append(numpy.linalg.lstsq(matrix, points_y)[0][0])
-
-                residues.append(0.0)
-                for idx, point_y in enumerate(points_y):
-                    residues[-1] += (matrix[idx][0] * res[-1] - point_y) ** 2
-                if best_residue == -1 or best_residue > residues[-1]:
-                    sbest_residue = best_residue
-                    best_residue = residues[-1]
-                    best_idxs = (i, j, k)
-                elif sbest_residue == -1 or sbest_residue > residues[-1]:
-                    sbest_residue = residues[-1]
-
-    result[0] = submission.score
-    result[1] = best_idxs
-
-    with io.open("sub_%s.info" % submission.id,
-                 "wt", encoding="utf-8") as info:
-        for i in xrange(MAXP + 1):
-            for j in xrange(MAXL + 1):
-                for k in xrange(MAXE + 1):
-                    info.write(
-                        "%+20.13lf x^%d log^%d(x) (2^x)^%d  -->  %+20.13lf\n" %
-                        (res[ijk_to_idx(i, j, k)], i, j, k,
-                         residues[ijk_to_idx(i, j, k)]))
-        info.write("Complexity: %s\n" % complexity_to_string(best_idxs))
-        if sbest_residue != 0.0:
-            confidence = (100.0 * (1.0 - best_residue / sbest_residue))
-            info.write("Confidence: %5.2lf (%20.13lf, %20.13lf)\n" % (
-                confidence, best_residue, sbest_residue))
-            result[2] = confidence
-        if submission.score is not None:
-            info.write("Score: %3d\n" % submission.score)
-
-    computed_y = []
-    for point_x in points_x:
-        i, j, k = best_idxs
-        computed_y.append(ijk_to_func(i, j, k)(point_x) *
-                          res[ijk_to_idx(i, j, k)])
-
-    with io.open("sub_%s.dat" % submission.id, "wt", encoding="utf-8") as dat:
-        for point_x, point_y, computed_y in zip(points_x, points_y,
-                                                computed_y):
-            dat.write("%15.8lf %+15.8lf %+15.8lf\n" % (point_x * x_scale,
-                                                       point_y * y_scale,
-                                                       computed_y * y_scale))
-    print(submission.user.username, result)
-    return result
-
-
-def extract_complexity(task_id, file_lengther=None):
-    """Extract the complexity of all submissions of the task. The
-    results are stored in a file task_<id>.info
+        points_y /= y_scale
+
+    matrix = models_matrix(points_x)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        norms = numpy.einsum("ij,ij->i", matrix, matrix)
+        coefficients = matrix.dot(points_y) / norms
+    # Models that vanish, or are undefined, on the points get a null
+    # coefficient (as lstsq would do) and cannot be the best ones.
+    valid = numpy.isfinite(coefficients) & (norms > 0)
+    coefficients[~valid] = 0.0
+    residues = ((matrix * coefficients[:, numpy.newaxis] - points_y) ** 2)\
+        .sum(axis=1)
+    residues[~valid] = numpy.inf
+
+    best, second_best = numpy.argsort(residues, kind="mergesort")[:2]
+    best_residue = residues[best]
+    sbest_residue = residues[second_best]
+
+    confidence = None
+    if sbest_residue != 0.0:
+        confidence = 100.0 * (1.0 - best_residue / sbest_residue)
+
+    computed_y = matrix[best] * coefficients[best]
+
+    return {
+        "submission_id": submission_id,
+        "username": username,
+        "score": score,
+        "complexity": list(MODELS[best]),
+        "complexity_string": complexity_to_string(MODELS[best]),
+        "confidence": confidence,
+        "models": [{"complexity": list(model),
+                    "coefficient": float(coefficients[idx]),
+                    "residue": float(residues[idx])}
+                   for idx, model in enumerate(MODELS)],
+        "points": [[float(x * x_scale), float(y * y_scale),
+                    float(yp * y_scale)]
+                   for x, y, yp in zip(points_x, points_y, computed_y)],
+    }
+
+
+def load_submissions(session, dataset, testcases_lengths):
+    """Yield the data needed to extract the complexity of all the
+    evaluated submissions of the task, on the given dataset.
+
+    The evaluations are loaded with a single query, sorted by
+    submission, and not as ORM objects.
+
+    session (Session): the session to use.
+    dataset (Dataset): the dataset to consider.
+    testcases_lengths ({int: float}): the dimensions of the testcases,
+        indexed by their id.
+
+    yield ((int, unicode, float, [float], [float])): the arguments
+        for extract_complexity_submission.
+
+    """
+    submissions = session.query(Submission.id, User.username,
+                                SubmissionResult.score)\
+        .join(Submission.user)\
+        .join(SubmissionResult,
+              SubmissionResult.submission_id == Submission.id)\
+        .filter(Submission.task_id == dataset.task_id)\
+        .filter(SubmissionResult.dataset_id == dataset.id)\
+        .filter(SubmissionResult.filter_evaluated())\
+        .order_by(Submission.id).all()
+
+    evaluations = session.query(Evaluation.submission_id,
+                                Evaluation.testcase_id,
+                                Evaluation.outcome,
+                                Evaluation.execution_time)\
+        .join(Evaluation.submission)\
+        .filter(Submission.task_id == dataset.task_id)\
+        .filter(Evaluation.dataset_id == dataset.id)\
+        .order_by(Evaluation.submission_id)\
+        .yield_per(10000)
+
+    # Both lists are sorted by submission, we merge them.
+    evaluations = iter(evaluations)
+    evaluation = next(evaluations, None)
+    for submission_id, username, score in submissions:
+        submission_evaluations = []
+        while evaluation is not None and \
+                evaluation.submission_id <= submission_id:
+            if evaluation.submission_id == submission_id:
+                submission_evaluations.append(evaluation[1:])
+            evaluation = next(evaluations, None)
+        points_x, points_y = extract_meaningful_points(
+            testcases_lengths, submission_evaluations)
+        yield submission_id, username, score, points_x, points_y
+
+
+def extract_complexity(task_id, file_lengther=None, output=None,
+                       workers=None):
+    """Extract the complexity of all submissions of the task, on its
+    active dataset. The results are stored in the JSON file output
+    (by default, task_<id>.json): a list with, for each submission
+    with enough data, an object with its id, username and score, the
+    best complexity (as a triple and as a string) and its confidence,
+    the coefficient and residue of each candidate complexity, and the
+    points (dimension, time, time predicted by the best complexity).
 
     task_id (int): the id of the task we are interested in.
     file_lengther (type): a File-like object that tell the dimension
         of the input (see example above for how to write one).
+    output (unicode|None): the path of the output file.
+    workers (int|None): the number of processes to use (by default,
+        the number of CPUs).
 
     return (int): 0 if operation was successful.
 
     """
+    if output is None:
+        output = "task_%s.json" % task_id
+
     with SessionGen() as session:
         task = Task.get_from_id(task_id, session)
         if task is None:
             return -1
+        dataset = task.active_dataset
 
         # Extracting the length of the testcase.
         file_cacher = FileCacher()
-        testcases_lengths = [file_length(testcase.input,
-                                         file_cacher, file_lengther)
-                             for testcase in task.testcases]
+        testcases_lengths = dict(
+            (testcase.id, file_length(testcase.input,
+                                      file_cacher, file_lengther))
+            for testcase in dataset.testcases.itervalues())
         file_cacher.purge_cache()
 
         # Compute the complexity of the solutions.
-        with io.open("task_%s.info" % task_id, "wt", encoding="utf-8") as info:
-            for submission in task.contest.get_submissions():
-                if submission.task_id == task_id and \
-                        submission.evaluated():
-                    print(submission.user.username)
-                    result = extract_complexity_submission(testcases_lengths,
-                                                           submission)
-                    if result[1] is None:
-                        continue
-                    info.write("Submission: %s" % submission.id)
-                    info.write(" - user: %15s" % submission.user.username)
-                    info.write(" - task: %s" % task.name)
-                    if result[0] is not None:
-                        info.write(" - score: %6.2lf" % result[0])
-                    info.write(" - complexity: %20s" %
-                               complexity_to_string(result[1]))
-                    if result[2] is not None:
-                        info.write(" - confidence %5.1lf" % result[2])
-                    info.write("\n")
+        pool = multiprocessing.Pool(workers)
+        results = []
+        try:
+            for result in pool.imap(
+                    extract_complexity_submission,
+                    load_submissions(session, dataset, testcases_lengths),
+                    chunksize=100):
+                if result is None:
+                    continue
+                results.append(result)
+                if len(results) % 1000 == 0:
+                    print("Processed %d submissions." % len(results))
+        finally:
+            pool.terminate()
+
+    with io.open(output, "wb") as fout:
+        json.dump(results, fout, indent=1, sort_keys=True)
+    print("Written the complexity of %d submissions to %s." %
+          (len(results), output))
 
     return 0
 
@@ -311,6 +361,12 @@ def main():
     parser.add_argument("-l", "--lengther", action="store", type=utf8_decoder,
                         help="filename of a Python source "
                         "with a FileLengther class")
+    parser.add_argument("-o", "--output", action="store", type=utf8_decoder,
+                        help="file where to write the results "
+                        "(task_<id>.json by default)")
+    parser.add_argument("-j", "--workers", action="store", type=int,
+                        help="number of processes to use "
+                        "(the number of CPUs by default)")
     args = parser.parse_args()
 
     file_lengther = None
@@ -329,7 +385,8 @@ def main():
             print("Module %s must have a class named FileLengther." %
                   args.lengther)
 
-    return extract_complexity(args.task_id, file_lengther=file_lengther)
+    return extract_complexity(args.task_id, file_lengther=file_lengther,
+                              output=args.output, workers=args.workers)
 
 
 if __name__ == "__main__":
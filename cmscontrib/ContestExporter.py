@@ -36,12 +36,13 @@ import gevent.monkey
 gevent.monkey.patch_all()
 
 import argparse
+import hashlib
 import io
-import json
 import logging
 import os
 import tarfile
-import tempfile
+
+import gevent.pool
 
 from sqlalchemy.types import \
     Boolean, Integer, Float, String, Unicode, DateTime, Interval, Enum
@@ -54,7 +55,7 @@ from cms.db import SessionGen, Contest, ask_for_contest, \
 from cms.db.filecacher import FileCacher
 from cms.io.GeventUtils import rmtree
 
-from cmscontrib import sha1sum
+from cmscontrib import dump_records
 from cmscommon.datetime import make_timestamp
 
 
@@ -114,7 +115,7 @@ class ContestExporter(object):
 
     def __init__(self, contest_id, export_target,
                  dump_files, dump_model, skip_generated,
-                 skip_submissions, skip_user_tests):
+                 skip_submissions, skip_user_tests, workers=8, resume=False):
         self.contest_id = contest_id
         self.dump_files = dump_files
         self.dump_model = dump_model
@@ -122,6 +123,8 @@ class ContestExporter(object):
         self.skip_submissions = skip_submissions
         self.skip_user_tests = skip_user_tests
         self.export_target = export_target
+        self.workers = workers
+        self.resume = resume
 
         # If target is not provided, we use the contest's name.
         if export_target == "":
@@ -135,7 +138,9 @@ class ContestExporter(object):
                     logger.warning("export_target not given, using \"%s\"",
                                    self.export_target)
 
-        self.file_cacher = FileCacher()
+        # Files are written straight to the export directory, a local
+        # cache would only be an extra copy.
+        self.file_cacher = FileCacher(enabled=False)
 
     def do_export(self):
         """Run the actual export code."""
@@ -153,21 +158,28 @@ class ContestExporter(object):
                 logger.critical("The specified file already exists, "
                                 "I won't overwrite it.")
                 return False
-            export_dir = os.path.join(tempfile.mkdtemp(),
-                                      archive_info["basename"])
+            # We stage the export next to the archive, so that it can
+            # be resumed if interrupted.
+            staging_dir = self.export_target + ".tmp"
+            if not os.path.exists(staging_dir):
+                os.mkdir(staging_dir)
+            export_dir = os.path.join(staging_dir, archive_info["basename"])
 
         logger.info("Creating dir structure.")
-        try:
-            os.mkdir(export_dir)
-        except OSError:
-            logger.critical("The specified directory already exists, "
-                            "I won't overwrite it.")
-            return False
-
         files_dir = os.path.join(export_dir, "files")
         descr_dir = os.path.join(export_dir, "descriptions")
-        os.mkdir(files_dir)
-        os.mkdir(descr_dir)
+        if self.resume and os.path.isdir(export_dir):
+            logger.info("Resuming the export in %s.", export_dir)
+        else:
+            try:
+                os.mkdir(export_dir)
+            except OSError:
+                logger.critical("The specified directory already exists, "
+                                "I won't overwrite it (use --resume to "
+                                "complete an interrupted export).")
+                return False
+            os.mkdir(files_dir)
+            os.mkdir(descr_dir)
 
         with SessionGen() as session:
 
@@ -179,11 +191,8 @@ class ContestExporter(object):
                 files = contest.enumerate_files(self.skip_submissions,
                                                 self.skip_user_tests,
                                                 self.skip_generated)
-                for file_ in files:
-                    if not self.safe_get_file(file_,
-                                              os.path.join(files_dir, file_),
-                                              os.path.join(descr_dir, file_)):
-                        return False
+                if not self.export_files(files, files_dir, descr_dir):
+                    return False
 
             # Export the contest in JSON format.
             if self.dump_model:
@@ -194,21 +203,12 @@ class ContestExporter(object):
                 self.ids = {contest.sa_identity_key: "0"}
                 self.queue = [contest]
 
-                data = dict()
-                while len(self.queue) > 0:
-                    obj = self.queue.pop(0)
-                    data[self.ids[obj.sa_identity_key]] = \
-                        self.export_object(obj)
-
-                # Specify the "root" of the data graph
-                data["_objects"] = ["0"]
-
-                data["_version"] = model_version
-
-                with io.open(os.path.join(export_dir,
-                                          "contest.json"), "wb") as fout:
-                    json.dump(data, fout, encoding="utf-8",
-                              indent=4, sort_keys=True)
+                # Objects are written as soon as they are exported, and
+                # the file is moved in place only when complete.
+                json_path = os.path.join(export_dir, "contest.json")
+                with io.open(json_path + ".tmp", "wb") as fout:
+                    dump_records(self.export_records(), fout)
+                os.rename(json_path + ".tmp", json_path)
 
         # If the admin requested export to file, we do that.
         if archive_info["write_mode"] != "":
@@ -216,12 +216,56 @@ class ContestExporter(object):
                                    archive_info["write_mode"])
             archive.add(export_dir, arcname=archive_info["basename"])
             archive.close()
-            rmtree(export_dir)
+            rmtree(staging_dir)
 
         logger.info("Export finished.")
 
         return True
 
+    def export_records(self):
+        """Yield the records of contest.json, exporting the objects in
+        the queue (and the ones they reference) one at a time.
+
+        """
+        index = 0
+        while index < len(self.queue):
+            obj = self.queue[index]
+            # Drop the reference to allow freeing the object.
+            self.queue[index] = None
+            index += 1
+            yield self.ids[obj.sa_identity_key], self.export_object(obj)
+
+        # Specify the "root" of the data graph
+        yield "_objects", ["0"]
+
+        yield "_version", model_version
+
+    def export_files(self, files, files_dir, descr_dir):
+        """Export the given files, fetching many of them at once.
+
+        files (set): the digests of the files to export.
+        files_dir (string): the directory where to save the files.
+        descr_dir (string): the directory where to save the
+            descriptions.
+
+        return (bool): True if all ok, False if something wrong.
+
+        """
+        pool = gevent.pool.Pool(self.workers)
+        results = pool.imap_unordered(
+            lambda digest: self.safe_get_file(
+                digest,
+                os.path.join(files_dir, digest),
+                os.path.join(descr_dir, digest)),
+            sorted(files))
+        for count, result in enumerate(results, 1):
+            if not result:
+                pool.kill()
+                return False
+            if count % 1000 == 0:
+                logger.info("Exported %d files out of %d.", count, len(files))
+        return True
+
     def get_id(self, obj):
         obj_key = obj.sa_identity_key
         if obj_key not in self.ids:
@@ -319,6 +363,11 @@ class ContestExporter(object):
         """Get file from FileCacher ensuring that the digest is
         correct.
 
+        The file is written to a temporary path while computing its
+        digest, and moved to its place (after the description) only if
+        correct: hence, existing files are complete and are not fetched
+        again when resuming an export.
+
         digest (string): the digest of the file to retrieve.
         path (string): the path where to save the file.
         descr_path (string): the path where to save the description.
@@ -329,19 +378,31 @@ class ContestExporter(object):
 
         # TODO - Probably this method could be merged in FileCacher
 
-        # First get the file
+        if os.path.exists(path):
+            return True
+
+        # First get the file, computing its digest on the way
+        temp_path = path + ".tmp"
+        hasher = hashlib.sha1()
         try:
-            self.file_cacher.get_file_to_path(digest, path)
+            with self.file_cacher.get_file(digest) as src:
+                with io.open(temp_path, 'wb') as dst:
+                    buf = src.read(FileCacher.CHUNK_SIZE)
+                    while len(buf) > 0:
+                        hasher.update(buf)
+                        dst.write(buf)
+                        buf = src.read(FileCacher.CHUNK_SIZE)
         except Exception:
             logger.error("File %s could not retrieved from file server.",
                          digest, exc_info=True)
             return False
 
         # Then check the digest
-        calc_digest = sha1sum(path)
+        calc_digest = hasher.hexdigest()
         if digest != calc_digest:
             logger.critical("File %s has wrong hash %s.",
                             digest, calc_digest)
+            os.unlink(temp_path)
             return False
 
         # If applicable, retrieve also the description
@@ -349,6 +410,8 @@ class ContestExporter(object):
             with io.open(descr_path, 'wt', encoding='utf-8') as fout:
                 fout.write(self.file_cacher.describe(digest))
 
+        os.rename(temp_path, path)
+
         return True
 
 
@@ -369,6 +432,12 @@ def main():
                         help="don't export submissions")
     parser.add_argument("-U", "--no-user-tests", action="store_true",
                         help="don't export user tests")
+    parser.add_argument("-j", "--workers", action="store", type=int,
+                        default=8,
+                        help="number of files to fetch at the same time")
+    parser.add_argument("-r", "--resume", action="store_true",
+                        help="complete an interrupted export, keeping the "
+                        "files already exported")
     parser.add_argument("export_target", action="store",
                         type=utf8_decoder, nargs='?', default="",
                         help="target directory or archive for export")
@@ -384,7 +453,9 @@ def main():
                     dump_model=not args.files,
                     skip_generated=args.no_generated,
                     skip_submissions=args.no_submissions,
-                    skip_user_tests=args.no_user_tests).do_export()
+                    skip_user_tests=args.no_user_tests,
+                    workers=args.workers,
+                    resume=args.resume).do_export()
 
 
 if __name__ == "__main__":
@@ -39,11 +39,12 @@ gevent.monkey.patch_all()
 
 import argparse
 import io
-import json
 import logging
 import os
 from datetime import timedelta
 
+import gevent.pool
+
 from sqlalchemy.types import \
     Boolean, Integer, Float, String, Unicode, DateTime, Interval, Enum
 
@@ -55,7 +56,7 @@ from cms.db import SessionGen, init_db, drop_db, Submission, UserTest, \
     SubmissionResult, UserTestResult, RepeatedUnicode
 from cms.db.filecacher import FileCacher
 
-from cmscontrib import sha1sum
+from cmscontrib import load_records
 from cmscommon.datetime import make_datetime
 from cmscommon.archive import Archive
 
@@ -97,13 +98,14 @@ class ContestImporter(object):
 
     def __init__(self, drop, import_source,
                  load_files, load_model, skip_generated,
-                 skip_submissions, skip_user_tests):
+                 skip_submissions, skip_user_tests, workers=8):
         self.drop = drop
         self.load_files = load_files
         self.load_model = load_model
         self.skip_generated = skip_generated
         self.skip_submissions = skip_submissions
         self.skip_user_tests = skip_user_tests
+        self.workers = workers
 
         self.import_source = import_source
         self.import_dir = import_source
@@ -152,7 +154,7 @@ class ContestImporter(object):
                     # input is correct without actually doing any
                     # validations.  Thus, for example, we're not
                     # checking that the decoded object is a dict...
-                    self.datas = json.load(fin, encoding="utf-8")
+                    self.datas = load_records(fin)
 
                 # If the dump has been exported using a data model
                 # different than the current one (that is, a previous
@@ -273,13 +275,24 @@ class ContestImporter(object):
                 if contest_files is not None:
                     files &= contest_files
 
-                for digest in files:
-                    file_ = os.path.join(files_dir, digest)
-                    desc = os.path.join(descr_dir, digest)
-                    if not self.safe_put_file(file_, desc):
-                        logger.critical("Unable to put file `%s' in the DB. "
-                                        "Aborting. Please remove the contest "
-                                        "from the database.", file_)
+                # Files already in the storage need not be put again.
+                existing = self.file_cacher.filter_existing(files)
+                logger.info("Skipping %d files already stored.",
+                            len(files & existing))
+                files -= existing
+
+                pool = gevent.pool.Pool(self.workers)
+                results = pool.imap_unordered(
+                    lambda digest: self.safe_put_file(
+                        os.path.join(files_dir, digest),
+                        os.path.join(descr_dir, digest)),
+                    sorted(files))
+                for result in results:
+                    if not result:
+                        pool.kill()
+                        logger.critical("Unable to put all the files in "
+                                        "the DB. Aborting. Please remove "
+                                        "the contest from the database.")
                         # TODO: remove contest from the database.
                         return False
 
@@ -416,11 +429,12 @@ class ContestImporter(object):
                             "aborting.", path, error)
             return False
 
-        # Then check the digest.
-        calc_digest = sha1sum(path)
-        if digest != calc_digest:
-            logger.critical("File %s has hash %s, but the server returned %s, "
-                            "aborting.", path, calc_digest, digest)
+        # Then check the digest: the file cacher computed it while
+        # storing the file, and files are named after their digest.
+        expected_digest = os.path.basename(path)
+        if digest != expected_digest:
+            logger.critical("File %s has hash %s, aborting.",
+                            path, digest)
             return False
 
         return True
@@ -444,6 +458,9 @@ def main():
                         help="don't import submissions")
     parser.add_argument("-U", "--no-user-tests", action="store_true",
                         help="don't import user tests")
+    parser.add_argument("-j", "--workers", action="store", type=int,
+                        default=8,
+                        help="number of files to store at the same time")
     parser.add_argument("import_source", action="store", type=utf8_decoder,
                         help="source directory or compressed file")
 
@@ -455,7 +472,8 @@ def main():
                     load_model=not args.files,
                     skip_generated=args.no_generated,
                     skip_submissions=args.no_submissions,
-                    skip_user_tests=args.no_user_tests).do_import()
+                    skip_user_tests=args.no_user_tests,
+                    workers=args.workers).do_import()
 
 
 if __name__ == "__main__":
@@ -38,7 +38,6 @@ gevent.monkey.patch_all()
 
 import argparse
 import io
-import json
 import logging
 import os
 import shutil
@@ -46,6 +45,7 @@ import shutil
 from cms import utf8_decoder
 from cmscommon.archive import Archive
 from cms.db import version as model_version
+from cmscontrib import dump_records, load_records
 
 
 logger = logging.getLogger(__name__)
@@ -96,7 +96,7 @@ def main():
         return
 
     with io.open(path, 'rb') as fin:
-        data = json.load(fin, encoding="utf-8")
+        data = load_records(fin)
 
     # If no "_version" field is found we assume it's a v1.0
     # export (before the new dump format was introduced).
@@ -126,7 +126,7 @@ def main():
     assert data["_version"] == to_version
 
     with io.open(path, 'wb') as fout:
-        json.dump(data, fout, encoding="utf-8", indent=4, sort_keys=True)
+        dump_records(sorted(data.iteritems()), fout)
 
     if archive is not None:
         # Keep the old archive, just rename it
@@ -0,0 +1,125 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Utility to store the rendered score details of the submission
+results scored before ScoringService started doing it, or with an
+older version of the rendering.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import logging
+import sys
+
+from sqlalchemy import inspect, or_, tuple_
+
+from cms.db import SessionGen, SubmissionResult, engine
+from cms.grading import SCORE_DETAILS_VERSION, render_score_details
+
+
+logger = logging.getLogger(__name__)
+
+
+def add_missing_columns():
+    """Add the rendered score details columns, if the database was
+    created before they existed.
+
+    """
+    table = SubmissionResult.__tablename__
+    columns = set(c["name"] for c in inspect(engine).get_columns(table))
+    for name, sql_type in [("rendered_score_details", "VARCHAR"),
+                           ("rendered_score_details_version", "INTEGER")]:
+        if name not in columns:
+            logger.info("Adding column %s.", name)
+            engine.execute("ALTER TABLE %s ADD COLUMN %s %s" %
+                           (table, name, sql_type))
+
+
+def render_all(batch_size):
+    """Render the score details of all the scored submission results
+    whose rendering is missing or outdated, a batch at a time.
+
+    batch_size (int): the number of results loaded at once.
+
+    return ((int, int)): the number of results rendered, and of the
+        ones whose score details could not be rendered.
+
+    """
+    rendered = 0
+    failed = 0
+    last_key = (0, 0)
+    while True:
+        with SessionGen() as session:
+            results = session.query(SubmissionResult)\
+                .filter(SubmissionResult.filter_scored())\
+                .filter(or_(
+                    SubmissionResult.rendered_score_details_version == None,
+                    SubmissionResult.rendered_score_details_version !=
+                    SCORE_DETAILS_VERSION))\
+                .filter(tuple_(SubmissionResult.submission_id,
+                               SubmissionResult.dataset_id) >
+                        tuple_(*last_key))\
+                .order_by(SubmissionResult.submission_id,
+                          SubmissionResult.dataset_id)\
+                .limit(batch_size).all()  # noqa
+            if len(results) == 0:
+                break
+            for sr in results:
+                try:
+                    sr.rendered_score_details = render_score_details(
+                        sr.score, sr.score_details)
+                except Exception:
+                    logger.warning("Cannot render the score details of "
+                                   "submission result %d(%d).",
+                                   sr.submission_id, sr.dataset_id,
+                                   exc_info=True)
+                    failed += 1
+                    continue
+                sr.rendered_score_details_version = SCORE_DETAILS_VERSION
+                rendered += 1
+            last_key = (results[-1].submission_id, results[-1].dataset_id)
+            session.commit()
+        logger.info("Rendered %d score details so far.", rendered)
+    return rendered, failed
+
+
+def main():
+    """Parse arguments and launch process.
+
+    """
+    parser = argparse.ArgumentParser(
+        description="Store the rendered score details of the submission "
+        "results that miss them.")
+    parser.add_argument("-b", "--batch-size", action="store", type=int,
+                        default=1000,
+                        help="number of results to process at once")
+    args = parser.parse_args()
+
+    add_missing_columns()
+    rendered, failed = render_all(args.batch_size)
+    logger.info("Rendered %d score details, %d failed.", rendered, failed)
+
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
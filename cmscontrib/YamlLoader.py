@@ -37,7 +37,7 @@ from cms import LANGUAGES, LANGUAGE_TO_HEADER_EXT_MAP, \
 from cmscommon.datetime import make_datetime
 from cms.db import Contest, User, Task, Statement, Attachment, \
     SubmissionFormatElement, Dataset, Manager, Testcase
-from cmscontrib.BaseLoader import Loader
+from cmscontrib.BaseLoader import FileUploader, Loader
 from cmscontrib import touch
 
 
@@ -351,6 +351,10 @@ class YamlLoader(Loader):
         # If this file is not deleted, then the import failed
         touch(os.path.join(task_path, ".import_error"))
 
+        # Files are hashed now, but stored all together at the end
+        uploader = FileUploader(self.file_cacher,
+                                os.path.join(task_path, ".digests"))
+
         args = {}
 
         args["num"] = num
@@ -370,7 +374,7 @@ class YamlLoader(Loader):
                  os.path.join(task_path, "testo", "testo.pdf")]
         for path in paths:
             if os.path.exists(path):
-                digest = self.file_cacher.put_file_from_path(
+                digest = uploader.add(
                     path,
                     "Statement for task %s (lang: %s)" % (name,
                                                           primary_language))
@@ -442,7 +446,7 @@ class YamlLoader(Loader):
         args["attachments"] = []
         if os.path.exists(os.path.join(task_path, "att")):
             for filename in os.listdir(os.path.join(task_path, "att")):
-                digest = self.file_cacher.put_file_from_path(
+                digest = uploader.add(
                     os.path.join(task_path, "att", filename),
                     "Attachment %s for task %s" % (filename, name))
                 args["attachments"] += [Attachment(filename, digest)]
@@ -477,7 +481,7 @@ class YamlLoader(Loader):
                 grader_filename = os.path.join(
                     task_path, "sol", "grader.%s" % lang)
                 if os.path.exists(grader_filename):
-                    digest = self.file_cacher.put_file_from_path(
+                    digest = uploader.add(
                         grader_filename,
                         "Grader for task %s and language %s" % (name, lang))
                     args["managers"] += [
@@ -488,7 +492,7 @@ class YamlLoader(Loader):
             for other_filename in os.listdir(os.path.join(task_path, "sol")):
                 if any(other_filename.endswith(header)
                        for header in LANGUAGE_TO_HEADER_EXT_MAP.itervalues()):
-                    digest = self.file_cacher.put_file_from_path(
+                    digest = uploader.add(
                         os.path.join(task_path, "sol", other_filename),
                         "Manager %s for task %s" % (other_filename, name))
                     args["managers"] += [
@@ -504,7 +508,7 @@ class YamlLoader(Loader):
                  os.path.join(task_path, "cor", "correttore")]
         for path in paths:
             if os.path.exists(path):
-                digest = self.file_cacher.put_file_from_path(
+                digest = uploader.add(
                     path,
                     "Manager for task %s" % name)
                 args["managers"] += [
@@ -612,7 +616,7 @@ class YamlLoader(Loader):
                 if os.path.exists(path):
                     args["task_type"] = "Communication"
                     args["task_type_parameters"] = '[]'
-                    digest = self.file_cacher.put_file_from_path(
+                    digest = uploader.add(
                         path,
                         "Manager for task %s" % name)
                     args["managers"] += [
@@ -621,7 +625,7 @@ class YamlLoader(Loader):
                         stub_name = os.path.join(
                             task_path, "sol", "stub.%s" % lang)
                         if os.path.exists(stub_name):
-                            digest = self.file_cacher.put_file_from_path(
+                            digest = uploader.add(
                                 stub_name,
                                 "Stub for task %s and language %s" % (name,
                                                                       lang))
@@ -634,7 +638,7 @@ class YamlLoader(Loader):
                                                                   "sol")):
                         if any(other_filename.endswith(header) for header in
                                LANGUAGE_TO_HEADER_EXT_MAP.itervalues()):
-                            digest = self.file_cacher.put_file_from_path(
+                            digest = uploader.add(
                                 os.path.join(task_path, "sol", other_filename),
                                 "Stub %s for task %s" % (other_filename, name))
                             args["managers"] += [
@@ -649,14 +653,17 @@ class YamlLoader(Loader):
                     (compilation_param, infile_param, outfile_param,
                      evaluation_param)
 
+        digests = uploader.add_many(
+            [(os.path.join(task_path, "input", "input%d.txt" % i),
+              "Input %d for task %s" % (i, name))
+             for i in xrange(n_input)] +
+            [(os.path.join(task_path, "output", "output%d.txt" % i),
+              "Output %d for task %s" % (i, name))
+             for i in xrange(n_input)])
         args["testcases"] = []
         for i in xrange(n_input):
-            input_digest = self.file_cacher.put_file_from_path(
-                os.path.join(task_path, "input", "input%d.txt" % i),
-                "Input %d for task %s" % (i, name))
-            output_digest = self.file_cacher.put_file_from_path(
-                os.path.join(task_path, "output", "output%d.txt" % i),
-                "Output %d for task %s" % (i, name))
+            input_digest = digests[i]
+            output_digest = digests[n_input + i]
             args["testcases"] += [
                 Testcase("%03d" % i, False, input_digest, output_digest)]
             if args["task_type"] == "OutputOnly":
@@ -671,6 +678,8 @@ class YamlLoader(Loader):
         dataset = Dataset(**args)
         task.active_dataset = dataset
 
+        uploader.upload()
+
         # Import was successful
         os.remove(os.path.join(task_path, ".import_error"))
 
@@ -32,6 +32,7 @@ from __future__ import unicode_literals
 
 import hashlib
 import io
+import json
 import os
 
 
@@ -65,3 +66,53 @@ def touch(path):
     """
     with io.open(path, 'ab'):
         os.utime(path, None)
+
+
+def dump_records(records, fout):
+    """Write a contest dump (i.e., contest.json) one record per line.
+
+    The result is a JSON object, whose items are the given records, in
+    a layout that allows load_records to read it a line at a time. As
+    records can be produced while writing, the whole dump never needs
+    to be in memory.
+
+    records (iterable): pairs (key, value) to store in the dump.
+    fout (fileobj): a writable binary file-like object.
+
+    """
+    fout.write(b"{")
+    separator = b"\n"
+    for key, value in records:
+        fout.write(separator)
+        fout.write(json.dumps(key).encode("ascii"))
+        fout.write(b": ")
+        fout.write(json.dumps(value, sort_keys=True).encode("ascii"))
+        separator = b",\n"
+    fout.write(b"\n}\n")
+
+
+def load_records(fin):
+    """Read a contest dump (i.e., contest.json).
+
+    Dumps written by dump_records are parsed a line at a time; other
+    ones (e.g., written by older versions of CMS) as a whole.
+
+    fin (fileobj): a readable binary file-like object.
+
+    return (dict): the content of the dump.
+
+    """
+    data = dict()
+    try:
+        if fin.readline().strip() != b"{":
+            raise ValueError("Not one record per line.")
+        for line in fin:
+            line = line.strip()
+            if line == b"}":
+                return data
+            data.update(json.loads(b"{%s}" % line.rstrip(b","),
+                                   encoding="utf-8"))
+        raise ValueError("Unterminated dump.")
+    except ValueError:
+        fin.seek(0)
+        return json.load(fin, encoding="utf-8")
@@ -44,6 +44,12 @@ class Config(object):
         self.https_keyfile = None
         self.timeout = 600  # 10 minutes (in seconds)
 
+        # Processes. With readers > 0 the ports above are served by
+        # that many reader processes, while the data is written only
+        # through writer_port (which ProxyService must point to).
+        self.readers = 0
+        self.writer_port = 8891
+
         # Authentication.
         self.realm_name = 'Scoreboard'
         self.username = 'usern4me'
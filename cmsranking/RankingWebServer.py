@@ -23,6 +23,7 @@ from __future__ import unicode_literals
 
 import argparse
 import functools
+import gzip
 import io
 import json
 import logging
@@ -34,7 +35,9 @@ import time
 from datetime import datetime
 
 import gevent
+from gevent import socket
 from gevent.pywsgi import WSGIServer
+from gevent.queue import Queue
 
 from werkzeug.wrappers import Request, Response
 from werkzeug.routing import Map, Rule
@@ -49,7 +52,7 @@ import cmsranking.Logger
 
 from cmscommon.eventsource import EventSource
 from cmsranking.Config import config
-from cmsranking.Entity import InvalidData
+from cmsranking.Entity import InvalidData, InvalidKey
 import cmsranking.Contest as Contest
 import cmsranking.Task as Task
 import cmsranking.Team as Team
@@ -62,6 +65,19 @@ import cmsranking.Scoring as Scoring
 logger = logging.getLogger(__name__)
 
 
+# The stores replicated by the reader processes, with the names of
+# their entities.
+STORES = [("contest", Contest.store),
+          ("task", Task.store),
+          ("team", Team.store),
+          ("user", User.store),
+          ("submission", Submission.store),
+          ("subchange", Subchange.store)]
+
+# The size of the accept queue of the listening sockets of the readers.
+LISTEN_BACKLOG = 256
+
+
 class CustomUnauthorized(Unauthorized):
     def get_response(self, environ=None):
         response = Unauthorized.get_response(self, environ)
@@ -73,8 +89,11 @@ class CustomUnauthorized(Unauthorized):
 
 
 class StoreHandler(object):
-    def __init__(self, store):
+    def __init__(self, store, read_only=False):
         self.store = store
+        # The replicas of the reader processes can only be changed by
+        # the writer process.
+        self.read_only = read_only
 
         self.router = Map(
             [Rule("/<key>", methods=["GET"], endpoint="get"),
@@ -101,6 +120,11 @@ class StoreHandler(object):
 
         response = Response()
 
+        if self.read_only and endpoint not in ("get", "get_list"):
+            logger.warning("Write request to a reader process.",
+                           extra={'location': request.url})
+            return Forbidden()
+
         try:
             if endpoint == "get":
                 self.get(request, response, args["key"])
@@ -127,6 +151,20 @@ class StoreHandler(object):
             request.authorization.username == config.username and \
             request.authorization.password == config.password
 
+    @staticmethod
+    def load_data(request):
+        """Decode the JSON body of the request, possibly compressed.
+
+        request (Request): the request.
+
+        return (object): the decoded body.
+
+        """
+        if request.headers.get("Content-Encoding", "identity") == "gzip":
+            return json.load(gzip.GzipFile(
+                fileobj=io.BytesIO(request.stream.read()), mode="rb"))
+        return json.load(request.stream)
+
     def get(self, request, response, key):
         # Limit charset of keys.
         if re.match("^[A-Za-z0-9_]+$", key) is None:
@@ -166,8 +204,8 @@ class StoreHandler(object):
             raise UnsupportedMediaType()
 
         try:
-            data = json.load(request.stream)
-        except (TypeError, ValueError):
+            data = self.load_data(request)
+        except (TypeError, ValueError, IOError):
             logger.warning("Wrong JSON.",
                            extra={'location': request.url})
             raise BadRequest()
@@ -198,8 +236,8 @@ class StoreHandler(object):
             raise UnsupportedMediaType()
 
         try:
-            data = json.load(request.stream)
-        except (TypeError, ValueError):
+            data = self.load_data(request)
+        except (TypeError, ValueError, IOError):
             logger.warning("Wrong JSON.",
                            extra={'location': request.url})
             raise BadRequest()
@@ -248,6 +286,11 @@ class DataWatcher(EventSource):
         self._CACHE_SIZE = config.buffer_size
         EventSource.__init__(self)
 
+        # The sequence number of the change being applied, if it comes
+        # from the writer, and how many events it caused so far.
+        self._sequence = None
+        self._index = 0
+
         Contest.store.add_create_callback(
             functools.partial(self.callback, "contest", "create"))
         Contest.store.add_update_callback(
@@ -278,12 +321,136 @@ class DataWatcher(EventSource):
 
         Scoring.store.add_score_callback(self.score_callback)
 
+    def set_sequence(self, sequence):
+        """Key the next events by the writer's number of the change
+        causing them.
+
+        This way all the readers give the same IDs to the same events,
+        and a client can reconnect to any of them.
+
+        sequence (int): the sequence number of the change.
+
+        """
+        self._sequence = sequence
+        self._index = 0
+
+    def _next_key(self):
+        """Return the key of the next event.
+
+        return (int|None): the key, or None to use the clock.
+
+        """
+        if self._sequence is None:
+            return None
+        self._index += 1
+        return (self._sequence << 32) + self._index
+
     def callback(self, entity, event, key, *args):
-        self.send(entity, "%s %s" % (event, key))
+        self.send(entity, "%s %s" % (event, key), self._next_key())
 
     def score_callback(self, user, task, score):
         # FIXME Use score_precision.
-        self.send("score", "%s %s %0.2f" % (user, task, score))
+        self.send("score", "%s %s %0.2f" % (user, task, score),
+                  self._next_key())
+
+
+class ReplicationPublisher(object):
+    """Forward the changes of the stores to the reader processes.
+
+    Each change is a JSON object on its own line; they are sent in
+    the order in which the stores notify them, so that the readers,
+    applying them to their replicas, compute the same scores and send
+    the same events as the writer. Each is numbered, for the readers
+    to give the same IDs to these events.
+
+    """
+    def __init__(self, sockets):
+        """Start sending changes on the given sockets.
+
+        sockets ([socket]): the writer's ends of the channels to the
+            readers, one per reader.
+
+        """
+        # Starting from the clock, so that the numbers keep growing
+        # when the writer is restarted.
+        self._sequence = int(time.time() * 1000000)
+        self._queues = list()
+        for sock in sockets:
+            queue = Queue()
+            self._queues.append(queue)
+            gevent.spawn(self._send, sock, queue)
+
+        for entity, store in STORES:
+            store.add_create_callback(
+                functools.partial(self.callback, entity, "create"))
+            store.add_update_callback(
+                functools.partial(self.callback, entity, "update"))
+            store.add_delete_callback(
+                functools.partial(self.callback, entity, "delete"))
+
+    def callback(self, entity, event, key, *args):
+        data = args[-1].get() if event != "delete" else None
+        self._sequence += 1
+        line = json.dumps({"seq": self._sequence, "entity": entity,
+                           "event": event, "key": key,
+                           "data": data}) + b"\n"
+        for queue in self._queues:
+            queue.put(line)
+
+    def _send(self, sock, queue):
+        """Send to a reader the changes put in its queue.
+
+        sock (socket): the writer's end of the channel.
+        queue (Queue): the lines to send.
+
+        """
+        while True:
+            # Send together all the changes accumulated meanwhile.
+            lines = [queue.get()]
+            while not queue.empty():
+                lines.append(queue.get_nowait())
+            try:
+                sock.sendall(b"".join(lines))
+            except socket.error:
+                logger.error("Reader unreachable, not replicating to it "
+                             "anymore.", exc_info=True)
+                self._queues.remove(queue)
+                return
+
+
+def replicate(sock, event_handler=None):
+    """Apply the changes sent by the writer to the local stores.
+
+    sock (socket): the reader's end of the channel to the writer.
+    event_handler (DataWatcher|None): if given, told the sequence
+        number of each change before applying it.
+
+    Return when the writer closes the channel.
+
+    """
+    stores = dict(STORES)
+    for line in sock.makefile("rb"):
+        change = json.loads(line)
+        if event_handler is not None:
+            event_handler.set_sequence(change["seq"])
+        store = stores[change["entity"]]
+        key = change["key"]
+        try:
+            if change["event"] == "delete":
+                # The writer notifies the deletion of the entities that
+                # depend on this one before it, but deleting it here
+                # may have already removed them.
+                if key in store:
+                    store.delete(key)
+            elif key in store:
+                store.update(key, change["data"])
+            else:
+                store.create(key, change["data"])
+        except (InvalidKey, InvalidData):
+            logger.error("Cannot apply change sent by the writer.",
+                         exc_info=True,
+                         extra={'details': pprint.pformat(change)})
+    logger.info("Writer closed the replication channel.")
 
 
 def SubListHandler(request, response, user_id):
@@ -328,6 +495,18 @@ def ScoreHandler(request, response):
     response.data = json.dumps(result)
 
 
+def EventStatsHandler(request, response, event_handler):
+    if request.accept_mimetypes.quality("application/json") <= 0:
+        raise NotAcceptable()
+
+    result = event_handler.get_stats()
+    result["pid"] = os.getpid()
+
+    response.status_code = 200
+    response.mimetype = "application/json"
+    response.data = json.dumps(result)
+
+
 class ImageHandler(object):
     EXT_TO_MIME = {
         'png': 'image/png',
@@ -397,6 +576,7 @@ class RoutingHandler(object):
              Rule("/history", methods=["GET"], endpoint="history"),
              Rule("/scores", methods=["GET"], endpoint="scores"),
              Rule("/events", methods=["GET"], endpoint="events"),
+             Rule("/events/stats", methods=["GET"], endpoint="event_stats"),
              Rule("/logo", methods=["GET"], endpoint="logo"),
              ], encoding_errors="strict")
 
@@ -432,10 +612,137 @@ class RoutingHandler(object):
                 ScoreHandler(request, response)
             elif endpoint == "history":
                 HistoryHandler(request, response)
+            elif endpoint == "event_stats":
+                EventStatsHandler(request, response, self.event_handler)
 
             return response(environ, start_response)
 
 
+def make_wsgi_app(read_only=False, event_handler=None):
+    """Build the WSGI application serving the ranking.
+
+    read_only (bool): whether to refuse the requests changing the
+        stores.
+    event_handler (DataWatcher|None): the source of the events to
+        serve; if not given, a new one.
+
+    return (function): the WSGI application.
+
+    """
+    if event_handler is None:
+        event_handler = DataWatcher()
+    toplevel_handler = RoutingHandler(event_handler, ImageHandler(
+        os.path.join(config.lib_dir, '%(name)s'),
+        os.path.join(config.web_dir, 'img', 'logo.png')))
+
+    return SharedDataMiddleware(DispatcherMiddleware(
+        toplevel_handler,
+        {'/contests': StoreHandler(Contest.store, read_only),
+         '/tasks': StoreHandler(Task.store, read_only),
+         '/teams': StoreHandler(Team.store, read_only),
+         '/users': StoreHandler(User.store, read_only),
+         '/submissions': StoreHandler(Submission.store, read_only),
+         '/subchanges': StoreHandler(Subchange.store, read_only),
+         '/faces': ImageHandler(
+             os.path.join(config.lib_dir, 'faces', '%(name)s'),
+             os.path.join(config.web_dir, 'img', 'face.png')),
+         '/flags': ImageHandler(
+             os.path.join(config.lib_dir, 'flags', '%(name)s'),
+             os.path.join(config.web_dir, 'img', 'flag.png')),
+         }), {'/': config.web_dir})
+
+
+def reuseport_listener(address, port):
+    """Create a listening socket sharing its port with the other
+    processes that ask so, the kernel balancing the connections among
+    them.
+
+    address (unicode): the address to bind to.
+    port (int): the port to bind to.
+
+    return (socket): the listening socket.
+
+    """
+    family = socket.AF_INET6 if ":" in address else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((address, port))
+    sock.listen(LISTEN_BACKLOG)
+    return sock
+
+
+def run_servers(servers, until=None):
+    """Run the servers until interrupted.
+
+    servers ([WSGIServer]): the servers to run.
+    until (Greenlet|None): if given, also stop when it finishes.
+
+    """
+    greenlets = list(gevent.spawn(s.serve_forever) for s in servers)
+    try:
+        if until is None:
+            gevent.joinall(greenlets)
+        else:
+            until.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        gevent.joinall(list(gevent.spawn(s.stop) for s in servers))
+
+
+def run_reader(sock):
+    """Serve the ranking, read-only, from replicas of the stores.
+
+    sock (socket): the reader's end of the channel to the writer.
+
+    """
+    for _, store in STORES:
+        store.persistent = False
+    event_handler = DataWatcher()
+    wsgi_app = make_wsgi_app(read_only=True, event_handler=event_handler)
+    replication = gevent.spawn(replicate, sock, event_handler)
+
+    servers = list()
+    if config.http_port is not None:
+        servers.append(WSGIServer(
+            reuseport_listener(config.bind_address, config.http_port),
+            wsgi_app))
+    if config.https_port is not None:
+        servers.append(WSGIServer(
+            reuseport_listener(config.bind_address, config.https_port),
+            wsgi_app,
+            certfile=config.https_certfile, keyfile=config.https_keyfile))
+
+    run_servers(servers, until=replication)
+
+
+def run_writer(sockets, pids):
+    """Own the stores, accepting changes on the writer port and
+    forwarding them to the readers.
+
+    sockets ([socket]): the writer's ends of the channels to the
+        readers.
+    pids ([int]): the process ids of the readers.
+
+    """
+    ReplicationPublisher(sockets)
+    wsgi_app = make_wsgi_app()
+
+    try:
+        run_servers([WSGIServer(
+            (config.bind_address, config.writer_port), wsgi_app)])
+    finally:
+        # Readers stop when their channel is closed.
+        for sock in sockets:
+            sock.close()
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+
 def main():
     """Entry point for RWS.
 
@@ -459,41 +766,37 @@ def main():
             print("Not removing directory %s." % config.lib_dir)
         return False
 
-    toplevel_handler = RoutingHandler(DataWatcher(), ImageHandler(
-        os.path.join(config.lib_dir, '%(name)s'),
-        os.path.join(config.web_dir, 'img', 'logo.png')))
-
-    wsgi_app = SharedDataMiddleware(DispatcherMiddleware(
-        toplevel_handler,
-        {'/contests': StoreHandler(Contest.store),
-         '/tasks': StoreHandler(Task.store),
-         '/teams': StoreHandler(Team.store),
-         '/users': StoreHandler(User.store),
-         '/submissions': StoreHandler(Submission.store),
-         '/subchanges': StoreHandler(Subchange.store),
-         '/faces': ImageHandler(
-             os.path.join(config.lib_dir, 'faces', '%(name)s'),
-             os.path.join(config.web_dir, 'img', 'face.png')),
-         '/flags': ImageHandler(
-             os.path.join(config.lib_dir, 'flags', '%(name)s'),
-             os.path.join(config.web_dir, 'img', 'flag.png')),
-         }), {'/': config.web_dir})
-
-    servers = list()
-    if config.http_port is not None:
-        http_server = WSGIServer(
-            (config.bind_address, config.http_port), wsgi_app)
-        servers.append(http_server)
-    if config.https_port is not None:
-        https_server = WSGIServer(
-            (config.bind_address, config.https_port), wsgi_app,
-            certfile=config.https_certfile, keyfile=config.https_keyfile)
-        servers.append(https_server)
-
-    try:
-        gevent.joinall(list(gevent.spawn(s.serve_forever) for s in servers))
-    except KeyboardInterrupt:
-        pass
-    finally:
-        gevent.joinall(list(gevent.spawn(s.stop) for s in servers))
+    if config.readers <= 0:
+        wsgi_app = make_wsgi_app()
+        servers = list()
+        if config.http_port is not None:
+            http_server = WSGIServer(
+                (config.bind_address, config.http_port), wsgi_app)
+            servers.append(http_server)
+        if config.https_port is not None:
+            https_server = WSGIServer(
+                (config.bind_address, config.https_port), wsgi_app,
+                certfile=config.https_certfile, keyfile=config.https_keyfile)
+            servers.append(https_server)
+        run_servers(servers)
+        return True
+
+    # The stores have already been loaded from disk, so the readers
+    # start with a copy of them and then follow the writer's changes.
+    channels = list(socket.socketpair() for _ in xrange(config.readers))
+    pids = list()
+    for writer_end, reader_end in channels:
+        pid = gevent.fork()
+        if pid == 0:
+            for sock in sum(channels, ()):
+                if sock is not reader_end:
+                    sock.close()
+            run_reader(reader_end)
+            return True
+        pids.append(pid)
+    for _, reader_end in channels:
+        reader_end.close()
+    logger.info("Started %d readers, writing on port %d.",
+                len(pids), config.writer_port)
+    run_writer(list(writer_end for writer_end, _ in channels), pids)
     return True
@@ -71,6 +71,9 @@ class Store(object):
         self._create_callbacks = list()
         self._update_callbacks = list()
         self._delete_callbacks = list()
+        # Whether changes are reflected on the files in lib_dir; the
+        # replicas kept by the reader processes of RWS aren't.
+        self.persistent = True
 
         try:
             os.mkdir(self._path)
@@ -157,13 +160,15 @@ class Store(object):
             for callback in self._create_callbacks:
                 callback(key, item)
             # reflect changes on the persistent storage
-            try:
-                path = os.path.join(self._path, key + '.json')
-                with io.open(path, 'wb') as rec:
-                    json.dump(self._store[key].get(), rec, encoding='utf-8')
-            except IOError:
-                logger.error("I/O error occured while creating entity",
-                             exc_info=True)
+            if self.persistent:
+                try:
+                    path = os.path.join(self._path, key + '.json')
+                    with io.open(path, 'wb') as rec:
+                        json.dump(self._store[key].get(), rec,
+                                  encoding='utf-8')
+                except IOError:
+                    logger.error("I/O error occured while creating entity",
+                                 exc_info=True)
 
     def update(self, key, data):
         """Update an entity.
@@ -196,13 +201,15 @@ class Store(object):
             for callback in self._update_callbacks:
                 callback(key, old_item, item)
             # reflect changes on the persistent storage
-            try:
-                path = os.path.join(self._path, key + '.json')
-                with io.open(path, 'wb') as rec:
-                    json.dump(self._store[key].get(), rec, encoding='utf-8')
-            except IOError:
-                logger.error("I/O error occured while updating entity",
-                             exc_info=True)
+            if self.persistent:
+                try:
+                    path = os.path.join(self._path, key + '.json')
+                    with io.open(path, 'wb') as rec:
+                        json.dump(self._store[key].get(), rec,
+                                  encoding='utf-8')
+                except IOError:
+                    logger.error("I/O error occured while updating entity",
+                                 exc_info=True)
 
     def merge_list(self, data_dict):
         """Merge a list of entities.
@@ -252,6 +259,8 @@ class Store(object):
                     for callback in self._update_callbacks:
                         callback(key, old_value, value)
                 # reflect changes on the persistent storage
+                if not self.persistent:
+                    continue
                 try:
                     path = os.path.join(self._path, key + '.json')
                     with io.open(path, 'wb') as rec:
@@ -288,10 +297,11 @@ class Store(object):
             for callback in self._delete_callbacks:
                 callback(key, old_value)
             # reflect changes on the persistent storage
-            try:
-                os.remove(os.path.join(self._path, key + '.json'))
-            except OSError:
-                logger.error("Unable to delete entity", exc_info=True)
+            if self.persistent:
+                try:
+                    os.remove(os.path.join(self._path, key + '.json'))
+                except OSError:
+                    logger.error("Unable to delete entity", exc_info=True)
 
     def delete_list(self):
         """Delete all entities.
@@ -27,6 +27,7 @@ from __future__ import unicode_literals
 
 import argparse
 import io
+import json
 import os
 import sys
 import subprocess
@@ -34,10 +35,13 @@ import copy
 import functools
 import shutil
 import tempfile
+import threading
+import Queue
 import yaml
 
 from cms import utf8_decoder
 from cms.grading import get_compilation_commands
+from cmscontrib import sha1sum
 from cmstaskenv.Test import test_testcases, clean_test_env
 
 
@@ -63,6 +67,7 @@ STUB_BASENAME = 'stub'
 INPUT_DIRNAME = 'input'
 OUTPUT_DIRNAME = 'output'
 RESULT_DIRNAME = 'result'
+BUILD_CACHE = '.cmsMake_cache'
 
 DATA_DIRS = [os.path.join('.', 'cmstaskenv', 'data'),
              os.path.join('/', 'usr', 'local', 'share', 'cms', 'cmsMake')]
@@ -178,6 +183,9 @@ def build_sols_list(base_dir, task_type, in_out_files, yaml_conf):
 
     actions = []
     test_actions = []
+    # Testing uses global state, and may ask questions: only one
+    # solution is tested at a time, even when building in parallel.
+    test_lock = threading.Lock()
     for src in sources:
         exe, lang = basename2(src, SOL_EXTS)
         # Delete the dot
@@ -253,28 +261,34 @@ def build_sols_list(base_dir, task_type, in_out_files, yaml_conf):
                 shutil.rmtree(tempdir)
 
         def test_src(exe, lang, assume=None):
-            print("Testing solution %s" % (exe))
-            test_testcases(
-                base_dir,
-                exe,
-                language=lang,
-                assume=assume)
+            with test_lock:
+                print("Testing solution %s" % (exe))
+                test_testcases(
+                    base_dir,
+                    exe,
+                    language=lang,
+                    assume=assume)
 
         actions.append(
             (srcs,
              [exe],
              functools.partial(compile_src, srcs, exe, False, lang),
-             'compile solution'))
+             'compile solution',
+             repr(get_compilation_commands(lang, srcs, exe,
+                                           for_evaluation=False))))
         actions.append(
             (srcs,
              [exe_EVAL],
              functools.partial(compile_src, srcs, exe_EVAL, True, lang),
-             'compile solution with -DEVAL'))
+             'compile solution with -DEVAL',
+             repr(get_compilation_commands(lang, srcs, exe_EVAL,
+                                           for_evaluation=True))))
 
         test_actions.append((test_deps,
                              ['test_%s' % (os.path.split(exe)[1])],
                              functools.partial(test_src, exe_EVAL, lang),
-                             'test solution (compiled with -DEVAL)'))
+                             'test solution (compiled with -DEVAL)',
+                             ''))
 
     return actions + test_actions
 
@@ -299,7 +313,9 @@ def build_checker_list(base_dir, task_type):
 
             actions.append(([src], [exe],
                             functools.partial(compile_check, src, exe),
-                            'compile checker'))
+                            'compile checker',
+                            repr(get_compilation_commands(lang, [src],
+                                                          exe))))
 
     return actions
 
@@ -310,16 +326,17 @@ def build_text_list(base_dir, task_type):
     text_aux = os.path.join(TEXT_DIRNAME, TEXT_AUX)
     text_log = os.path.join(TEXT_DIRNAME, TEXT_LOG)
 
+    command = ['pdflatex', '-output-directory', TEXT_DIRNAME,
+               '-interaction', 'batchmode', text_tex]
+
     def make_pdf(assume=None):
-        call(base_dir,
-             ['pdflatex', '-output-directory', TEXT_DIRNAME,
-              '-interaction', 'batchmode', text_tex],
+        call(base_dir, command,
              env={'TEXINPUTS': '.:%s:%s/file:' % (TEXT_DIRNAME, TEXT_DIRNAME)})
 
     actions = []
     if os.path.exists(text_tex):
         actions.append(([text_tex], [text_pdf, text_aux, text_log],
-                        make_pdf, 'compile to PDF'))
+                        make_pdf, 'compile to PDF', repr(command)))
     return actions
 
 
@@ -388,11 +405,9 @@ def build_gen_list(base_dir, task_type):
 
     sol_exe = os.path.join(SOL_DIRNAME, SOL_FILENAME)
 
-    # Count non-trivial lines in GEN and establish which external
-    # files are needed for input generation
+    # Count non-trivial lines in GEN
     testcases = list(iter_GEN(os.path.join(base_dir, gen_GEN)))
     testcase_num = len(testcases)
-    copy_files = [x[1] for x in testcases if x[0]]
 
     def compile_src(src, exe, lang, assume=None):
         if lang in ['cpp', 'c', 'pas']:
@@ -401,43 +416,44 @@ def build_gen_list(base_dir, task_type):
             for command in commands:
                 call(base_dir, command)
         elif lang in ['py', 'sh']:
-            os.symlink(os.path.basename(src), exe)
+            if os.path.lexists(os.path.join(base_dir, exe)):
+                os.remove(os.path.join(base_dir, exe))
+            os.symlink(os.path.basename(src), os.path.join(base_dir, exe))
         else:
             raise Exception("Wrong generator/validator language!")
 
-    # Question: why, differently from outputs, inputs have to be
-    # created all together instead of selectively over those that have
-    # been changed since last execution? This is a waste of time,
-    # usually generating inputs is a pretty long thing. Answer:
-    # because cmsMake architecture, which is based on file timestamps,
-    # doesn't make us able to understand which lines of gen/GEN have
-    # been changed. Douch! We'll have to think better this thing for
-    # the new format we're developing.
-    def make_input(assume=None):
-        n = 0
+    def compile_command(src, exe, lang):
+        if lang in ['cpp', 'c', 'pas']:
+            return repr(get_compilation_commands(lang, [src], exe,
+                                                 for_evaluation=False))
+        return lang
+
+    # Each input is generated by its own action, whose command is its
+    # line of gen/GEN: thanks to the build cache, only the inputs
+    # whose line (or generator, or validator) changed are generated
+    # again.
+    def make_input(n, is_copy, line, st, assume=None):
         try:
             os.makedirs(input_dir)
         except OSError:
             pass
-        for (is_copy, line, st) in testcases:
-            print("Generating input # %d" % (n), file=sys.stderr)
-            new_input = os.path.join(input_dir, 'input%d.txt' % (n))
-            if is_copy:
-                # Copy the file
-                print("> Copy input file from:", line)
-                copy_input = os.path.join(base_dir, line)
-                shutil.copyfile(copy_input, new_input)
-            else:
-                # Call the generator
-                with io.open(new_input, 'wb') as fout:
-                    call(base_dir,
-                         [gen_exe] + line.split(),
-                         stdout=fout)
-            command = [validator_exe, new_input]
-            if st != 0:
-                command.append("%s" % st)
-            call(base_dir, command)
-            n += 1
+        print("Generating input # %d" % (n), file=sys.stderr)
+        new_input = os.path.join(input_dir, 'input%d.txt' % (n))
+        if is_copy:
+            # Copy the file
+            print("> Copy input file from:", line)
+            copy_input = os.path.join(base_dir, line)
+            shutil.copyfile(copy_input, new_input)
+        else:
+            # Call the generator
+            with io.open(new_input, 'wb') as fout:
+                call(base_dir,
+                     [gen_exe] + line.split(),
+                     stdout=fout)
+        command = [validator_exe, new_input]
+        if st != 0:
+            command.append("%s" % st)
+        call(base_dir, command)
 
     def make_output(n, assume=None):
         try:
@@ -461,25 +477,30 @@ def build_gen_list(base_dir, task_type):
     actions.append(([gen_src],
                     [gen_exe],
                     functools.partial(compile_src, gen_src, gen_exe, gen_lang),
-                    "compile the generator"))
+                    "compile the generator",
+                    compile_command(gen_src, gen_exe, gen_lang)))
     actions.append(([validator_src],
                     [validator_exe],
                     functools.partial(compile_src, validator_src,
                                       validator_exe, validator_lang),
-                    "compile the validator"))
-    actions.append(([gen_GEN, gen_exe, validator_exe] + copy_files,
-                    map(lambda x: os.path.join(INPUT_DIRNAME,
-                                               'input%d.txt' % (x)),
-                        range(0, testcase_num)),
-                    make_input,
-                    "input generation"))
+                    "compile the validator",
+                    compile_command(validator_src, validator_exe,
+                                    validator_lang)))
+
+    for n, (is_copy, line, st) in enumerate(testcases):
+        actions.append(([gen_exe, validator_exe] + ([line] if is_copy else []),
+                        [os.path.join(INPUT_DIRNAME, 'input%d.txt' % (n))],
+                        functools.partial(make_input, n, is_copy, line, st),
+                        "input generation",
+                        repr((is_copy, line, st))))
 
     for n in xrange(testcase_num):
         actions.append(([os.path.join(INPUT_DIRNAME, 'input%d.txt' % (n)),
                          sol_exe],
                         [os.path.join(OUTPUT_DIRNAME, 'output%d.txt' % (n))],
                         functools.partial(make_output, n),
-                        "output generation"))
+                        "output generation",
+                        ""))
     in_out_files = [os.path.join(INPUT_DIRNAME, 'input%d.txt' % (n))
                     for n in xrange(testcase_num)] + \
                    [os.path.join(OUTPUT_DIRNAME, 'output%d.txt' % (n))
@@ -490,20 +511,24 @@ def build_gen_list(base_dir, task_type):
 def build_action_list(base_dir, task_type, yaml_conf):
     """Build a list of actions that cmsMake is able to do here. Each
     action is described by a tuple (infiles, outfiles, callable,
-    description) where:
+    description, command) where:
 
     1) infiles is a list of files this action depends on;
 
     2) outfiles is a list of files this action produces; it is
-    intended that this action can be skipped if all the outfiles is
-    newer than all the infiles; moreover, the outfiles get deleted
-    when the action is cleaned;
+    intended that this action can be skipped if all the outfiles
+    exist and neither the infiles nor the command changed since they
+    were produced (see BuildCache); moreover, the outfiles get
+    deleted when the action is cleaned;
 
     3) callable is a callable Python object that, when called,
     performs the action;
 
     4) description is a human-readable description of what this
-    action does.
+    action does;
+
+    5) command is a string describing what exactly the action does
+    (e.g., the command line it runs), besides its infiles.
 
     """
     actions = []
@@ -536,6 +561,10 @@ def clean(base_dir, generated_list):
         shutil.rmtree(os.path.join(base_dir, RESULT_DIRNAME))
     except OSError:
         pass
+    try:
+        os.remove(os.path.join(base_dir, BUILD_CACHE))
+    except OSError:
+        pass
 
     # Delete backup files
     os.system("find %s -name '*.pyc' -delete" % (base_dir))
@@ -546,9 +575,8 @@ def build_execution_tree(actions):
     """Given a set of actions as described in the docstring of
     build_action_list(), builds an execution tree and the list of all
     the buildable files. The execution tree is a dictionary that maps
-    each builable or source file to the tuple (infiles, callable),
-    where infiles and callable are as in the docstring of
-    build_action_list().
+    each builable or source file to the action building it (source
+    files get an action with no infiles, doing nothing).
 
     """
     exec_tree = {}
@@ -558,84 +586,240 @@ def build_execution_tree(actions):
         for exe in action[1]:
             if exe in exec_tree:
                 raise Exception("Target %s not unique" % (exe))
-            exec_tree[exe] = (action[0], action[2])
+            exec_tree[exe] = action
             generated_list.append(exe)
         for src in action[0]:
             src_list.add(src)
     for src in src_list:
         if src not in exec_tree:
-            exec_tree[src] = ([], noop)
+            exec_tree[src] = ([], [src], noop, "source file", "")
     return exec_tree, generated_list
 
 
-def execute_target(base_dir, exec_tree, target,
-                   already_executed=None, stack=None,
-                   debug=False, assume=None):
-    # Initialization
-    if debug:
-        print(">> Target %s is requested" % (target))
-    if already_executed is None:
-        already_executed = set()
-    if stack is None:
-        stack = set()
-
-    # Get target information
-    deps = exec_tree[target][0]
-    action = exec_tree[target][1]
-
-    # If this target is already in the stack, we have a circular
-    # dependency
-    if target in stack:
-        raise Exception("Circular dependency detected")
-
-    # If the target was already made in another subtree, we have
-    # nothing to do
-    if target in already_executed:
-        if debug:
-            print(">> Target %s has already been built, ignoring..." %
-                  (target))
-        return
-
-    # Otherwise, do a step of the DFS to make dependencies
-    if debug:
-        print(">> Building dependencies for target %s" % (target))
-    already_executed.add(target)
-    stack.add(target)
-    for dep in deps:
-        execute_target(base_dir, exec_tree, dep,
-                       already_executed, stack, assume=assume)
-    stack.remove(target)
-    if debug:
-        print(">> Dependencies built for target %s" % (target))
-
-    # Check if the action really needs to be done (i.e., there is one
-    # dependency more recent than the generated file)
-    dep_times = max([0] + map(lambda dep: os.stat(
-        os.path.join(base_dir, dep)).st_mtime, deps))
-    try:
-        gen_time = os.stat(os.path.join(base_dir, target)).st_mtime
-    except OSError:
-        gen_time = 0
-    if gen_time >= dep_times:
-        if debug:
-            print(">> Target %s is already new enough, not building" %
-                  (target))
-        return
+class BuildCache(object):
+    """Remember, for each action that was performed, its command and
+    the digests of its infiles, so that the action is performed again
+    only when they change.
 
-    # At last: actually make the so long desired action :-)
-    if debug:
-        print(">> Acutally building target %s" % (target))
-    action(assume=assume)
-    if debug:
-        print(">> Target %s finished to build" % (target))
+    To avoid hashing files at every run, the digests are stored along
+    with the size and the modification time of the files; only the
+    files whose ones changed are hashed again.
 
+    """
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self.path = os.path.join(base_dir, BUILD_CACHE)
+        self.lock = threading.Lock()
+        # Map from the first outfile of each action to a dictionary
+        # with the command and the infiles, mapped to their
+        # [mtime, size, digest].
+        try:
+            with io.open(self.path, 'rb') as fin:
+                self.entries = json.load(fin)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def _file_info(self, name, old_info=None):
+        stat = os.stat(os.path.join(self.base_dir, name))
+        if old_info is not None and \
+                old_info[:2] == [stat.st_mtime, stat.st_size]:
+            return old_info
+        return [stat.st_mtime, stat.st_size,
+                sha1sum(os.path.join(self.base_dir, name))]
+
+    def is_up_to_date(self, action):
+        """Tell whether the action can be skipped.
+
+        action (tuple): an action as in build_action_list().
+
+        return (bool): True if all the outfiles of the action exist
+            and they were produced with the same infiles and command.
+
+        """
+        deps, targets, _, _, command = action
+        for target in targets:
+            if not os.path.exists(os.path.join(self.base_dir, target)):
+                return False
+
+        with self.lock:
+            entry = self.entries.get(targets[0])
+        if entry is None:
+            # The targets were produced before the cache existed (or
+            # by hand): fall back to comparing timestamps.
+            dep_times = max([0] + map(lambda dep: os.stat(
+                os.path.join(self.base_dir, dep)).st_mtime, deps))
+            gen_time = min(map(lambda target: os.stat(
+                os.path.join(self.base_dir, target)).st_mtime, targets))
+            return gen_time >= dep_times
+
+        if entry["command"] != command or \
+                sorted(entry["deps"]) != sorted(deps):
+            return False
+        return all(self._file_info(dep, entry["deps"][dep])[2] ==
+                   entry["deps"][dep][2] for dep in deps)
+
+    def record(self, action):
+        """Remember that the action has been performed (or that it
+        was up to date) with the current infiles.
+
+        action (tuple): an action as in build_action_list().
+
+        """
+        deps, targets, _, _, command = action
+        # Nothing to remember for actions not producing files (e.g.,
+        # tests) or that failed to.
+        for target in targets:
+            if not os.path.exists(os.path.join(self.base_dir, target)):
+                return
+        with self.lock:
+            old_entry = self.entries.get(targets[0], {"deps": {}})
+        entry = {"command": command,
+                 "deps": dict((dep,
+                               self._file_info(dep,
+                                               old_entry["deps"].get(dep)))
+                              for dep in deps)}
+        with self.lock:
+            self.entries[targets[0]] = entry
+
+    def save(self):
+        """Write the cache to disk.
+
+        """
+        with self.lock:
+            with io.open(self.path, 'wb') as fout:
+                json.dump(self.entries, fout)
+
+
+def sort_targets(exec_tree, targets):
+    """Return the actions needed to make the given targets, in an
+    order compatible with their dependencies.
+
+    """
+    actions = []
+    seen = set()
+    already_visited = set()
+    stack = set()
+
+    def visit(target):
+        # If this target is already in the stack, we have a circular
+        # dependency
+        if target in stack:
+            raise Exception("Circular dependency detected")
+        if target in already_visited:
+            return
+        already_visited.add(target)
+        stack.add(target)
+        action = exec_tree[target]
+        for dep in action[0]:
+            visit(dep)
+        stack.remove(target)
+        if action[2] is not noop and id(action) not in seen:
+            seen.add(id(action))
+            actions.append(action)
 
-def execute_multiple_targets(base_dir, exec_tree, targets,
-                             debug=False, assume=None):
-    already_executed = set()
     for target in targets:
-        execute_target(base_dir, exec_tree, target,
-                       already_executed, debug=debug, assume=assume)
+        visit(target)
+    return actions
+
+
+def execute_multiple_targets(base_dir, exec_tree, targets,
+                             debug=False, assume=None, jobs=1):
+    """Make the given targets, running up to the given number of
+    actions at the same time.
+
+    """
+    actions = sort_targets(exec_tree, targets)
+    cache = BuildCache(base_dir)
+
+    def execute_action(action):
+        if cache.is_up_to_date(action):
+            if debug:
+                print(">> Targets %s are already new enough, not building" %
+                      (", ".join(action[1])))
+        else:
+            if debug:
+                print(">> Actually building targets %s" %
+                      (", ".join(action[1])))
+            try:
+                action[2](assume=assume)
+            except BaseException:
+                # Do not leave around partial outfiles, that may look
+                # up to date next time.
+                for target in action[1]:
+                    try:
+                        os.remove(os.path.join(base_dir, target))
+                    except OSError:
+                        pass
+                raise
+            if debug:
+                print(">> Targets %s finished to build" %
+                      (", ".join(action[1])))
+        cache.record(action)
+
+    try:
+        if jobs <= 1:
+            for action in actions:
+                execute_action(action)
+        else:
+            execute_in_parallel(exec_tree, actions, execute_action, jobs)
+    finally:
+        cache.save()
+
+
+def execute_in_parallel(exec_tree, actions, execute_action, jobs):
+    """Execute the given actions, sorted as by sort_targets(), each
+    after the ones it depends on, in up to jobs threads.
+
+    """
+    index = dict((id(action), i) for i, action in enumerate(actions))
+    # For each action, how many of the actions it depends on are
+    # still to be done, and which actions depend on it.
+    waiting = [0] * len(actions)
+    dependents = [[] for _ in actions]
+    for i, action in enumerate(actions):
+        for dep in set(index[id(exec_tree[dep])] for dep in action[0]
+                       if id(exec_tree[dep]) in index):
+            waiting[i] += 1
+            dependents[dep].append(i)
+
+    done = Queue.Queue()
+
+    def worker(i):
+        # Actions exit on failure: we need to catch SystemExit too.
+        try:
+            execute_action(actions[i])
+        except BaseException:
+            done.put((i, sys.exc_info()))
+        else:
+            done.put((i, None))
+
+    ready = [i for i in xrange(len(actions)) if waiting[i] == 0]
+    running = 0
+    failure = None
+    while True:
+        # Stop starting actions after the first failure, but let the
+        # running ones finish.
+        while ready and running < jobs and failure is None:
+            thread = threading.Thread(target=worker, args=(ready.pop(0),))
+            thread.daemon = True
+            thread.start()
+            running += 1
+        if running == 0:
+            break
+        i, exc_info = done.get()
+        running -= 1
+        if exc_info is not None:
+            if failure is None:
+                failure = exc_info
+            continue
+        for j in dependents[i]:
+            waiting[j] -= 1
+            if waiting[j] == 0:
+                ready.append(j)
+
+    if failure is not None:
+        raise failure[0], failure[1], failure[2]
 
 
 def main():
@@ -659,6 +843,8 @@ def main():
                        help="answer no to all questions")
     parser.add_argument("-d", "--debug", action="store_true", default=False,
                         help="enable debug messages")
+    parser.add_argument("-j", "--jobs", action="store", type=int, default=1,
+                        help="number of actions to perform at the same time")
     parser.add_argument("targets", action="store", type=utf8_decoder,
                         nargs="*", metavar="target", help="target to build")
     options = parser.parse_args()
@@ -697,7 +883,7 @@ def main():
         try:
             execute_multiple_targets(base_dir, exec_tree,
                                      generated_list, debug=options.debug,
-                                     assume=assume)
+                                     assume=assume, jobs=options.jobs)
 
         # After all work, possibly clean the left-overs of testing
         finally:
@@ -707,7 +893,7 @@ def main():
         try:
             execute_multiple_targets(base_dir, exec_tree,
                                      options.targets, debug=options.debug,
-                                     assume=assume)
+                                     assume=assume, jobs=options.jobs)
 
         # After all work, possibly clean the left-overs of testing
         finally:
@@ -0,0 +1,156 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Load test for RankingWebServer.
+
+Simulate spectators: each of them keeps the event stream open and
+polls the scores, like the ranking page does. Running it against RWS
+configured with an increasing number of readers shows how the
+throughput scales with them.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import multiprocessing
+import sys
+import threading
+import time
+
+import requests
+
+
+def follow_events(url, received):
+    """Keep the event stream open, counting the events received.
+
+    url (unicode): the URL of the event stream.
+    received ([int]): a one-element list, incremented at each event.
+
+    """
+    try:
+        response = requests.get(url, stream=True,
+                                headers={"Accept": "text/event-stream"})
+        for line in response.iter_lines():
+            if line.startswith(b"data:"):
+                received[0] += 1
+    except requests.RequestException:
+        pass
+
+
+def run_client(args):
+    """Run the spectators of one client process.
+
+    args ((unicode, int, int, float)): the base URL of the ranking,
+        the number of event streams to open, the number of threads
+        polling the scores and the duration of the test in seconds.
+
+    return ((int, int, float, int)): the number of successful and
+        failed requests, their total time and the number of events
+        received.
+
+    """
+    url, streams, pollers, duration = args
+    received = [0]
+    for _ in xrange(streams):
+        thread = threading.Thread(target=follow_events,
+                                  args=(url + "/events", received))
+        thread.daemon = True
+        thread.start()
+
+    stats = [0, 0, 0.0]
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def poll():
+        session = requests.Session()
+        while time.time() < deadline:
+            start = time.time()
+            try:
+                response = session.get(url + "/scores",
+                                       headers={"Accept": "application/json"})
+                ok = response.status_code == 200
+            except requests.RequestException:
+                ok = False
+            with lock:
+                stats[0 if ok else 1] += 1
+                stats[2] += time.time() - start
+
+    threads = list(threading.Thread(target=poll) for _ in xrange(pollers))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stats[0], stats[1], stats[2], received[0]
+
+
+def main():
+    """Parse arguments and launch the test.
+
+    return (int): 0 if all requests succeeded.
+
+    """
+    parser = argparse.ArgumentParser(
+        description="Load test for RankingWebServer.")
+    parser.add_argument("url", action="store", type=unicode,
+                        help="base URL of the ranking")
+    parser.add_argument("-p", "--processes", action="store", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="number of client processes")
+    parser.add_argument("-s", "--spectators", action="store", type=int,
+                        default=2000,
+                        help="number of event streams kept open")
+    parser.add_argument("-c", "--pollers", action="store", type=int,
+                        default=8,
+                        help="number of threads polling the scores in "
+                        "each process")
+    parser.add_argument("-t", "--duration", action="store", type=float,
+                        default=30.0,
+                        help="duration of the test, in seconds")
+    args = parser.parse_args()
+
+    url = args.url.rstrip("/")
+    jobs = list((url,
+                 args.spectators // args.processes +
+                 (1 if i < args.spectators % args.processes else 0),
+                 args.pollers, args.duration)
+                for i in xrange(args.processes))
+
+    pool = multiprocessing.Pool(args.processes)
+    results = pool.map(run_client, jobs)
+    pool.close()
+
+    success = sum(r[0] for r in results)
+    failure = sum(r[1] for r in results)
+    total_time = sum(r[2] for r in results)
+    events = sum(r[3] for r in results)
+
+    print("Requests:       %7d (%d failed)" % (success + failure, failure))
+    print("Throughput:     %9.1f req/s" % (success / args.duration))
+    if success + failure > 0:
+        print("Average time:   %9.3f s" %
+              (total_time / (success + failure)))
+    print("Events:         %7d" % events)
+
+    return 0 if failure == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the publisher of the event streams."""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import re
+import unittest
+
+import gevent
+
+from cmscommon.eventsource import Publisher, REINIT_FRAME
+
+
+def get_data(frames):
+    """Return the data of the given frames."""
+    return list(re.search(b"data:(.*)\n", frame).group(1)
+                if frame != REINIT_FRAME else None
+                for frame in frames)
+
+
+def get_id(frame):
+    """Return the id of the given frame."""
+    return re.match(b"id:([0-9a-f]+)\n", frame).group(1).decode('utf-8')
+
+
+class TestPublisher(unittest.TestCase):
+
+    def setUp(self):
+        self.pub = Publisher(4)
+
+    def test_new_subscriber(self):
+        """A new subscriber gets only the messages put afterwards."""
+        self.pub.put("e", "1")
+        sub = self.pub.get_subscriber()
+        self.pub.put("e", "2")
+        self.pub.put("e", "3")
+        self.assertEqual(get_data(sub.get()), [b"2", b"3"])
+        self.pub.put("e", "4")
+        self.assertEqual(get_data(sub.get()), [b"4"])
+        self.assertTrue(self.pub.has_subscribers())
+
+    def test_wait(self):
+        """Getting blocks until a message is put."""
+        sub = self.pub.get_subscriber()
+        getter = gevent.spawn(lambda: get_data(sub.get()))
+        gevent.sleep(0)
+        self.assertFalse(getter.ready())
+        self.pub.put("e", "1")
+        self.assertEqual(getter.get(timeout=1), [b"1"])
+
+    def test_replay(self):
+        """Missed messages still cached are sent again."""
+        frames = list()
+        for i in xrange(6):
+            self.pub.put("e", "%d" % i)
+            frames.append(self.pub._frames[i % 4])
+        sub = self.pub.get_subscriber(get_id(frames[3]))
+        self.assertEqual(get_data(sub.get()), [b"4", b"5"])
+        sub = self.pub.get_subscriber(get_id(frames[5]))
+        self.pub.put("e", "6")
+        self.assertEqual(get_data(sub.get()), [b"6"])
+
+    def test_replay_too_old(self):
+        """Clients that missed dropped messages are asked to reinit."""
+        frames = list()
+        for i in xrange(6):
+            self.pub.put("e", "%d" % i)
+            frames.append(self.pub._frames[i % 4])
+        sub = self.pub.get_subscriber(get_id(frames[0]))
+        self.assertEqual(get_data(sub.get()), [None])
+        self.pub.put("e", "6")
+        self.assertEqual(get_data(sub.get()), [b"6"])
+
+    def test_lagging(self):
+        """A subscriber falling too much behind is asked to reinit and
+        then continues from the newest messages.
+
+        """
+        sub = self.pub.get_subscriber()
+        for i in xrange(5):
+            self.pub.put("e", "%d" % i)
+        self.assertEqual(get_data(sub.get()), [None])
+        self.pub.put("e", "5")
+        self.assertEqual(get_data(sub.get()), [b"5"])
+        stats = self.pub.get_stats()
+        self.assertEqual(stats["messages"], 6)
+        self.assertEqual(stats["reinits"], 1)
+        self.assertEqual(stats["delivered"], 1)
+        self.assertEqual(stats["buffered_bytes"],
+                         sum(len(frame) for frame in self.pub._frames))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the functions in cms.grading."""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import json
+import unittest
+
+from cms.grading import render_score_details, white_diff, white_diff_digest
+
+
+class TestRenderScoreDetails(unittest.TestCase):
+    """Test the function render_score_details."""
+
+    @staticmethod
+    def make_testcase(idx, outcome):
+        return {"idx": idx,
+                "outcome": outcome,
+                "text": json.dumps(["Output is %s (%d)", outcome, idx])}
+
+    def test_without_subtasks(self):
+        details = [self.make_testcase(0, "Correct"),
+                   self.make_testcase(1, "Wrong")]
+        rendered = json.loads(
+            render_score_details(50.004, json.dumps(details)))
+        self.assertEqual(len(rendered), 1)
+        self.assertEqual(rendered[0]["score"], 50.0)
+        self.assertEqual(rendered[0]["max_score"], 100)
+        self.assertEqual([t["text"] for t in rendered[0]["testcases"]],
+                         ["Output is Correct (0)", "Output is Wrong (1)"])
+
+    def test_with_subtasks(self):
+        details = [
+            {"score": 30, "max_score": 30,
+             "testcases": [self.make_testcase(0, "Correct")]},
+            {"score": 0, "max_score": 70,
+             "testcases": [self.make_testcase(1, "Wrong")]}]
+        rendered = json.loads(render_score_details(30.0, json.dumps(details)))
+        self.assertEqual([(s["score"], s["max_score"]) for s in rendered],
+                         [(30, 30), (0, 70)])
+        self.assertEqual(rendered[1]["testcases"][0]["text"],
+                         "Output is Wrong (1)")
+
+    def test_empty(self):
+        self.assertEqual(json.loads(render_score_details(0.0, "[]")), [])
+
+
+class TestWhiteDiffDigest(unittest.TestCase):
+    """Test that white_diff_digest agrees with white_diff."""
+
+    FILES = [b"", b"\n\n", b"1 2\n3\n", b"1  2 \n\t3", b"1 2\n3\n\n \n",
+             b"1 2\n\n3\n", b"1 2\n3 \n4\n", b"12\n3\n", b"\n1 2\n3\n"]
+
+    def test_agrees_with_white_diff(self):
+        for a in self.FILES:
+            for b in self.FILES:
+                self.assertEqual(
+                    white_diff(io.BytesIO(a), io.BytesIO(b)),
+                    white_diff_digest(io.BytesIO(a)) ==
+                    white_diff_digest(io.BytesIO(b)),
+                    (a, b))
+
+
+if __name__ == "__main__":
+    unittest.main()
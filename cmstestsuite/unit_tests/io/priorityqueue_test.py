@@ -52,6 +52,21 @@ class TestPriorityQueue(unittest.TestCase):
         self.queue = PriorityQueue()
         pass
 
+    def test_sorted_entries(self):
+        """Verify that the entries are listed in extraction order."""
+        self.queue.push(self.item_a, PriorityQueue.PRIORITY_LOW)
+        self.queue.push(self.item_b, PriorityQueue.PRIORITY_MEDIUM,
+                        timestamp=make_datetime(10))
+        self.queue.push(self.item_c, PriorityQueue.PRIORITY_MEDIUM,
+                        timestamp=make_datetime(5))
+        self.queue.push(self.item_d, PriorityQueue.PRIORITY_MEDIUM,
+                        timestamp=make_datetime(5))
+
+        self.assertEqual(
+            [entry.item for entry in self.queue.get_sorted_entries()],
+            [self.item_c, self.item_d, self.item_b, self.item_a])
+        self.assertEqual(self.queue.length(), 4)
+
     def test_success(self):
         """Verify a simple success case.
 
@@ -25,6 +25,7 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import time
 import unittest
 
 import gevent
@@ -34,9 +35,10 @@ from gevent.server import StreamServer
 
 from mock import Mock, patch
 
-from cms import Address, ServiceCoord
+from cms import Address, ServiceCoord, config
 from cms.io import RPCError, rpc_method, RemoteServiceServer, \
     RemoteServiceClient
+from cms.io.rpc import CODECS, FRAME_HEADER, FRAME_MARKER
 
 
 class MockService(object):
@@ -381,6 +383,75 @@ class TestRPC(unittest.TestCase):
         # Verify the server resumes normal operation.
         self.test_method_return_int()
 
+    def test_negotiation(self):
+        client = self.get_client(ServiceCoord("Foo", 0))
+        gevent.sleep(0.002)
+        self.assertEqual(client._codec, config.rpc_codecs[0])
+        self.test_method_return_list()
+
+    def test_negotiation_disabled(self):
+        with patch.object(config, "rpc_codecs", []):
+            client = self.get_client(ServiceCoord("Foo", 0))
+            gevent.sleep(0.002)
+            self.assertIsNone(client._codec)
+            result = client.echo(value=["Hello", 42, "World"])
+            result.wait()
+            self.assertTrue(result.successful())
+            self.assertEqual(result.value, ["Hello", 42, "World"])
+
+    def test_large_message(self):
+        # Larger than MAX_MESSAGE_SIZE, that only applies to the
+        # legacy format.
+        value = "x" * (2 * RemoteServiceClient.MAX_MESSAGE_SIZE)
+        client = self.get_client(ServiceCoord("Foo", 0))
+        gevent.sleep(0.002)
+        result = client.echo(value=value)
+        result.wait()
+        self.assertTrue(result.successful())
+        self.assertEqual(result.value, value)
+
+    def test_send_unknown_codec(self):
+        sock = gevent.socket.create_connection((self.host, self.port))
+        sock.sendall(FRAME_HEADER.pack(FRAME_MARKER, 255, 3) + b"foo")
+        gevent.sleep(0.002)
+        self.assertTrue(self.servers[0].connected)
+        # Verify the server resumes normal operation.
+        self.test_method_return_int()
+
+    def benchmark(self, codecs, value, count):
+        """Measure how many echo calls per second are performed.
+
+        codecs ([unicode]): the codecs the client should propose.
+        value (object): the argument of each call.
+        count (int): the number of calls to issue (concurrently).
+
+        return (float): calls per second.
+
+        """
+        with patch.object(config, "rpc_codecs", codecs):
+            client = self.get_client(ServiceCoord("Foo", 0))
+            gevent.sleep(0.002)
+        start = time.time()
+        results = [client.echo(value=value) for _ in range(count)]
+        for result in results:
+            result.wait()
+            self.assertTrue(result.successful())
+        elapsed = time.time() - start
+        client.disconnect()
+        return count / elapsed
+
+    def test_throughput(self):
+        # Something shaped like a job group: many small dicts with
+        # digests and some text.
+        value = {"jobs": dict(("%d" % i, {"digest": "%040x" % i,
+                                          "text": "Output is correct",
+                                          "time": 0.1, "memory": 1024})
+                              for i in range(1000))}
+        for codecs in [[]] + [[codec] for codec in sorted(CODECS)]:
+            rate = self.benchmark(codecs, value, 100)
+            print("%s: %.1f calls/s" % (codecs[0] if codecs else "legacy",
+                                        rate))
+
 
 if __name__ == "__main__":
     unittest.main()
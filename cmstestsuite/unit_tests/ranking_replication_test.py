@@ -0,0 +1,176 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the replication of the stores of RWS to its readers."""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import gevent
+from gevent import socket
+from mock import patch
+
+import cmsranking.RankingWebServer
+from cmsranking.RankingWebServer import DataWatcher, ReplicationPublisher, \
+    STORES, replicate
+import cmsranking.Contest as Contest
+import cmsranking.Task as Task
+import cmsranking.User as User
+import cmsranking.Submission as Submission
+import cmsranking.Subchange as Subchange
+
+
+CONTEST = {"name": "Contest", "begin": 0, "end": 1000,
+           "score_precision": 0}
+TASK = {"name": "Task", "short_name": "task", "contest": "c",
+        "max_score": 100.0, "score_precision": 0, "extra_headers": [],
+        "score_mode": "max", "order": 0}
+USER = {"f_name": "First", "l_name": "Last", "team": None}
+SUBMISSION = {"user": "u", "task": "t", "time": 10}
+SUBCHANGE = {"submission": "s", "time": 20, "score": 50.0,
+             "extra": ["50"]}
+
+
+class TestReplication(unittest.TestCase):
+    """Run a writer in a child process and replicate its changes to
+    the stores of this one, acting as a reader.
+
+    """
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.writer_dir = os.path.join(self.base_dir, "writer")
+        self.reader_dir = os.path.join(self.base_dir, "reader")
+        for _, store in STORES:
+            self.use_dir(store, self.reader_dir)
+            store._store.clear()
+            store.persistent = False
+        self.event_handler = DataWatcher()
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    @staticmethod
+    def use_dir(store, lib_dir):
+        """Make a store save its entities in the given directory."""
+        store._path = os.path.join(lib_dir, os.path.basename(store._path))
+        os.makedirs(store._path)
+
+    def replicate(self, writer, lines=()):
+        """Replicate the changes made by writer in a child process.
+
+        writer (function): makes the changes, in the child.
+        lines ([bytes]): changes to send before those of writer.
+
+        """
+        writer_end, reader_end = socket.socketpair()
+        pid = gevent.fork()
+        if pid == 0:
+            reader_end.close()
+            status = 1
+            try:
+                for _, store in STORES:
+                    self.use_dir(store, self.writer_dir)
+                    store.persistent = True
+                writer_end.sendall(b"".join(lines))
+                publisher = ReplicationPublisher([writer_end])
+                writer()
+                while not all(queue.empty() for queue in publisher._queues):
+                    gevent.sleep(0.01)
+                gevent.sleep(0.1)
+                writer_end.close()
+                status = 0
+            finally:
+                os._exit(status)
+        writer_end.close()
+        replicate(reader_end, self.event_handler)
+        reader_end.close()
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+
+    def assertNothingWritten(self):
+        for dir_path, _, file_names in os.walk(self.reader_dir):
+            self.assertEqual(file_names, [], dir_path)
+
+    def test_create_update_delete(self):
+        """Changes are applied, in order, to the replicas."""
+        def writer():
+            Contest.store.create("c", CONTEST)
+            User.store.create("u", USER)
+            Task.store.create("t", TASK)
+            Task.store.update("t", dict(TASK, name="Renamed"))
+            User.store.create("v", USER)
+            User.store.delete("v")
+
+        self.replicate(writer)
+        self.assertEqual(Task.store.retrieve("t")["name"], "Renamed")
+        self.assertIn("c", Contest.store)
+        self.assertIn("u", User.store)
+        self.assertNotIn("v", User.store)
+        self.assertNothingWritten()
+
+    def test_cascaded_delete(self):
+        """The deletions caused by another one are applied once."""
+        def writer():
+            Contest.store.create("c", CONTEST)
+            User.store.create("u", USER)
+            Task.store.create("t", TASK)
+            Submission.store.create("s", SUBMISSION)
+            Subchange.store.create("sc", SUBCHANGE)
+            # Deletes the submission and its subchange too.
+            Task.store.delete("t")
+
+        # The deletion of an entity the replica doesn't have (e.g.
+        # already deleted as depending on another one) is ignored.
+        missing = json.dumps({"seq": 1, "entity": "user",
+                              "event": "delete", "key": "x",
+                              "data": None}) + b"\n"
+        with patch.object(cmsranking.RankingWebServer.logger,
+                          "error") as error:
+            self.replicate(writer, [missing])
+        self.assertFalse(error.called)
+        self.assertNotIn("t", Task.store)
+        self.assertNotIn("s", Submission.store)
+        self.assertNotIn("sc", Subchange.store)
+        self.assertIn("c", Contest.store)
+        self.assertIn("u", User.store)
+        self.assertNothingWritten()
+
+    def test_event_ids(self):
+        """Readers key the events by the writer's change numbers."""
+        def writer():
+            Contest.store.create("c", CONTEST)
+            Contest.store.update("c", dict(CONTEST, name="Renamed"))
+
+        self.replicate(writer)
+        keys = [key for key in self.event_handler._pub._keys
+                if key is not None]
+        self.assertEqual(len(keys), 2)
+        # One change each, with consecutive numbers.
+        self.assertEqual((keys[1] >> 32) - (keys[0] >> 32), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -28,7 +28,8 @@ from __future__ import unicode_literals
 import unittest
 from datetime import date, time, datetime, timedelta
 
-from cms.server import compute_actual_phase
+from cms.server import compute_actual_phase, etag_matches, \
+    parse_range_header
 
 
 def parse_datetime(value):
@@ -216,5 +217,35 @@ class TestComputeActualPhase(unittest.TestCase):
         test("6", "18", "3", "19", "1", "1", ("6", -1, "19", 0, "20"))
 
 
+class TestConditionalRequests(unittest.TestCase):
+
+    def test_etag_matches(self):
+        self.assertFalse(etag_matches(None, "\"abc\""))
+        self.assertTrue(etag_matches("*", "\"abc\""))
+        self.assertTrue(etag_matches("\"abc\"", "\"abc\""))
+        self.assertTrue(etag_matches("W/\"abc\"", "\"abc\""))
+        self.assertTrue(etag_matches("\"def\", \"abc\"", "\"abc\""))
+        self.assertFalse(etag_matches("\"def\"", "\"abc\""))
+
+    def test_parse_range_header(self):
+        # Whole resource.
+        self.assertIsNone(parse_range_header(None, 100))
+        self.assertIsNone(parse_range_header("bytes=0-1,5-6", 100))
+        self.assertIsNone(parse_range_header("items=0-1", 100))
+        self.assertIsNone(parse_range_header("bytes=5-1", 100))
+        self.assertIsNone(parse_range_header("bytes=-", 100))
+        self.assertIsNone(parse_range_header("bytes=a-b", 100))
+        # Single ranges.
+        self.assertEqual(parse_range_header("bytes=0-0", 100), (0, 1))
+        self.assertEqual(parse_range_header("bytes=10-19", 100), (10, 20))
+        self.assertEqual(parse_range_header("bytes=10-", 100), (10, 100))
+        self.assertEqual(parse_range_header("bytes=90-200", 100), (90, 100))
+        self.assertEqual(parse_range_header("bytes=-10", 100), (90, 100))
+        self.assertEqual(parse_range_header("bytes=-200", 100), (0, 100))
+        # Not satisfiable.
+        self.assertRaises(ValueError, parse_range_header, "bytes=100-", 100)
+        self.assertRaises(ValueError, parse_range_header, "bytes=-0", 100)
+
+
 if __name__ == "__main__":
     unittest.main()
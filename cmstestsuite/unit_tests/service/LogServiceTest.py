@@ -28,6 +28,11 @@ from __future__ import unicode_literals
 import logging
 import unittest
 
+import gevent
+import gevent.event
+from mock import Mock
+
+from cms.log import LogServiceHandler
 from cms.service.LogService import LogService
 
 
@@ -81,6 +86,70 @@ class TestLogService(unittest.TestCase):
         else:
             self.assertNotEquals(last_message["severity"], severity)
 
+    def test_log_batch(self):
+        self.service.LogBatch(records=[
+            {"msg": TestLogService.MSG + "%d" % i,
+             "levelname": "ERROR",
+             "levelno": logging.ERROR,
+             "created": TestLogService.CREATED}
+            for i in range(3)])
+        self.assertEquals([m["message"]
+                           for m in self.service.last_messages()[-3:]],
+                          [TestLogService.MSG + "%d" % i for i in range(3)])
+
+
+class TestLogServiceHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.log_service = Mock()
+        self.batches = []
+
+        def log_batch(records):
+            self.batches.append(records)
+            result = gevent.event.AsyncResult()
+            result.set(None)
+            return result
+        self.log_service.LogBatch.side_effect = log_batch
+
+        self.handler = LogServiceHandler(self.log_service, sampling_rate=5)
+        self.logger = logging.Logger("test")
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.handler._sender.kill()
+
+    def messages(self):
+        return [record["msg"]
+                for batch in self.batches for record in batch]
+
+    def test_batching(self):
+        for i in range(LogServiceHandler.BATCH_SIZE + 1):
+            self.logger.error("%d", i)
+        self.assertEquals(self.batches, [])
+        gevent.sleep(2 * LogServiceHandler.FLUSH_INTERVAL)
+        self.assertEquals(len(self.batches), 2)
+        self.assertEquals(self.messages(),
+                          ["%d" % i
+                           for i in range(LogServiceHandler.BATCH_SIZE + 1)])
+
+    def test_sampling(self):
+        for i in range(10):
+            self.logger.info("info %d", i)
+            self.logger.warning("warning %d", i)
+        gevent.sleep(2 * LogServiceHandler.FLUSH_INTERVAL)
+        messages = self.messages()
+        # All warnings are kept, but only 5 infos (plus the report).
+        self.assertEquals(len(messages), 10 + 5 + 1)
+        self.assertIn("0 log records dropped because the queue was full, "
+                      "5 because of sampling.", messages)
+
+    def test_queue_full(self):
+        for i in range(LogServiceHandler.MAX_QUEUE_SIZE + 7):
+            self.logger.error("%d", i)
+        gevent.sleep(2 * LogServiceHandler.FLUSH_INTERVAL)
+        self.assertIn("7 log records dropped because the queue was full, "
+                      "0 because of sampling.", self.messages())
+
 
 if __name__ == "__main__":
     unittest.main()
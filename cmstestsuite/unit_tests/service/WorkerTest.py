@@ -32,6 +32,7 @@ from mock import Mock, call
 import cms.service.Worker
 from cms.grading import JobException
 from cms.grading.Job import EvaluationJob, JobGroup
+from cms.grading.Sandbox import SandboxBase
 from cms.service.Worker import Worker
 
 
@@ -157,7 +158,7 @@ class TestWorker(unittest.TestCase):
         """After a failure, the worker should be able to accept another job.
 
         """
-        jobgroup_a, calls_a = TestWorker.new_jobgroup(1)
+        jobgroup_a, calls_a = TestWorker.new_jobgroup(1, prefix="a")
         task_type_a = FakeTaskType([Exception()])
         cms.service.Worker.get_task_type = Mock(return_value=task_type_a)
 
@@ -173,7 +174,7 @@ class TestWorker(unittest.TestCase):
             calls_a, any_order=True)
         self.assertEquals(task_type_a.call_count, 1)
 
-        jobgroup_b, calls_b = TestWorker.new_jobgroup(3)
+        jobgroup_b, calls_b = TestWorker.new_jobgroup(3, prefix="b")
         task_type_b = FakeTaskType([True, True, True])
         cms.service.Worker.get_task_type = Mock(return_value=task_type_b)
 
@@ -184,6 +185,25 @@ class TestWorker(unittest.TestCase):
             calls_b, any_order=True)
         self.assertEquals(task_type_b.call_count, 3)
 
+    def test_execute_job_group_task_type_cached(self):
+        """Executes two job groups with the same task type parameters,
+        that should be instantiated only once.
+
+        """
+        jobgroup_a, calls_a = TestWorker.new_jobgroup(2, same_parameters=True)
+        jobgroup_b, unused_calls_b = \
+            TestWorker.new_jobgroup(2, same_parameters=True)
+        task_type = FakeTaskType([True, True, True, True])
+        cms.service.Worker.get_task_type = Mock(return_value=task_type)
+
+        for jobgroup in [jobgroup_a, jobgroup_b]:
+            JobGroup.import_from_dict(
+                self.service.execute_job_group(jobgroup.export_to_dict()))
+
+        cms.service.Worker.get_task_type.assert_called_once_with(
+            *calls_a[0][1])
+        self.assertEquals(task_type.call_count, 4)
+
     # Testing ignore_job.
 
     def test_ignore_job(self):
@@ -210,13 +230,46 @@ class TestWorker(unittest.TestCase):
         self.assertEquals(cms.service.Worker.get_task_type.call_count, 1)
         self.assertEquals(task_type.call_count, 1)
 
+    def test_ignore_job_aborts_sandboxes(self):
+        """Sends an ignore_job request during a job: the sandbox then
+        refuses to start processes, the job group fails without
+        errors, and the next one runs normally.
+
+        """
+        jobgroup, unused_calls = TestWorker.new_jobgroup(1)
+
+        def execute_job(job, file_cacher):
+            gevent.sleep(0.01)
+            SandboxBase(file_cacher)._start_process(["true"])
+            job.success = True
+
+        task_type = Mock()
+        task_type.execute_job.side_effect = execute_job
+        cms.service.Worker.get_task_type = Mock(return_value=task_type)
+
+        greenlet = gevent.spawn(self.service.execute_job_group,
+                                jobgroup.export_to_dict())
+        gevent.sleep(0)  # Ensure it enters into the job.
+
+        self.service.ignore_job()
+
+        self.assertFalse(JobGroup.import_from_dict(greenlet.get()).success)
+
+        jobgroup, unused_calls = TestWorker.new_jobgroup(1, prefix="b")
+        cms.service.Worker.get_task_type = Mock(
+            return_value=FakeTaskType([True]))
+        new_group = JobGroup.import_from_dict(
+            self.service.execute_job_group(jobgroup.export_to_dict()))
+        self.assertTrue(new_group.success)
+
     @staticmethod
-    def new_jobgroup(number_of_jobs, prefix=None):
+    def new_jobgroup(number_of_jobs, prefix=None, same_parameters=False):
         prefix = prefix if prefix is not None else ""
         jobgroup_dict = {}
         calls = []
         for i in xrange(number_of_jobs):
-            job_params = ("fake_task_type", "fake_parameters_%s" % i)
+            job_params = ("fake_task_type", "fake_parameters_%s%s" %
+                          (prefix, 0 if same_parameters else i))
             job = EvaluationJob(*job_params, info="%s%d" % (prefix, i))
             jobgroup_dict["%s" % i] = job
             calls.append(call(*job_params))
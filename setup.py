@@ -181,6 +181,7 @@ def do_setup():
                   "cmsAddUser=cmscontrib.AddUser:main",
                   "cmsRemoveUser=cmscontrib.RemoveUser:main",
                   "cmsRemoveTask=cmscontrib.RemoveTask:main",
+                  "cmsRenderScoreDetails=cmscontrib.RenderScoreDetails:main",
                   "cmsComputeComplexity=cmscontrib.ComputeComplexity:main",
                   "cmsTestImporter=cmscontrib.TestImporter:main",
                   "cmsImporter=cmscontrib.Importer:main",